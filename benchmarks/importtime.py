@@ -0,0 +1,130 @@
+# measures the cold start of the server:
+# - the import of code/main.py with `python -X importtime`, the slowest modules (cumulative) are listed
+# - optionally (--server) the time from starting main.py until /healthz answers (listening) and until /readyz
+#   answers 200 (database ready), against a sqlite database in a temporary folder
+#
+# example:
+#   python benchmarks/importtime.py
+#   python benchmarks/importtime.py --max-import-ms 800 --server --max-listen-ms 1500
+import argparse, json, os, re, socket, subprocess, sys, tempfile, time
+from urllib.request import urlopen
+from urllib.error import HTTPError, URLError
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CODE = os.path.join(ROOT, "code")
+
+# the configuration main.py reads at import time
+ENV = {
+    "POSTGRES_USER": "postgres",
+    "POSTGRES_PASSWORD": "password",
+    "SMTP_PORT": "25",
+    "DOMAIN": "localhost",
+    "BOT_USERNAME": "bot",
+    "BOT_EMAIL": "bot",
+    "GAMELIST_LIMIT": "20",
+    "SESSION_TIMEOUT": "1209600",
+    "ENABLE_SSL": "FALSE",
+    "PRODUCTION": "TRUE",
+}
+
+LINE = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)")
+
+def environment(extra={}):
+    env = dict(os.environ)
+    for key, value in ENV.items():
+        env.setdefault(key, value)
+    env.update(extra)
+    return env
+
+# imports main.py in a fresh interpreter, returns the modules as (name, self us, cumulative us, depth)
+def importTimes(databaseUri):
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", "import main"], cwd=CODE, env=environment({"DATABASE_URI": databaseUri}), capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError("importing main.py failed:\n" + result.stderr[-2000:])
+    modules = []
+    for line in result.stderr.splitlines():
+        match = LINE.match(line)
+        if match:
+            modules.append((match.group(4), int(match.group(1)), int(match.group(2)), len(match.group(3)) // 2))
+    return modules
+
+def freePort():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+# returns the status of a GET request, None if the server doesn't answer
+def status(url):
+    try:
+        with urlopen(url, timeout=1) as response:
+            return response.status
+    except HTTPError as e:
+        return e.code
+    except (URLError, OSError):
+        return None
+
+# starts main.py and returns the seconds until it listens (/healthz) and until it is ready (/readyz)
+def serverStartup(databaseUri, timeout, warmup):
+    port = freePort()
+    env = environment({"DATABASE_URI": databaseUri, "HTTP_PORT": str(port), "HTTPS_PORT": str(freePort()), "SMTP_HOST": "127.0.0.1", "WARMUP": warmup})
+    start = time.perf_counter()
+    process = subprocess.Popen([sys.executable, "main.py"], cwd=CODE, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    listening = ready = None
+    try:
+        while time.perf_counter() - start < timeout and process.poll() is None:
+            if listening is None and status(f"http://127.0.0.1:{port}/healthz") == 200:
+                listening = time.perf_counter() - start
+            if listening is not None and status(f"http://127.0.0.1:{port}/readyz") == 200:
+                ready = time.perf_counter() - start
+                break
+            time.sleep(0.01)
+    finally:
+        process.terminate()
+        process.wait(10)
+    return listening, ready
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="measures the import time of main.py and the startup of the server")
+    parser.add_argument("--runs", type=int, default=3, help="imports to measure, the fastest counts")
+    parser.add_argument("--top", type=int, default=15, help="number of modules to list")
+    parser.add_argument("--max-import-ms", type=float, help="fail if importing main.py takes longer")
+    parser.add_argument("--server", action="store_true", help="also measure the time until the server listens and is ready")
+    parser.add_argument("--warmup", default="background", choices=["background", "eager", "lazy"], help="WARMUP of the started server")
+    parser.add_argument("--max-listen-ms", type=float, help="fail if the server takes longer until /healthz answers")
+    parser.add_argument("--startup-timeout", type=float, default=60, help="seconds to wait for the server")
+    parser.add_argument("--output", help="write the results as json to this file")
+    args = parser.parse_args()
+
+    failures = []
+    with tempfile.TemporaryDirectory() as directory:
+        databaseUri = "sqlite:///" + os.path.join(directory, "startup.db")
+        runs = [importTimes(databaseUri) for _ in range(args.runs)]
+        # the fastest run has the least noise
+        modules = min(runs, key=lambda modules: next(cumulative for name, _, cumulative, _ in modules if name == "main"))
+        total = next(cumulative for name, _, cumulative, _ in modules if name == "main") / 1000
+        print(f"import main: {total:.1f} ms (fastest of {args.runs})")
+        print(f"{'module':<45}{'self ms':>10}{'cumulative ms':>16}")
+        # the direct imports of main are the ones that can be deferred
+        direct = [module for module in modules if module[3] == 1]
+        for name, own, cumulative, _ in sorted(direct, key=lambda module: -module[2])[:args.top]:
+            print(f"{name:<45}{own / 1000:>10.1f}{cumulative / 1000:>16.1f}")
+        report = {"importMs": total, "modules": {name: cumulative / 1000 for name, _, cumulative, _ in direct}}
+        if args.max_import_ms and total > args.max_import_ms:
+            failures.append(f"import took {total:.1f} ms (max {args.max_import_ms} ms)")
+
+        if args.server:
+            listening, ready = serverStartup(databaseUri, args.startup_timeout, args.warmup)
+            report.update(listenMs=listening and listening * 1000, readyMs=ready and ready * 1000)
+            print(f"server listening after {listening * 1000:.0f} ms" if listening else "server did not listen")
+            print(f"server ready after {ready * 1000:.0f} ms" if ready else "server did not get ready")
+            if listening is None or ready is None:
+                failures.append("server did not start")
+            elif args.max_listen_ms and listening * 1000 > args.max_listen_ms:
+                failures.append(f"listening took {listening * 1000:.0f} ms (max {args.max_listen_ms} ms)")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    if failures:
+        print("\n".join(failures))
+        sys.exit(1)
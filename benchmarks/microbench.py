@@ -0,0 +1,330 @@
+# microbenchmarks for the in-process hot paths of the server
+#
+# every benchmark runs on its own and without a database: main.py is loaded against an in-memory sqlite
+# database and sockets and the smtp server are replaced by fakes. the results are compared with the
+# numbers stored in benchmarks/baseline.json.
+#
+# example:
+#   python benchmarks/microbench.py                    # run all benchmarks and compare with the baseline
+#   python benchmarks/microbench.py solveState rotate  # only run benchmarks containing one of the names
+#   python benchmarks/microbench.py --save-baseline    # store the results as the new baseline
+#   python benchmarks/microbench.py encode --json-backend json  # the encoders without orjson
+import argparse, json, os, platform, statistics, subprocess, sys, time, types
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BASELINE = os.path.join(ROOT, "benchmarks", "baseline.json")
+
+# main.py reads its configuration from the environment at import time
+for key, value in {
+    "DATABASE_URI": "sqlite://",
+    "POSTGRES_USER": "postgres",
+    "POSTGRES_PASSWORD": "password",
+    "SMTP_PORT": "25",
+    "DOMAIN": "localhost",
+    "BOT_USERNAME": "bot",
+    "BOT_EMAIL": "bot",
+    "GAMELIST_LIMIT": "20",
+    "SESSION_TIMEOUT": "1209600",
+    "ENABLE_SSL": "FALSE",
+    "PRODUCTION": "TRUE",
+}.items():
+    os.environ.setdefault(key, value)
+sys.path.insert(0, os.path.join(ROOT, "code"))
+sys.path.insert(0, os.path.join(ROOT, "code", "RL-A"))
+
+import numpy as np
+
+BENCHMARKS = {}
+
+# registers a benchmark. the decorated function does the setup and returns the callable to measure
+def benchmark(name):
+    def register(setup):
+        BENCHMARKS[name] = setup
+        return setup
+    return register
+
+def gameInfo(gameId=1):
+    return {"attacker": "sampleUser1", "defender": "bot", "gameId": gameId, "winner": None, "gameField": [1, -1, 0, 0, 1, 0, -1, 0, 0], "isFinished": False, "isDraw": False}
+
+def gameList(games=20):
+    return {"success": True, "data": [gameInfo(gameId) for gameId in range(games, 0, -1)]}
+
+def userList(users=100):
+    return {"success": True, "data": [{"username": f"sampleUser{i}", "winCount": 100 - i, "defeatCount": i, "drawCount": i % 7} for i in range(users)]}
+
+SOLVER = []
+
+# loads the solver with the policies used by the server (only once)
+def loadSolver():
+    if not SOLVER:
+        from TTTsolver import TicTacToeSolver
+        SOLVER.append(TicTacToeSolver("presets/policy_p1", "presets/policy_p2"))
+    return SOLVER[0]
+
+# socket that uses the real WebSocket.send but throws the encoded messages away
+def fakeSocketClass():
+    import main
+    # a frame that is written immediately
+    class WrittenFuture:
+        def add_done_callback(self, callback):
+            callback(self)
+    class FakeSocket:
+        send = main.WebSocket.send
+        sendEncoded = main.WebSocket.sendEncoded
+        def __init__(self):
+            self.outbox = main.outbox.Outbox(self)
+        def write_message(self, message):
+            return WrittenFuture()
+    return FakeSocket
+
+@benchmark("TicTacToeSolver.solveState[empty]")
+def solveStateEmpty():
+    solver = loadSolver()
+    board = np.zeros((3, 3))
+    return lambda: solver.solveState(board, "attacker", False)
+
+@benchmark("TicTacToeSolver.solveState[midgame]")
+def solveStateMidgame():
+    solver = loadSolver()
+    board = np.array([[1, 0, 0], [0, -1, 0], [0, 0, 1]], dtype="float64")
+    return lambda: solver.solveState(board, "defender", False)
+
+@benchmark("TicTacToeSolver.getBoardIdentifier")
+def getBoardIdentifier():
+    solver = loadSolver()
+    board = np.array([[1, 0, 0], [0, -1, 0], [0, 0, 1]], dtype="float64")
+    return lambda: solver.getBoardIdentifier(board)
+
+@benchmark("Game.getWinnerOfBoard[ongoing]")
+def getWinnerOfBoardOngoing():
+    import main
+    board = np.array([1, -1, 0, 0, 1, 0, -1, 0, 0], dtype="float64")
+    return lambda: main.Game.getWinnerOfBoard(board)
+
+@benchmark("Game.getWinnerOfBoard[won]")
+def getWinnerOfBoardWon():
+    import main
+    board = np.array([1, 1, 1, -1, -1, 0, 0, 0, 0], dtype="float64")
+    return lambda: main.Game.getWinnerOfBoard(board)
+
+@benchmark("Game.rotate45")
+def rotate45():
+    import main
+    board = np.array([[1, -1, 0], [0, 1, 0], [-1, 0, 0]], dtype="float64")
+    return lambda: main.Game.rotate45(board)
+
+@benchmark("GameSubscriptionList.broadcastMove[100 sockets]")
+def broadcastMove():
+    import main
+    FakeSocket = fakeSocketClass()
+    subscriptions = main.GameSubscriptionList()
+    subscriptions.subscriptions = {}
+    for msgId in range(100):
+        socket = FakeSocket()
+        # half of the sockets negotiated protocol 2 and get the delta, the others get the full state
+        socket.protocolVersion = 2 if msgId % 2 else 1
+        subscriptions.add(1, msgId, socket)
+    # the game and the move as the routes have them, without the database
+    game = types.SimpleNamespace(gameId=1, attacker="sampleUser1", defender="bot", winner=None, isDraw=False, gameFinished=False)
+    game.getMoveDelta = lambda move: main.Game.getMoveDelta(game, move)
+    move = types.SimpleNamespace(gameId=1, moveIndex=5, movePosition=8, player="bot")
+    info = subscriptions.gameInfos[1] = {**gameInfo(), "seq": 5}
+
+    def run():
+        # the state before the move is known, so the full state is updated instead of loaded
+        info["seq"] = move.moveIndex
+        subscriptions.broadcastMove(game, move)
+    return run
+
+@benchmark("LobbyFeed.publish[100 subscribers]")
+def lobbyPublish():
+    import lobby
+    FakeSocket = fakeSocketClass()
+    feed = lobby.LobbyFeed()
+    for msgId in range(100):
+        # every other socket only follows the games of some players
+        feed.subscribe(FakeSocket(), msgId, ["sampleUser1"] if msgId % 2 else None)
+    return lambda: feed.publish("move", 1, {"player": "sampleUser1", "position": 4, "index": 2}, ("sampleUser1", "bot"))
+
+@benchmark("WebSocket.send[gameInfo]")
+def websocketSend():
+    socket = fakeSocketClass()()
+    data = gameInfo()
+    return lambda: socket.send("viewGame", data, 1)
+
+# the encoders of responses.py, compared with json.dumps (how the responses were encoded before)
+@benchmark("json.dumps[gameInfo]")
+def jsonDumpsGameInfo():
+    data = gameInfo()
+    return lambda: json.dumps(data)
+
+@benchmark("responses.encodeGameInfo")
+def encodeGameInfo():
+    import responses
+    data = gameInfo()
+    return lambda: responses.encodeGameInfo(data)
+
+@benchmark("json.dumps[gameList 20 games]")
+def jsonDumpsGameList():
+    data = gameList()
+    return lambda: json.dumps(data)
+
+@benchmark("responses.encodeGameList[20 games]")
+def encodeGameList():
+    import responses
+    data = gameList()
+    return lambda: responses.encodeGameList(data)
+
+@benchmark("json.dumps[userList 100 users]")
+def jsonDumpsUserList():
+    data = userList()
+    return lambda: json.dumps(data)
+
+@benchmark("responses.encodeUserList[100 users]")
+def encodeUserList():
+    import responses
+    data = userList()
+    return lambda: responses.encodeUserList(data)
+
+@benchmark("MatchmakingQueue.enqueue[10000 waiting]")
+def matchmakingEnqueue():
+    import matchmaking
+    queue = matchmaking.MatchmakingQueue()
+    for i in range(10000):
+        queue.add(matchmaking.WaitingPlayer(f"waiting{i}", object(), i))
+    socket = object()
+    # pairs a new player with the longest waiting one, which is put back so the queue keeps its size
+    def enqueue():
+        queue.add(queue.enqueue("player", socket, 1))
+    return enqueue
+
+def rankIndex(players=10000):
+    import rating
+    index = rating.RankIndex()
+    index.load((f"player{i}", 1000 + (i * 7919) % 1000, i % 50) for i in range(players))
+    return index
+
+@benchmark("RankIndex.rank[10000 players]")
+def rankIndexRank():
+    index = rankIndex()
+    return lambda: index.rank("player5000")
+
+@benchmark("RankIndex.set[10000 players]")
+def rankIndexSet():
+    index = rankIndex()
+    ratings = [1490.0, 1510.0]
+    # moves a player up and down, like a game that finished
+    def update():
+        ratings.reverse()
+        index.set("player5000", ratings[0], 1)
+    return update
+
+@benchmark("RankIndex.top[20 of 10000 players]")
+def rankIndexTop():
+    index = rankIndex()
+    return lambda: index.top(20)
+
+@benchmark("positions.canonical")
+def positionsCanonical():
+    import positions
+    board = [1, 0, 0, 0, -1, 0, 0, 0, 1]
+    return lambda: positions.canonical(board)
+
+@benchmark("positions.gamePositions[9 moves]")
+def positionsGamePositions():
+    import positions
+    moves = [(4, 1), (0, -1), (8, 1), (2, -1), (1, 1), (7, -1), (6, 1), (3, -1), (5, 1)]
+    return lambda: positions.gamePositions(moves)
+
+@benchmark("mail.sendMail[gamefinished]")
+def sendMail():
+    import mail
+    # smtp connection that accepts everything
+    class FakeSMTP:
+        def __init__(self, *args):
+            pass
+        def __enter__(self):
+            return self
+        def __exit__(self, *args):
+            pass
+        def sendmail(self, *args):
+            pass
+    mail.smtplib.SMTP = FakeSMTP
+    content = {"attacker": "sampleUser1", "defender": "bot", "gameField": ["x", "o", "◻", "◻", "x", "◻", "o", "◻", "x"], "winner": "sampleUser1", "isDraw": False, "domain": "localhost", "username": "sampleUser1", "gameId": "000001", "stateText": "won"}
+    return lambda: mail.sendMail("sampleUser1@localhost", "Your game", mail.EMAIL_TEMPLATES["gamefinished"], content)
+
+# runs a benchmark: calibrates the number of loops so one run takes about minTime, then measures several runs.
+# returns the mean, standard deviation and minimum time per call in microseconds
+def run(function, runs, minTime):
+    loops = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(loops):
+            function()
+        elapsed = time.perf_counter() - start
+        if elapsed >= minTime:
+            break
+        loops *= 2 if elapsed == 0 else max(2, min(10, int(minTime / elapsed) + 1))
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        for _ in range(loops):
+            function()
+        timings.append((time.perf_counter() - start) / loops * 1e6)
+    return {"mean": statistics.mean(timings), "stdev": statistics.stdev(timings) if runs > 1 else 0.0, "min": min(timings), "loops": loops}
+
+def gitRevision():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=ROOT, capture_output=True, text=True).stdout.strip()
+    except Exception:
+        return None
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="microbenchmarks of the servers hot paths")
+    parser.add_argument("names", nargs="*", help="only run benchmarks containing one of these names")
+    parser.add_argument("--runs", type=int, default=10, help="number of measured runs per benchmark")
+    parser.add_argument("--min-time", type=float, default=0.1, help="minimal duration of a single run in seconds")
+    parser.add_argument("--baseline", default=BASELINE, help="baseline to compare with")
+    parser.add_argument("--save-baseline", action="store_true", help="store the results as the new baseline")
+    parser.add_argument("--output", help="also write the results to this file")
+    parser.add_argument("--threshold", type=float, default=10, help="slowdown in percent that counts as regression")
+    parser.add_argument("--json-backend", choices=["auto", "json"], default="auto", help="json: measure without orjson even if it is installed")
+    args = parser.parse_args()
+    if args.json_backend == "json":
+        # makes the import of orjson in responses.py fail
+        sys.modules["orjson"] = None
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)["benchmarks"]
+
+    results = {}
+    regressions = []
+    for name, setup in BENCHMARKS.items():
+        if args.names and not any(selected in name for selected in args.names):
+            continue
+        result = run(setup(), args.runs, args.min_time)
+        results[name] = result
+        line = f"{name:<45} {result['mean']:>10.2f} us +- {result['stdev']:.2f}"
+        if name in baseline:
+            change = (result["mean"] - baseline[name]["mean"]) / baseline[name]["mean"] * 100
+            line += f"   ({change:+.1f}% vs. baseline)"
+            if change > args.threshold:
+                regressions.append(name)
+        print(line)
+
+    import responses
+    report = {"meta": {"revision": gitRevision(), "python": platform.python_version(), "machine": platform.machine(), "numpy": np.__version__, "json": responses.BACKEND}, "benchmarks": results}
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    if args.save_baseline:
+        # keep the numbers of benchmarks that were not run
+        report["benchmarks"] = {**baseline, **results}
+        with open(args.baseline, "w") as f:
+            json.dump(report, f, indent=2)
+        print("baseline written to", args.baseline)
+    elif regressions:
+        print("slower than baseline:", ", ".join(regressions))
+        sys.exit(1)
@@ -0,0 +1,171 @@
+# plays engines built on TicTacToeSolver against each other, without the server or the database.
+#
+# the policy of an engine is looked up once for every position that can occur (as the server does with
+# solveState) and stored in a table indexed by the base-3 code of the board. the games are then played in
+# batches with numpy (one array operation per ply for the whole batch) across a pool of processes.
+#
+# example:
+#   python tournament.py --games 1000000
+#   python tournament.py --engine presets=presets/policy_p1,presets/policy_p2 --engine random --opening-plies 2
+import argparse, json, os, sys, time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from TTTsolver import TicTacToeSolver
+
+# value of each field in the base-3 code of a board (empty=0, attacker=1, defender=2)
+POWERS = 3 ** np.arange(9)
+# all boards with 3^9 codes
+CODES = 3 ** 9
+# rows, columns and diagonals as indices of the flat board
+LINES = np.array([[0, 1, 2], [3, 4, 5], [6, 7, 8], [0, 3, 6], [1, 4, 7], [2, 5, 8], [0, 4, 8], [2, 4, 6]])
+# results from the view of the attacker
+WIN, DRAW, LOSS = 0, 1, 2
+
+# returns the board (values 1, -1 and 0) of a base-3 code
+def decode(code):
+    digits = (code // POWERS) % 3
+    return np.where(digits == 2, -1, digits)
+
+def encode(boards):
+    return (boards % 3) @ POWERS
+
+# returns 1 or -1 if a player won the board, 0 otherwise
+def winnerOf(board):
+    sums = board[LINES].sum(axis=1)
+    return 1 if 3 in sums else -1 if -3 in sums else 0
+
+# looks up the moves of a solver for every position in which the role is to move,
+# returns a table of the field to play per code (-1 for positions that can't occur)
+def policyTable(solver, role):
+    player = 1 if role == "attacker" else -1
+    table = np.full(CODES, -1, dtype=np.int8)
+    for code in range(CODES):
+        board = decode(code)
+        attackers, defenders = np.count_nonzero(board == 1), np.count_nonzero(board == -1)
+        toMove = 1 if attackers == defenders else -1 if attackers == defenders + 1 else 0
+        if toMove != player or winnerOf(board) or 0 not in board:
+            continue
+        y, x = solver.solveState(board.reshape((3, 3)).astype("float64"), role, False)
+        table[code] = y * 3 + x
+    return table
+
+# an engine is given as "name=attackerPolicy,defenderPolicy" (paths relative to RL-A) or "random"
+def parseEngine(spec):
+    name, _, files = spec.partition("=")
+    if name == "random" and not files:
+        return name, None
+    attackerFile, defenderFile = (files or name).split(",")
+    return name, (attackerFile, defenderFile)
+
+# builds the tables of all engines: name => (attacker table, defender table), None for random engines
+def loadEngines(specs):
+    engines = {}
+    for spec in specs:
+        name, files = parseEngine(spec)
+        if files is None:
+            engines[name] = None
+            continue
+        start = time.perf_counter()
+        solver = TicTacToeSolver(*files)
+        engines[name] = (policyTable(solver, "attacker"), policyTable(solver, "defender"))
+        print(f"built policy table of {name} in {time.perf_counter() - start:.1f}s", file=sys.stderr)
+    return engines
+
+# tables of the engines in a worker process, set by the initializer of the pool
+ENGINES = {}
+
+def initWorker(engines):
+    ENGINES.update(engines)
+
+# picks a random empty field for every board
+def randomMoves(boards, rng):
+    scores = rng.random(boards.shape)
+    scores[boards != 0] = -1
+    return scores.argmax(axis=1)
+
+# plays a batch of games, returns the number of [wins, draws, losses] of the attacker
+def playBatch(attacker, defender, games, openingPlies, seed):
+    rng = np.random.default_rng(seed)
+    boards = np.zeros((games, 9), dtype=np.int8)
+    # 1 or -1 once a player won, 0 while the game is running or if it is a draw
+    winners = np.zeros(games, dtype=np.int8)
+    running = np.ones(games, dtype=bool)
+    for ply in range(9):
+        player = 1 if ply % 2 == 0 else -1
+        table = ENGINES[attacker if player == 1 else defender]
+        active = np.flatnonzero(running)
+        if active.size == 0:
+            break
+        if table is None or ply < openingPlies:
+            moves = randomMoves(boards[active], rng)
+        else:
+            moves = table[0 if player == 1 else 1][encode(boards[active])]
+            # positions the policy doesn't know are played randomly
+            unknown = moves < 0
+            if unknown.any():
+                moves[unknown] = randomMoves(boards[active[unknown]], rng)
+        boards[active, moves] = player
+        # only the player that moved can have won
+        won = (boards[active][:, LINES].sum(axis=2) == 3 * player).any(axis=1)
+        winners[active[won]] = player
+        running[active[won]] = False
+    return [int((winners == 1).sum()), int((winners == 0).sum()), int((winners == -1).sum())]
+
+def main(args):
+    engines = loadEngines(args.engine)
+    names = list(engines)
+    # the batches of every pairing (attacker, defender)
+    tasks = []
+    for attacker in names:
+        for defender in names:
+            for batch, start in enumerate(range(0, args.games, args.batch_size)):
+                tasks.append((attacker, defender, min(args.batch_size, args.games - start), args.opening_plies, (args.seed, names.index(attacker), names.index(defender), batch)))
+    results = {attacker: {defender: [0, 0, 0] for defender in names} for attacker in names}
+    start = time.perf_counter()
+    with ProcessPoolExecutor(args.workers, initializer=initWorker, initargs=(engines,)) as pool:
+        futures = [(task[0], task[1], pool.submit(playBatch, *task)) for task in tasks]
+        for attacker, defender, future in futures:
+            counts = future.result()
+            results[attacker][defender] = [total + count for total, count in zip(results[attacker][defender], counts)]
+    duration = time.perf_counter() - start
+    games = args.games * len(names) ** 2
+    return {
+        "engines": {name: list(parseEngine(spec)[1] or ["random"]) for name, spec in zip(names, args.engine)},
+        "gamesPerPairing": args.games,
+        "openingPlies": args.opening_plies,
+        "seconds": duration,
+        "gamesPerSecond": games / duration,
+        # attacker => defender => [wins, draws, losses] of the attacker
+        "results": results,
+    }
+
+# prints the matrix: one row per attacker, one column per defender, W/D/L in percent of the attacker
+def printMatrix(report):
+    names = list(report["results"])
+    games = report["gamesPerPairing"]
+    width = max(17, *(len(name) + 2 for name in names))
+    print("attacker \\ defender".ljust(width) + "".join(name.rjust(width) for name in names))
+    for attacker in names:
+        cells = ["/".join(f"{count / games * 100:.0f}" for count in report["results"][attacker][defender]) for defender in names]
+        print(attacker.ljust(width) + "".join(cell.rjust(width) for cell in cells))
+    print(f"W/D/L of the attacker in %, {games} games per pairing, {report['gamesPerSecond']:,.0f} games/s")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="plays engines built on TicTacToeSolver against each other")
+    parser.add_argument("--engine", action="append", help="name=attackerPolicy,defenderPolicy or random (can be given multiple times, default: the presets and random)")
+    parser.add_argument("--games", type=int, default=100000, help="games per pairing of attacker and defender")
+    parser.add_argument("--batch-size", type=int, default=50000, help="games played at once by a worker")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="number of processes")
+    parser.add_argument("--opening-plies", type=int, default=2, help="number of random moves at the start of each game, so the games differ")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the random openings")
+    parser.add_argument("--output", help="also write the report as json to this file")
+    args = parser.parse_args()
+    args.engine = args.engine or ["presets=presets/policy_p1,presets/policy_p2", "random"]
+
+    report = main(args)
+    printMatrix(report)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
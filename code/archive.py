@@ -0,0 +1,128 @@
+# moves finished games that are older than some days from games/moves into archived_games:
+# one row per game, the fields of the moves are packed into one number (4 bits per move, position + 1,
+# the first move in the lowest bits), the timestamps of the single moves are dropped.
+# the job reports the size of the tables and the latency of the hot queries before and after.
+import time, statistics
+from datetime import datetime, timedelta
+
+from metrics import registry
+
+ARCHIVED_GAMES = registry.counter("archived_games_total", "Games moved to the archive")
+
+# packs the fields of the moves (in the order they were played) into a number
+def packMoves(positions):
+    packed = 0
+    for index, position in enumerate(positions):
+        packed |= (position + 1) << (4 * index)
+    return packed
+
+# returns the fields of the moves of a packed number
+def unpackMoves(packed):
+    positions = []
+    while packed:
+        positions.append((packed & 0xF) - 1)
+        packed >>= 4
+    return positions
+
+# a move of an archived game, has the attributes of Move that are used to build the game field
+class ArchivedMove:
+    def __init__(self, gameId, moveIndex, movePosition, player, timestamp=None):
+        self.gameId = gameId
+        self.moveIndex = moveIndex
+        self.movePosition = movePosition
+        self.player = player
+        self.timestamp = timestamp
+
+# the moves of an archived game, the players take turns starting with the attacker
+def archivedMoves(gameId, packed, attacker, defender, finishedAt=None):
+    positions = unpackMoves(packed)
+    return [ArchivedMove(gameId, index, position, attacker if index % 2 == 0 else defender, finishedAt if index == len(positions) - 1 else None) for index, position in enumerate(positions)]
+
+class Archiver:
+    # db: flask_sqlalchemy instance, Game/Move/ArchivedGame: the models, queries: name => function that runs a
+    # query whose latency is reported
+    def __init__(self, db, Game, Move, ArchivedGame, queries={}, log=None):
+        self.db = db
+        self.Game = Game
+        self.Move = Move
+        self.ArchivedGame = ArchivedGame
+        self.queries = queries
+        self.log = log
+
+    # total size (with indexes and toast) of the tables in bytes, only known for postgres
+    def tableSizes(self):
+        if self.db.engine.dialect.name != "postgresql":
+            return None
+        tables = [self.Game.__tablename__, self.Move.__tablename__, self.ArchivedGame.__tablename__]
+        return {table: self.db.session.execute(self.db.text("SELECT pg_total_relation_size(:table)"), {"table": table}).scalar() for table in tables}
+
+    # median latency of every query in ms
+    def latencies(self, runs=7):
+        results = {}
+        for name, query in self.queries.items():
+            durations = []
+            for _ in range(runs):
+                start = time.perf_counter()
+                query()
+                durations.append((time.perf_counter() - start) * 1000)
+            results[name] = statistics.median(durations)
+        self.db.session.rollback()
+        return results
+
+    # archives finished games that started more than days ago, batchSize games per transaction
+    def archive(self, days, batchSize=500):
+        Game, Move, ArchivedGame, session = self.Game, self.Move, self.ArchivedGame, self.db.session
+        before = datetime.now() - timedelta(days=days)
+        archived = 0
+        while True:
+            games = session.query(Game).filter(Game.gameFinished == True, Game.timestamp < before).order_by(Game.gameId).limit(batchSize).all()
+            if not games:
+                break
+            gameIds = [game.gameId for game in games]
+            moves = {}
+            for move in session.query(Move).filter(Move.gameId.in_(gameIds)).order_by(Move.gameId, Move.moveIndex):
+                moves.setdefault(move.gameId, []).append(move)
+            for game in games:
+                gameMoves = moves.get(game.gameId, [])
+                session.add(ArchivedGame(
+                    gameId=game.gameId, attacker=game.attacker, defender=game.defender, winner=game.winner, isDraw=game.isDraw,
+                    moves=packMoves([move.movePosition for move in gameMoves]), timestamp=game.timestamp,
+                    finishedAt=gameMoves[-1].timestamp if gameMoves else game.timestamp,
+                ))
+            # the archived rows have to exist before the games are gone, so readers always find the game
+            session.flush()
+            session.query(Move).filter(Move.gameId.in_(gameIds)).delete(synchronize_session=False)
+            session.query(Game).filter(Game.gameId.in_(gameIds)).delete(synchronize_session=False)
+            session.commit()
+            archived += len(games)
+            ARCHIVED_GAMES.inc(len(games))
+            if self.log:
+                self.log.info("archived games", games=len(games), lastGameId=gameIds[-1])
+        return archived
+
+    # postgres only frees the space of deleted rows for reuse after a vacuum, and only gives it back to the
+    # operating system after a VACUUM FULL (which locks the tables)
+    def vacuum(self, full=False):
+        if self.db.engine.dialect.name != "postgresql":
+            return
+        with self.db.engine.connect().execution_options(isolation_level="AUTOCOMMIT") as connection:
+            for table in [self.Game.__tablename__, self.Move.__tablename__, self.ArchivedGame.__tablename__]:
+                connection.execute(self.db.text(f"VACUUM {'FULL ' if full else ''}ANALYZE {table}"))
+
+    # archives the games and returns a report with the sizes and latencies before and after
+    def run(self, days, batchSize=500, vacuum=True, vacuumFull=False):
+        report = {"days": days, "startedAt": datetime.now().isoformat()}
+        report["sizesBefore"] = self.tableSizes()
+        report["latencyBefore"] = self.latencies()
+        start = time.perf_counter()
+        report["archivedGames"] = self.archive(days, batchSize)
+        report["seconds"] = time.perf_counter() - start
+        if vacuum or vacuumFull:
+            self.vacuum(vacuumFull)
+        report["sizesAfter"] = self.tableSizes()
+        report["latencyAfter"] = self.latencies()
+        if report["sizesBefore"] and report["sizesAfter"]:
+            report["bytesReclaimed"] = sum(report["sizesBefore"].values()) - sum(report["sizesAfter"].values())
+        if self.log:
+            self.log.info("archive finished", archived=report["archivedGames"], bytesReclaimed=report.get("bytesReclaimed"), latencyBefore=report["latencyBefore"], latencyAfter=report["latencyAfter"])
+        return report
@@ -0,0 +1,160 @@
+# streams the history of all games (players, result, moves and timestamps) as NDJSON or CSV.
+# the handler is not part of flask, because the WSGIContainer would buffer the whole response: the rows are
+# fetched in batches from a server-side cursor (in a thread) and every batch is flushed to the client before
+# the next one is fetched, so the memory stays the same no matter how many games there are.
+# a download can be resumed with ?after=<gameId of the last received game>. archived games are exported with
+# the others, but only the timestamp of their last move is known.
+import os, io, csv
+from concurrent.futures import ThreadPoolExecutor
+
+from sqlalchemy import select, union_all, literal, null, true
+
+from archive import unpackMoves
+from responses import dumps, CONTENT_TYPE
+from tornado.ioloop import IOLoop
+from tornado.iostream import StreamClosedError
+from tornado.web import RequestHandler
+
+from metrics import registry
+
+# rows (moves) fetched from the cursor at once
+BATCH_SIZE = int(os.environ.get("EXPORT_BATCH_SIZE", 2000))
+
+# all exports share one thread: every call of a connection is made from the same thread (sqlite doesn't allow
+# anything else), and it is only busy while a batch is fetched, not while it is sent
+EXECUTOR = ThreadPoolExecutor(1, thread_name_prefix="export")
+
+EXPORTED_GAMES = registry.counter("export_games_total", "Games written by the export", ["format"])
+
+CSV_COLUMNS = ["gameId", "attacker", "defender", "winner", "isDraw", "isFinished", "startedAt", "lastMoveAt", "moves"]
+
+# one row per move (or per game without moves) of the games, and one row per archived game (with the packed
+# moves), ordered by game and move
+def exportQuery(games, moves, archived, after, limit=None):
+    hot = select(
+        games.c.gameid, games.c.attacker, games.c.defender, games.c.winner, games.c.isDraw, games.c.gameFinished, games.c.timestamp,
+        moves.c.moveposition, moves.c.player, moves.c.timestamp.label("movetimestamp"), moves.c.moveindex, null().label("packed"),
+    ).select_from(games.outerjoin(moves, moves.c.gameid == games.c.gameid)).where(games.c.gameid > after)
+    cold = select(
+        archived.c.gameid, archived.c.attacker, archived.c.defender, archived.c.winner, archived.c.isDraw, true(), archived.c.timestamp,
+        null(), null(), archived.c.finishedat, literal(0), archived.c.moves,
+    ).where(archived.c.gameid > after)
+    if limit:
+        # limit the games, not the moves
+        gameIds = union_all(select(games.c.gameid).where(games.c.gameid > after), select(archived.c.gameid).where(archived.c.gameid > after)).subquery()
+        limited = select(gameIds.c.gameid).order_by(gameIds.c.gameid).limit(limit)
+        hot = hot.where(games.c.gameid.in_(limited))
+        cold = cold.where(archived.c.gameid.in_(limited))
+    rows = union_all(hot, cold).subquery()
+    return select(rows).order_by(rows.c.gameid, rows.c.moveindex)
+
+def toIso(timestamp):
+    return timestamp.isoformat() if timestamp else None
+
+# combines the rows of a game to one record
+def gameRecord(rows):
+    gameId, attacker, defender, winner, isDraw, isFinished, startedAt = rows[0][:7]
+    packed = rows[0][11]
+    if packed is not None:
+        # archived games only know when the last move was made
+        positions = unpackMoves(packed)
+        moves = [(None,) * 7 + (position, attacker if index % 2 == 0 else defender, rows[0][9] if index == len(positions) - 1 else None) for index, position in enumerate(positions)]
+    else:
+        moves = [row for row in rows if row[7] is not None]
+    return {
+        "gameId": gameId,
+        "attacker": attacker,
+        "defender": defender,
+        "winner": winner,
+        "isDraw": bool(isDraw),
+        "isFinished": bool(isFinished),
+        "startedAt": toIso(startedAt),
+        # fields of the moves in the order they were played (attacker first)
+        "moves": [row[7] for row in moves],
+        "movePlayers": [row[8] for row in moves],
+        "moveTimestamps": [toIso(row[9]) for row in moves],
+    }
+
+def ndjsonLine(record):
+    return dumps(record) + "\n"
+
+def csvLine(record):
+    output = io.StringIO()
+    row = dict(record, lastMoveAt=record["moveTimestamps"][-1] if record["moveTimestamps"] else None, moves="".join(str(position) for position in record["moves"]))
+    csv.writer(output).writerow([row[column] for column in CSV_COLUMNS])
+    return output.getvalue()
+
+class ExportHandler(RequestHandler):
+    FORMATS = {"ndjson": ("application/x-ndjson", ndjsonLine), "csv": ("text/csv; charset=utf-8", csvLine)}
+
+    # engine: the sqlalchemy engine, games/moves/archived: the tables, isAllowed: function(request) => bool
+    def initialize(self, engine, games, moves, archived, isAllowed):
+        self.engine = engine
+        self.games = games
+        self.moves = moves
+        self.archived = archived
+        self.isAllowed = isAllowed
+        self.closed = False
+
+    def on_connection_close(self):
+        self.closed = True
+
+    async def get(self):
+        # errors are answered with json, the format sets its own content type
+        self.set_header("Content-Type", CONTENT_TYPE)
+        try:
+            allowed = self.isAllowed(self.request)
+        except Exception:
+            allowed = False
+        if not allowed:
+            self.set_status(403)
+            return self.finish(dumps({"success": False}))
+        format = self.get_argument("format", "ndjson")
+        if format not in self.FORMATS:
+            self.set_status(400)
+            return self.finish(dumps({"success": False, "error": "unknown format"}))
+        try:
+            after = int(self.get_argument("after", 0))
+            limit = int(self.get_argument("limit", 0))
+        except ValueError:
+            self.set_status(400)
+            return self.finish(dumps({"success": False, "error": "after and limit have to be numbers"}))
+        contentType, formatRecord = self.FORMATS[format]
+        self.set_header("Content-Type", contentType)
+        self.set_header("Content-Disposition", f'attachment; filename="games-after-{after}.{format}"')
+        self.set_header("Cache-Control", "no-store")
+        if format == "csv":
+            self.write(",".join(CSV_COLUMNS) + "\r\n")
+
+        ioloop = IOLoop.current()
+        connection = await ioloop.run_in_executor(EXECUTOR, self.engine.connect)
+        try:
+            # stream_results makes postgres use a server-side cursor, only BATCH_SIZE rows are held at once
+            result = await ioloop.run_in_executor(EXECUTOR, lambda: connection.execution_options(stream_results=True).execute(exportQuery(self.games, self.moves, self.archived, after, limit)))
+            # rows of the game that is not complete yet (its moves may continue in the next batch)
+            current = []
+            exported = 0
+            while not self.closed:
+                rows = await ioloop.run_in_executor(EXECUTOR, result.fetchmany, BATCH_SIZE)
+                lines = []
+                for row in rows:
+                    if current and current[0][0] != row[0]:
+                        lines.append(formatRecord(gameRecord(current)))
+                        current = []
+                    current.append(row)
+                if not rows and current:
+                    lines.append(formatRecord(gameRecord(current)))
+                if lines:
+                    exported += len(lines)
+                    self.write("".join(lines))
+                    # wait until the batch is sent, slow clients slow down the export instead of filling the memory
+                    await self.flush()
+                if not rows:
+                    break
+            EXPORTED_GAMES.inc(exported, format=format)
+        except StreamClosedError:
+            pass
+        finally:
+            await ioloop.run_in_executor(EXECUTOR, connection.close)
+        if not self.closed:
+            self.finish()
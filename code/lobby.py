@@ -0,0 +1,111 @@
+# a feed of the events of all games for the lobby and spectators: one subscribeLobby instead of a subscribeGame per
+# game. the events are "created" (with started), "started" (a second player joined), "move" and "finished".
+# - the events of a session are collected by the mapper events and published after its commit, a rollback drops them
+# - every event gets a seq and is encoded once, the subscribers only differ in the msgId that is spliced in
+# - a subscriber can filter the events by the players of the game and by their type
+# - the last LOBBY_REPLAY events are kept: a client that reconnects passes the epoch and the seq of the last event it
+#   got (since) and gets the ones it missed. if they are not kept anymore or the server restarted (another epoch), it
+#   gets "reset" and should load /games again
+# the events are published on the IOLoop (the games and moves are only written there)
+import secrets
+from collections import deque, OrderedDict
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session as OrmSession
+
+import responses
+from metrics import registry
+
+TYPES = ["created", "started", "move", "finished"]
+LOBBY_EVENTS = registry.counter("lobby_events_total", "Events published to the lobby feed", ["type"])
+LOBBY_MESSAGES = registry.counter("lobby_messages_total", "Events sent to subscribers of the lobby feed")
+
+# what a socket wants to get from the feed
+class LobbySubscription:
+    __slots__ = ("socket", "msgId", "players", "types")
+
+    def __init__(self, socket, msgId, players=None, types=None):
+        self.socket = socket
+        self.msgId = msgId
+        # None for all
+        self.players = frozenset(players) if players else None
+        self.types = frozenset(types) if types else None
+
+    def matches(self, type, players):
+        return (self.types is None or type in self.types) and (self.players is None or not self.players.isdisjoint(players))
+
+class LobbyFeed:
+    def __init__(self, replaySize=1000, maxGames=10000):
+        # a new epoch for every start of the server, the seqs start at 0 again
+        self.epoch = secrets.token_hex(4)
+        self.seq = 0
+        # the last events: (seq, type, players, encoded)
+        self.replay = deque(maxlen=replaySize)
+        # socket => LobbySubscription
+        self.subscribers = {}
+        # gameId => (attacker, defender) of the recent games, the moves don't know their players
+        self.games = OrderedDict()
+        self.maxGames = maxGames
+        self.sessionKey = f"lobby{id(self)}"
+        event.listen(OrmSession, "after_commit", self.afterCommit)
+        event.listen(OrmSession, "after_soft_rollback", self.afterRollback)
+        registry.gauge("lobby_subscribers", "Sockets subscribed to the lobby feed", function=lambda: len(self.subscribers))
+
+    # collects an event of the session (use in mapper events). players are the (attacker, defender) of the game or
+    # a function that loads them if they are not known
+    def record(self, session, type, gameId, data, players):
+        if not self.subscribers and not self.replay.maxlen:
+            return
+        if callable(players):
+            players = self.games.get(gameId) or tuple(players())
+        self.games[gameId] = players
+        self.games.move_to_end(gameId)
+        while len(self.games) > self.maxGames:
+            self.games.popitem(last=False)
+        session.info.setdefault(self.sessionKey, []).append((type, gameId, data, players))
+
+    def afterCommit(self, session):
+        for type, gameId, data, players in session.info.pop(self.sessionKey, ()):
+            self.publish(type, gameId, data, players)
+
+    def afterRollback(self, session, previousTransaction):
+        session.info.pop(self.sessionKey, None)
+
+    # encodes the event once and sends it to every subscriber that wants it
+    def publish(self, type, gameId, data, players):
+        self.seq += 1
+        encoded = responses.dumps({"seq": self.seq, "type": type, "gameId": gameId, **data})
+        players = frozenset(player for player in players if player)
+        self.replay.append((self.seq, type, players, encoded))
+        if type == "finished":
+            self.games.pop(gameId, None)
+        LOBBY_EVENTS.inc(type=type)
+        for subscription in list(self.subscribers.values()):
+            if subscription.matches(type, players):
+                try:
+                    subscription.socket.sendEncoded("lobby", encoded, subscription.msgId)
+                    LOBBY_MESSAGES.inc()
+                except:
+                    # socket is probably closed, the reaper removes it
+                    pass
+
+    # subscribes the socket (again, with the new filters). returns the state of the feed and the events the socket
+    # missed since the seq it got last (if it passed one of this epoch)
+    def subscribe(self, socket, msgId, players=None, types=None, epoch=None, since=None):
+        subscription = self.subscribers[socket] = LobbySubscription(socket, msgId, players, types)
+        missed = []
+        reset = False
+        if since is not None:
+            # the events after since have to be in the buffer, else some were dropped
+            oldest = self.replay[0][0] if self.replay else self.seq + 1
+            if epoch != self.epoch or since > self.seq or since + 1 < oldest:
+                reset = True
+            else:
+                missed = [encoded for seq, type, players, encoded in self.replay if seq > since and subscription.matches(type, players)]
+        return {"epoch": self.epoch, "seq": self.seq, "reset": reset, "replayed": len(missed)}, missed
+
+    def remove(self, socket):
+        return self.subscribers.pop(socket, None) is not None
+
+    def __contains__(self, socket):
+        return socket in self.subscribers
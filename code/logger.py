@@ -0,0 +1,92 @@
+# structured logging: every record is an event name with fields. nothing is formatted unless the level of
+# the record is enabled, so debug logging in hot paths costs (almost) nothing in production.
+import os, json, logging
+from datetime import datetime
+
+# in production mode only INFO and above is logged by default
+PRODUCTION = os.environ.get("PRODUCTION", "FALSE").upper() == "TRUE"
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO" if PRODUCTION else "DEBUG").upper()
+# "text" (event key=value ...) or "json" (one object per line)
+LOG_FORMAT = os.environ.get("LOG_FORMAT", "text").lower()
+# share of high-volume events that is logged (1 = all, 0.01 = every 100th)
+LOG_SAMPLE_RATE = float(os.environ.get("LOG_SAMPLE_RATE", "0.01" if PRODUCTION else "1"))
+
+# wraps a function whose result is only computed when the record is formatted
+class lazy:
+    def __init__(self, function):
+        self.function = function
+
+    def __str__(self):
+        return str(self.function())
+
+    def __repr__(self):
+        return repr(self.function())
+
+# formats records as "event key=value ..." or as json
+class StructuredFormatter(logging.Formatter):
+    def __init__(self, format=LOG_FORMAT):
+        super().__init__()
+        self.format_ = format
+
+    def format(self, record):
+        fields = getattr(record, "fields", {})
+        if self.format_ == "json":
+            entry = {"time": datetime.fromtimestamp(record.created).isoformat(), "level": record.levelname, "logger": record.name, "event": record.getMessage()}
+            entry.update({key: value if isinstance(value, (int, float, bool, type(None))) else str(value) for key, value in fields.items()})
+            if record.exc_info:
+                entry["exception"] = self.formatException(record.exc_info)
+            return json.dumps(entry)
+        line = f"[{datetime.fromtimestamp(record.created).isoformat(sep=' ', timespec='milliseconds')}] {record.levelname} in {record.module}: {record.getMessage()}"
+        if fields:
+            line += " " + " ".join(f"{key}={value}" for key, value in fields.items())
+        if record.exc_info:
+            line += "\n" + self.formatException(record.exc_info)
+        return line
+
+# wrapper around a logging.Logger that takes an event and its fields instead of a formatted message
+class StructuredLogger:
+    def __init__(self, logger, sampleRate=LOG_SAMPLE_RATE):
+        self.logger = logger
+        self.sampleEvery = max(1, round(1 / sampleRate)) if sampleRate > 0 else 0
+        # number of calls per sampled event
+        self.sampleCounts = {}
+
+    # stacklevel points to the caller of debug(), info(), ... so the record shows the right module
+    def log(self, level, event, exc_info=None, stacklevel=3, **fields):
+        if self.logger.isEnabledFor(level):
+            self.logger.log(level, event, exc_info=exc_info, extra={"fields": fields}, stacklevel=stacklevel)
+
+    def debug(self, event, **fields):
+        self.log(logging.DEBUG, event, **fields)
+
+    def info(self, event, **fields):
+        self.log(logging.INFO, event, **fields)
+
+    def warning(self, event, **fields):
+        self.log(logging.WARNING, event, **fields)
+
+    def error(self, event, **fields):
+        self.log(logging.ERROR, event, **fields)
+
+    def exception(self, event, **fields):
+        self.log(logging.ERROR, event, exc_info=True, **fields)
+
+    # logs only every n-th call of a high-volume event (see LOG_SAMPLE_RATE)
+    def sampled(self, level, event, **fields):
+        if not self.sampleEvery or not self.logger.isEnabledFor(level):
+            return
+        count = self.sampleCounts.get(event, 0)
+        self.sampleCounts[event] = count + 1
+        if count % self.sampleEvery == 0:
+            if self.sampleEvery > 1:
+                fields["sampled"] = f"1/{self.sampleEvery}"
+            self.logger.log(level, event, extra={"fields": fields}, stacklevel=2)
+
+# sets the level and the formatter of a logger (and its handlers)
+def configure(logger, level=LOG_LEVEL):
+    logger.setLevel(level)
+    if not logger.handlers:
+        logger.addHandler(logging.StreamHandler())
+    for handler in logger.handlers:
+        handler.setFormatter(StructuredFormatter())
+    return StructuredLogger(logger)
@@ -1,40 +1,200 @@
-import smtplib, os
+import smtplib, os, functools, threading, time
+from collections import OrderedDict
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 
-smtp_server = "smtp"
+from metrics import registry
+
+MAIL_DURATION = registry.histogram("mail_send_duration_seconds", "Duration of formatting and sending an email", ["template"])
+MAIL_FAILURES = registry.counter("mail_failures_total", "Emails that could not be sent", ["template"])
+SMTP_CONNECTIONS = registry.counter("smtp_connections_total", "Connections opened to the smtp server")
+DIGEST_GAMES = registry.counter("mail_digest_games_total", "Finished games collected for the digests")
+
+smtp_server = os.environ.get("SMTP_HOST", "smtp")
 port = os.environ["SMTP_PORT"]
 sender = f"no-reply@{os.environ['DOMAIN']}"
 
-def sendMail(reciever, subject, template, templateContent):
+def buildMessage(reciever, subject, template, templateContent):
     message = MIMEMultipart("alternative")
     message["Subject"]=subject
     message["From"]=sender
     message["To"]=reciever
     message.attach(MIMEText(template.txtContent.format(**templateContent), "plain", "UTF-8"))
-    message.attach(MIMEText(template.htmlContent.format(**templateContent, **{"style":EMAIL_STYLE}), "html", "UTF-8"))
+    message.attach(MIMEText(template.htmlContent.format(**templateContent, **{"style":emailStyle()}), "html", "UTF-8"))
+    return message
 
-    with smtplib.SMTP(smtp_server, port) as server:
-        server.sendmail(sender, reciever, message.as_string())
+def connect():
+    SMTP_CONNECTIONS.inc()
+    return smtplib.SMTP(smtp_server, port)
+
+def sendMail(reciever, subject, template, templateContent):
+    with MAIL_DURATION.time(template=template.name):
+        try:
+            message = buildMessage(reciever, subject, template, templateContent)
+            with connect() as server:
+                server.sendmail(sender, reciever, message.as_string())
+        except Exception:
+            MAIL_FAILURES.inc(template=template.name)
+            raise
     return
 
+# the files of a template are read when it is first used (or by load(), see the warmup in main.py)
 class EMailTemplate:
-    template_prefix = "/code/email_templates/"
+    template_prefix = os.path.join(os.path.dirname(os.path.abspath(__file__)), "email_templates", "")
 
     def __init__(self, name):
+        self.name = name
+        self.contents = None
 
-        with open(f"{self.template_prefix}{name}.html", "r") as f:
-            self.htmlContent = f.read()
+    def load(self):
+        if self.contents is None:
+            with open(f"{self.template_prefix}{self.name}.html", "r") as f:
+                htmlContent = f.read()
+            with open(f"{self.template_prefix}{self.name}.txt", "r") as f:
+                txtContent = f.read()
+            self.contents = (htmlContent, txtContent)
+        return self.contents
 
-        with open(f"{self.template_prefix}{name}.txt", "r") as f:
-            self.txtContent = f.read()
+    @property
+    def htmlContent(self):
+        return self.load()[0]
+
+    @property
+    def txtContent(self):
+        return self.load()[1]
 
 
 EMAIL_TEMPLATES = {
     "signupconfirmation": EMailTemplate("signupconfirmation"),
     "gamefinished": EMailTemplate("gamefinished"),
     "joinedcompetition": EMailTemplate("joinedcompetition"),
+    "gamedigest": EMailTemplate("gamedigest"),
+    # a row of the list in gamedigest
+    "gamedigestgame": EMailTemplate("gamedigestgame"),
 }
 
-with open("/code/email_templates/email_style.css", "r") as f:
-    EMAIL_STYLE = f"<style>{f.read()}</style>"
\ No newline at end of file
+@functools.lru_cache(maxsize=1)
+def emailStyle():
+    with open(f"{EMailTemplate.template_prefix}email_style.css", "r") as f:
+        return f"<style>{f.read()}</style>"
+
+# reads all templates, so the first mails don't have to
+def loadTemplates():
+    for template in EMAIL_TEMPLATES.values():
+        template.load()
+    emailStyle()
+
+# the games a reciever finished since the first one was collected
+class PendingDigest:
+    def __init__(self, since):
+        self.since = since
+        self.games = []
+        self.attempts = 0
+
+# the finished games of a player are collected for a window (from its first game on) and sent as one mail: the
+# gamefinished mail if it was only one game, else the gamedigest mail with all of them. all mails that are due
+# are sent over one connection
+class DigestQueue:
+    def __init__(self, window, log=None, maxAttempts=3):
+        self.window = window
+        self.log = log
+        self.maxAttempts = maxAttempts
+        # reciever => PendingDigest, the longest waiting first
+        self.pending = OrderedDict()
+        # digests taken by a flush that is still running
+        self.sending = 0
+        self.lock = threading.Lock()
+        registry.gauge("mail_digest_pending", "Recievers with games waiting for their digest", function=lambda: len(self.pending))
+
+    def __len__(self):
+        return len(self.pending)
+
+    # the digests that were not sent yet, including the ones of a flush that is still running
+    def unsent(self):
+        return len(self.pending) + self.sending
+
+    # game is the content of the gamefinished template for the reciever
+    def add(self, reciever, game):
+        with self.lock:
+            digest = self.pending.get(reciever)
+            if digest is None:
+                digest = self.pending[reciever] = PendingDigest(time.monotonic())
+            digest.games.append(game)
+        DIGEST_GAMES.inc()
+
+    # removes and returns the digests that waited for the window (all of them with everything), they count as
+    # being sent until done() is called
+    def due(self, everything=False):
+        now = time.monotonic()
+        with self.lock:
+            recievers = [reciever for reciever, digest in self.pending.items() if everything or now - digest.since >= self.window]
+            self.sending += len(recievers)
+            return [(reciever, self.pending.pop(reciever)) for reciever in recievers]
+
+    # puts digests that could not be sent back in front, with the games that were added since
+    def requeue(self, digests):
+        with self.lock:
+            for reciever, digest in reversed(digests):
+                digest.attempts += 1
+                if digest.attempts >= self.maxAttempts:
+                    if self.log:
+                        self.log.warning("dropped a game digest that could not be sent", reciever=reciever, games=len(digest.games), attempts=digest.attempts)
+                    continue
+                newer = self.pending.pop(reciever, None)
+                if newer is not None:
+                    digest.games += newer.games
+                self.pending[reciever] = digest
+                self.pending.move_to_end(reciever, last=False)
+
+    # sends the digests that are due, returns the number of mails. blocks, run it in a thread. a reciever that is
+    # refused only requeues its own digest, a failed connection requeues all that were not sent yet
+    def flush(self, everything=False):
+        digests = self.due(everything)
+        if not digests:
+            return 0
+        sent = 0
+        tried = 0
+        failed = []
+        with MAIL_DURATION.time(template="gamedigest"):
+            try:
+                with connect() as server:
+                    for reciever, digest in digests:
+                        try:
+                            server.sendmail(sender, reciever, digestMessage(reciever, digest.games).as_string())
+                            sent += 1
+                        except (smtplib.SMTPRecipientsRefused, smtplib.SMTPDataError) as e:
+                            MAIL_FAILURES.inc(template="gamedigest")
+                            failed.append((reciever, digest))
+                            if self.log:
+                                self.log.error("failed to send a game digest", reciever=reciever, error=e)
+                        tried += 1
+            except Exception as e:
+                MAIL_FAILURES.inc(len(digests) - tried, template="gamedigest")
+                failed += digests[tried:]
+                if self.log:
+                    self.log.error("failed to send the game digests", sent=sent, failed=len(digests) - tried, error=e)
+        self.requeue(failed)
+        self.done(len(digests))
+        return sent
+
+    def done(self, count):
+        with self.lock:
+            self.sending -= count
+
+# the mail of the finished games (contents of the gamefinished template) of a player
+def digestMessage(reciever, games):
+    if len(games) == 1:
+        return buildMessage(reciever, "Your game", EMAIL_TEMPLATES["gamefinished"], games[0])
+    username = games[0]["username"]
+    rows = [{**game, "opponent": game["defender"] if game["attacker"] == username else game["attacker"]} for game in games]
+    row = EMAIL_TEMPLATES["gamedigestgame"]
+    return buildMessage(reciever, "Your games", EMAIL_TEMPLATES["gamedigest"], {
+        "username": username,
+        "domain": games[0]["domain"],
+        "count": len(games),
+        "wins": sum(1 for game in games if game["winner"] == username),
+        "draws": sum(1 for game in games if game["isDraw"]),
+        "defeats": sum(1 for game in games if not game["isDraw"] and game["winner"] != username),
+        "gamesTxt": "\n".join(row.txtContent.format(**game) for game in rows),
+        "gamesHtml": "".join(row.htmlContent.format(**game) for game in rows),
+    })
@@ -1,43 +1,166 @@
 # flask for creating the WSGI contained server
-from flask import Flask, request, jsonify, send_from_directory, abort, redirect
+from flask import Flask, request, send_from_directory, abort, redirect, g, Response
 # SQLAlchemy to access the database
 from flask_sqlalchemy import SQLAlchemy
 # serializer to transform query result to json
 from sqlalchemy_serializer import SerializerMixin
 # we will use os to access enviornment variables stored in the *.env files, time for delays and json for ajax-responses.
-import os, time, json, random, sys, numpy as np, re
+# numpy is imported where it is used (and by the warmup), so the server can listen before it is loaded
+import os, time, json, random, sys, re, logging, signal, functools, itertools
 import secrets
 
-from datetime import datetime
-
 # since the builtin flask server is not for production, we use tornado
-import tornado.httpserver
-import tornado.wsgi
+import tornado.httpserver, tornado.gen
 from tornado.websocket import WebSocketHandler
-from tornado.web import FallbackHandler, Application
+from tornado.web import Application
 
-# add RL-A to importable 
-sys.path.insert(0, '/code/RL-A/')
-from TTTsolver import TicTacToeSolver, boardify
-solver = TicTacToeSolver("presets/policy_p1","presets/policy_p2").solveState
+# listening before the database is ready, readiness, lazy loading and warmup
+import startup
+# stopping within a deadline on SIGTERM, without losing work
+import shutdown
 
-# import mail stuff
-from mail import sendMail, EMAIL_TEMPLATES
+# add RL-A to importable 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "RL-A"))
+
+# the RL-A (with numpy and the policies) is loaded on first use or by the warmup
+def loadSolver():
+    from TTTsolver import TicTacToeSolver
+    return TicTacToeSolver("presets/policy_p1","presets/policy_p2").solveState
+solver = startup.Lazy(loadSolver)
+
+# import mail stuff (the templates are read on first use or by the warmup)
+from mail import sendMail, EMAIL_TEMPLATES, loadTemplates, DigestQueue
+
+# import metrics, exposed in the prometheus text format on /metrics
+import metrics
+
+# structured logging, records are only formatted if their level is enabled
+import logger
+from logger import lazy
+HTTP_DURATION = metrics.registry.histogram("http_request_duration_seconds", "Duration of HTTP requests handled by flask", ["route", "method", "status"])
+WS_ACTION_DURATION = metrics.registry.histogram("websocket_action_duration_seconds", "Duration of WebSocket actions", ["action"])
+SOLVER_DURATION = metrics.registry.histogram("solver_duration_seconds", "Time the RL-A needed to find a move")
+WS_CONNECTIONS = metrics.registry.gauge("websocket_connections", "Open WebSocket connections")
+WS_REAPED = metrics.registry.counter("websocket_reaped_total", "WebSockets closed or unsubscribed by the reaper", ["reason"])
+
+# sampling profiler and blocked-loop detection for diagnosing stalls in production
+import profiler
+
+# in-memory index of the react build, served natively by tornado
+import staticfiles
+
+# version of the backend, checked against the remote in the background
+import version
+
+# cache for the responses of the polled list endpoints
+from responsecache import ResponseCache, CachedResponse
+# outgoing websocket messages: batching and limits per connection
+import outbox
+# pairs players looking for a human opponent
+import matchmaking
+# streaming export of all games
+import export
+# moves old finished games into a compact table
+import archive
+# rate limits per client and admission control of the expensive actions
+import ratelimit
+# encoding of the responses and websocket messages
+import responses
+from responses import jsonResponse
+# routes the read-only queries to the read replica (if there is one)
+import replica
+# elo ratings of the players and their ranks
+import rating
+# feed of the events of all games (subscribeLobby)
+import lobby
+# win/draw counts of the positions of the finished games (/positions)
+import positions
+from sqlalchemy import event, select, union_all, inspect
+from sqlalchemy.orm import object_session
+from sqlalchemy.exc import NoResultFound
 
 # initialize flask application. since all GET requests are static, we point the static_url_path to a dummy path
 app=Flask(__name__, static_url_path='/_flask_static')
+# flask's debug mode is opt-in (FLASK_DEBUG in web.env), it is never enabled by a missing PRODUCTION
+app.debug = os.environ.get("FLASK_DEBUG", "FALSE").upper() == "TRUE"
+log = logger.configure(app.logger)
 app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = True
 # bind database
-app.config["SQLALCHEMY_DATABASE_URI"] =  f"postgresql://{os.environ['POSTGRES_USER']}:{os.environ['POSTGRES_PASSWORD']}@db/tictactoe"
+# DATABASE_URI can be set to point the server to another database (e.g. a local one for benchmarks)
+app.config["SQLALCHEMY_DATABASE_URI"] = os.environ.get("DATABASE_URI", f"postgresql://{os.environ['POSTGRES_USER']}:{os.environ['POSTGRES_PASSWORD']}@db/tictactoe")
 
 # uncomment to show all db queries
 # app.config['SQLALCHEMY_ECHO'] = True
 
-db = SQLAlchemy(app)
+# reads of the read-only routes go to REPLICA_DATABASE_URI if it is set and doesn't lag behind (see replica.py)
+readRouter = replica.ReplicaRouter(os.environ.get("REPLICA_DATABASE_URI"), float(os.environ.get("REPLICA_MAX_LAG", 5)), float(os.environ.get("REPLICA_STICKY_SECONDS", 5)), log)
+db = SQLAlchemy(app, session_options=readRouter.sessionOptions())
+
+# responses of /games and /users, invalidated when a game or move changes (see the mapper events below the models)
+responseCache = ResponseCache(float(os.environ.get("RESPONSE_CACHE_TTL", 10)))
+
+# the finished games of a player are collected for MAIL_DIGEST_WINDOW seconds and sent as one mail (0, the default,
+# sends a mail per game)
+mailDigests = DigestQueue(float(os.environ.get("MAIL_DIGEST_WINDOW", 0)), log)
+
+# the events of all games for the sockets that subscribed to the lobby, the last LOBBY_REPLAY are kept for reconnects
+lobbyFeed = lobby.LobbyFeed(int(os.environ.get("LOBBY_REPLAY", 1000)))
+
+# players waiting for an opponent (findMatch over the websocket)
+matchmakingQueue = matchmaking.MatchmakingQueue()
+
+# budgets of the expensive actions per ip and user/session (see RATE_LIMITS in web.env, empty to disable)
+rateLimiter = ratelimit.RateLimiter(ratelimit.parseLimits(os.environ.get("RATE_LIMITS", ratelimit.DEFAULT_LIMITS)))
+# rejects the limited actions if the server is overloaded, the IOLoop lag is measured once it was started
+admission = ratelimit.Admission(float(os.environ.get("ADMISSION_MAX_DELAY", 0.5)))
+
+# the server answers requests that need the database only once it is ready (the server requires it on startup)
+readiness = startup.Readiness()
+# SIGTERM stops the server within SHUTDOWN_DEADLINE seconds (the steps are added in __main__), the background work runs through it
+serverShutdown = shutdown.GracefulShutdown(float(os.environ.get("SHUTDOWN_DEADLINE", 20)), log)
+
+# users that may use the admin endpoints (profiler)
+ADMIN_USERS = [username for username in os.environ.get("ADMIN_USERS", "").split(",") if username]
+# the profiler is started by an admin (see /admin/profiler/start) or with SIGUSR1
+samplingProfiler = profiler.SamplingProfiler(os.environ.get("PROFILE_DIR", "/tmp"), log)
+# the watchdog is started with the IOLoop if BLOCKED_LOOP_THRESHOLD is set
+blockedLoopWatchdog = None
+# started with the IOLoop, reads the local hash once and the remote one every VERSION_CHECK_INTERVAL seconds
+versionChecker = version.VersionChecker(os.environ.get("GIT_REPOSITORY"), os.environ.get("GIT_REMOTE", "origin"), float(os.environ.get("VERSION_CHECK_INTERVAL", 3600)), log)
+
+# folder of the built react app
+BUILD_DIR = os.environ.get("BUILD_DIR", "/build/")
+
+# whether or not the server is using ssl (read once, the environment doesn't change)
+SSL_ENABLED = "ENABLE_SSL" in os.environ and os.environ["ENABLE_SSL"].upper() == "TRUE"
 
 # returns a boolean describing whether or not the server is using ssl
 def sslEnabled():
-    return "ENABLE_SSL" in os.environ and os.environ["ENABLE_SSL"].upper() == "TRUE"
+    return SSL_ENABLED
+
+# returns true if a GET request to the path would be answered by appLoader (i.e. is a route of the react app)
+@functools.lru_cache(maxsize=1024)
+def isAppRoute(path):
+    try:
+        endpoint, _ = app.url_map.bind("localhost").match(path, "GET")
+        return endpoint == "appLoader"
+    except Exception:
+        return False
+
+# returns true if the request was made by an admin with a token that didn't expire (SESSION_TIMEOUT)
+def isAdminRequest(request):
+    try:
+        token = Session.requestToken(request)
+        session = Session.find(token).one() if token else None
+        return session is not None and session.username in ADMIN_USERS and session.getExpiration() >= time.time()
+    except (NoResultFound, AttributeError):
+        # unknown token, or a malformed Authorisation header
+        return False
+
+# same for requests that are not handled by flask (e.g. tornado's), with an app context of their own
+def isAdminTornadoRequest(request):
+    with app.app_context():
+        return isAdminRequest(request)
 
 # makes a move if it should, returns true if the bot made a move
 def makeBotMove(gameId):
@@ -46,20 +169,27 @@ def makeBotMove(gameId):
     # if the game is ongoing and the bot is one of the players
     if game.getGameState() == Game.ONGOING and os.environ["BOT_USERNAME"] in [game.attacker, game.defender]:
         # find the best move
-        solution = solver(game.getNumpyGameField().reshape((3,3)), "defender", False)
+        with SOLVER_DURATION.time():
+            solution = solver.get()(game.getNumpyGameField().reshape((3,3)), "defender", False)
         # log the solution
-        app.logger.info(f"found solution to board: {solution}")
+        log.debug("found solution to board", gameId=gameId, solution=solution)
         # create a move
         move = Move.fromXY({"y":solution[0], "x":solution[1]},os.environ["BOT_USERNAME"], game.gameId)
-        # find out whether the game is finished or not
-        # BUG: breaks sometimes, preventing the user to recieve updates
-        game.determineState()
-        # send the new state to all subscribers
-        gameSubscriptions.broadcastState(game.gameId)
+        # find out whether the game is finished and send the move to all subscribers
+        determineAndBroadcast(game, move)
         return True
     else:
         return False
 
+# determines the state of the game after a move and sends the move to its subscribers. the move is sent even if
+# determining the state failed (determineState rolled its changes back then)
+def determineAndBroadcast(game, move):
+    try:
+        game.determineState()
+    except Exception:
+        log.exception("failed to determine the state of the game", gameId=move.gameId)
+    gameSubscriptions.broadcastMove(game, move)
+
 # table to store users, their password and email to
 class User(db.Model, SerializerMixin):
     __tablename__ = "users"
@@ -88,8 +218,7 @@ class User(db.Model, SerializerMixin):
     @staticmethod
     def authorize(username, key):
         # log for debugging
-        app.logger.info(username)
-        app.logger.info(key)
+        log.debug("authorizing user", username=username)
         # get all users, take those with the same username (should be 0 or 1), filter to the key and count it.
         return db.session.query(User).filter(User.username==username).filter(User.key==key).count()==1
 
@@ -120,7 +249,10 @@ class User(db.Model, SerializerMixin):
     
     # returns an array of games played by the user, ordered descending by their id
     def getGames(self, limit, lastGameId):
-        return db.session.query(Game).filter(Game.attacker == self.username).union(db.session.query(Game).filter(Game.defender==self.username)).filter(Game.gameId < lastGameId).order_by(Game.gameId.desc()).limit(limit).all()
+        games = db.session.query(Game).filter(Game.attacker == self.username).union(db.session.query(Game).filter(Game.defender==self.username)).filter(Game.gameId < lastGameId).order_by(Game.gameId.desc()).limit(limit).all()
+        # older games may have been archived
+        archivedGames = db.session.query(ArchivedGame).filter((ArchivedGame.attacker == self.username) | (ArchivedGame.defender == self.username)).filter(ArchivedGame.gameId < lastGameId).order_by(ArchivedGame.gameId.desc()).limit(limit).all()
+        return ArchivedGame.merge(games, archivedGames, limit)
 
 # table to store games and their players to
 class Game(db.Model, SerializerMixin):
@@ -139,6 +271,8 @@ class Game(db.Model, SerializerMixin):
     # unique values to determine the games state
     ONGOING=0
     FINISHED=1
+    # the moves of a game that was loaded from the archive (see ArchivedGame.toGame), None for all others
+    archivedMoves = None
 
     def __init__(self, player, playAgainstBot = True):
         # set the attacker
@@ -152,48 +286,69 @@ class Game(db.Model, SerializerMixin):
 
     # determines the game and sets gameFinished, and winner to the appropriate values 
     def determineState(self):
-        # get the board
-        board = self.getNumpyGameField()
-        # determine the winner, None if there is none, False if it is even, 1 or -1 if its a player
-        winner = self.getWinnerOfBoard(board)
-        # log it for debugging
-        app.logger.info(f"determined winner: {winner}")
-        # if the game was not set to be finished and there is a winner 
-        if not self.gameFinished and (winner == False or winner == 1 or winner == -1):
-            app.logger.info("game finished")
-            # set the game to be finished
-            self.gameFinished = True
-            # if the game is not even, set the winner
-            if(winner != False):
-                self.winner = self.attacker if winner == 1 else self.defender
+        # the mails of the result, (player, content), they are only sent once it is committed
+        mails = []
+        try:
+            # get the board
+            board = self.getNumpyGameField()
+            # determine the winner, None if there is none, False if it is even, 1 or -1 if its a player
+            winner = self.getWinnerOfBoard(board)
+            # log it for debugging
+            log.debug("determined winner", gameId=self.gameId, winner=winner)
+            # if the game was not set to be finished and there is a winner 
+            if not self.gameFinished and (winner == False or winner == 1 or winner == -1):
+                log.debug("game finished", gameId=self.gameId)
+                # set the game to be finished
+                self.gameFinished = True
+                # if the game is not even, set the winner
+                if(winner != False):
+                    self.winner = self.attacker if winner == 1 else self.defender
+                else:
+                    # else set the game to be draw
+                    self.isDraw = True
+                # update the ratings of the players, committed together with the result
+                ratings.apply(db.session, self)
+                # count the result for every position of the game, also committed together with it (the attacker has the even moves)
+                positionStats.record(db.session, [(move.movePosition, 1 if move.moveIndex % 2 == 0 else -1) for move in sorted(self.getMoves(), key=lambda move: move.moveIndex)], int(winner) if winner != False else 0)
+                # get the players and prepare their mail (a guest has no account)
+                players = [User.find(username).one() for username in (self.attacker, self.defender) if username is not None]
+                for player in players:
+                    # if the player didn't disable mails (TODO: give the user the option to disable mails), the bot never gets one
+                    if not player.disableMail and player.username != os.environ["BOT_USERNAME"]:
+                        try:
+                            mails.append((player.username, player.email, {
+                                "attacker":self.attacker, 
+                                "defender":self.defender, 
+                                "gameField":[{1:"x", 0:"◻", -1:"o"}[i] for i in self.getGameField()], 
+                                "winner":self.winner, 
+                                "isDraw":self.isDraw, 
+                                "domain":os.environ["DOMAIN"], 
+                                "username": player.username, 
+                                "gameId":self.idToHexString(),
+                                "stateText": "won" if player.username == self.winner else "lost" if not self.isDraw else "ended the game in a draw"
+                                }))
+                        except Exception as e:
+                            # log if failed
+                            log.error("failed to prepare the email of the user", username=player.username, error=e)
             else:
-                # else set the game to be draw
-                self.isDraw = True
-            # get the players and send them a mail
-            players = [User.find(self.attacker).one(), User.find(self.defender).one()]
-            for player in players:
-                # if the player didn't disable mails (TODO: give the user the option to disable mails)
-                if not player.disableMail:
-                    try:
-                        # send the mail
-                        sendMail(player.email, "Your game", EMAIL_TEMPLATES["gamefinished"], {
-                            "attacker":self.attacker, 
-                            "defender":self.defender, 
-                            "gameField":[{1:"x", 0:"◻", -1:"o"}[i] for i in self.getGameField()], 
-                            "winner":self.winner, 
-                            "isDraw":self.isDraw, 
-                            "domain":os.environ["DOMAIN"], 
-                            "username": player.username, 
-                            "gameId":self.idToHexString(),
-                            "stateText": "won" if player.username == self.winner else "lost" if not self.isDraw else "ended the game in a draw"
-                            })
-                    except Exception as e:
-                        # log if failed
-                        app.logger.error("failed to send email to user", player)
-        else:
-            app.logger.info("game not finished yet")
-        # commit changes
-        db.session.commit()
+                log.debug("game not finished yet", gameId=self.gameId)
+            # commit changes
+            db.session.commit()
+        except Exception:
+            # the result (ratings, position stats) must not stay in the session, it is shared by the websockets
+            db.session.rollback()
+            raise
+        # sent only once the result is committed, a rolled back result gets no mail
+        for username, email, content in mails:
+            try:
+                # collect the game for the digest of the player, or send the mail right away
+                if mailDigests.window > 0:
+                    mailDigests.add(email, content)
+                else:
+                    sendMail(email, "Your game", EMAIL_TEMPLATES["gamefinished"], content)
+            except Exception as e:
+                # log if failed
+                log.error("failed to send email to user", username=username, error=e)
 
     # transforms the game-id (int) to a hex-string
     def idToHexString(self, length=6):
@@ -201,12 +356,14 @@ class Game(db.Model, SerializerMixin):
 
     # returns all moves associated with this game
     def getMoves(self):
+        if self.archivedMoves is not None:
+            return self.archivedMoves
         return db.session.query(Move).filter(Move.gameId == self.gameId).all()
 
     # returns game field in one-dimensional array with {attacker:1, defender:-1, empty:0}
-    def getGameField(self):
-        # get the moves
-        moves = self.getMoves()
+    def getGameField(self, moves=None):
+        # get the moves (if they were not loaded already)
+        moves = self.getMoves() if moves is None else moves
         # create a field of 0's
         field = [0]*9
         # for every move, set the player in the field
@@ -219,6 +376,7 @@ class Game(db.Model, SerializerMixin):
 
     # returns the gamefield as np-array
     def getNumpyGameField(self):
+        import numpy as np
         # create an empty np array
         field = np.empty(9, dtype="float64")
         # fill it with the gamefield
@@ -226,17 +384,36 @@ class Game(db.Model, SerializerMixin):
         return field
 
     # get the info of the game
-    def getGameInfo(self):
+    def getGameInfo(self, moves=None):
         info = {}
         info["attacker"] = self.attacker
         info["defender"] = self.defender
         info["gameId"] = self.gameId
         info["winner"] = self.winner
-        info["gameField"] = self.getGameField()
+        info["gameField"] = self.getGameField(moves)
         info["isFinished"] = self.gameFinished
         info["isDraw"] = self.isDraw
         return info
 
+    # get the info of the game with its sequence number (the number of moves), used by protocol 2 of the websocket
+    def getSnapshot(self):
+        moves = self.getMoves()
+        info = self.getGameInfo(moves)
+        info["seq"] = len(moves)
+        return info
+
+    # get the change a move made to the game (protocol 2 of the websocket), seq is the number of moves after it
+    def getMoveDelta(self, move):
+        return {
+            "gameId": self.gameId,
+            "seq": move.moveIndex + 1,
+            "moveIndex": move.moveIndex,
+            "position": move.movePosition,
+            "player": 1 if move.player == self.attacker else -1,
+            # the terminal state, None while the game is ongoing
+            "state": {"winner": self.winner, "isDraw": self.isDraw} if self.gameFinished else None,
+        }
+
     # gets the winner of game (string), None if draw, False if ongoing
     def getWinner(self):
         if not self.gameFinished:
@@ -276,22 +453,45 @@ class Game(db.Model, SerializerMixin):
             raise ValueError("can't play against yourself")
 
         # if we are here, the user may join
-        game.started = True
+        values = {"started": True}
         # if a username is set (not guest) we can delete the gameKey
         if username:
-            game.defender = username
-            game.gameKey = None
-
+            values["defender"] = username
+            values["gameKey"] = None
+
+        # only update the game if it still hasn't started, so only one of two concurrent joiners succeeds
+        joined = db.session.query(Game).filter(Game.gameId == game.gameId, Game.started == False).update(values, synchronize_session=False)
+        # the bulk update bypasses the mapper events
+        responseCache.invalidateOnCommit(db.session, "games", "userGames")
+        if joined:
+            lobbyFeed.record(db.session, "started", game.gameId, {"attacker": game.attacker, "defender": values.get("defender", game.defender)}, (game.attacker, values.get("defender", game.defender)))
         # commit changes
         db.session.commit()
+        if not joined:
+            raise ValueError("game allready started")
         # refresh the game
         db.session.refresh(game)
         return game
 
+    @staticmethod
+    # creates a started game of two players (found by the matchmaking) with a single insert
+    def createMatch(attacker, defender):
+        game = Game(attacker, False)
+        game.defender = defender
+        game.started = True
+        game.gameKey = None
+        db.session.add(game)
+        db.session.commit()
+        return game
+
     @staticmethod
     # find a game by its id (decimal)
     def find(gameId):
-        return db.session.query(Game).filter(Game.gameId == gameId).one()
+        game = db.session.query(Game).filter(Game.gameId == gameId).one_or_none()
+        # finished games may have been moved to the archive
+        if game is None:
+            return db.session.query(ArchivedGame).filter(ArchivedGame.gameId == gameId).one().toGame()
+        return game
 
     @staticmethod
     # find a game by its hex id
@@ -301,7 +501,7 @@ class Game(db.Model, SerializerMixin):
     @staticmethod
     # rotate an array by 45  degrees (for getting diagonal moves in one line)
     def rotate45(array2d):
-        rotated = [[] for i in range(np.sum(array2d.shape)-1)]
+        rotated = [[] for i in range(sum(array2d.shape)-1)]
         for i in range(array2d.shape[0]):
             for j in range(array2d.shape[1]):
                 rotated[i+j].append(array2d[i][j])
@@ -335,16 +535,13 @@ class Game(db.Model, SerializerMixin):
     @staticmethod
     # @returns players number if he wins, elseif draw False else None
     def getWinnerOfBoard(board):
-        app.logger.info(f"getting winner of board={board}")
+        import numpy as np
         board = board.reshape((3,3))
-        app.logger.info(f"getting winner of reshaped board={board}")
-        app.logger.info(f"test-rotate: {np.rot90(board)}")
+        log.debug("getting winner of board", board=lazy(lambda: board.tolist()))
         # once normal, once rotated by 45 degrees and only 3rd row of that ([2:3]) (diagonal 1) and once rotated by -45 degrees (also only 3rd row) (diagonal 2)
         for i in [board, np.rot90(board, axes=(0,1)), *[Game.rotate45(j)[2:3] for j in [board, board[::-1]]]]:
-            app.logger.info(f"determining winner of sub-board {i}")
             # for every line
             for j in i:
-                app.logger.info(f"looking at row {j}")
                 # figure out if the average is exactly the same as the first entry
                 if sum(j)/len(j) == j[0] and 0 not in j:
                     return j[0]
@@ -367,7 +564,7 @@ class Move(db.Model, SerializerMixin):
         self.gameId = str(gameId)
         self.player = player if player else None
         self.moveIndex = self.getMoveIndex()
-        app.logger.info(self.moveIndex)
+        log.debug("move index", gameId=self.gameId, moveIndex=self.moveIndex)
         self.movePosition = int(movePosition)
         # check if move is valid
         self.checkValidity()
@@ -407,13 +604,76 @@ class Move(db.Model, SerializerMixin):
     @staticmethod
     def fromXY(coords, user, gameId):
         # 2d index to 1d => x + y*3 (counting from 0)
-        app.logger.info(f"creating move from coords: {coords}, user={user}, gameId={gameId}")
+        log.debug("creating move from coords", coords=coords, user=user, gameId=gameId)
         move = Move(gameId, int(coords["x"])+int(coords["y"])*3, user)
         db.session.add(move)
         db.session.commit()
         db.session.refresh(move)
         return move
 
+# finished games that were moved out of games and moves by the archive job (see archive.py), one row per game
+class ArchivedGame(db.Model, SerializerMixin):
+    __tablename__ = "archived_games"
+
+    # columns (same as in games, the ids are kept)
+    gameId = db.Column(db.Integer(), primary_key=True, autoincrement=False, name="gameid")
+    attacker = db.Column(db.String(16), db.ForeignKey("users.username"), nullable=True)
+    defender = db.Column(db.String(16), db.ForeignKey("users.username"), nullable=True)
+    winner = db.Column(db.String(16), db.ForeignKey("users.username"), nullable=True)
+    isDraw = db.Column(db.Boolean(), default=False)
+    # the fields of the moves, 4 bits per move (see archive.packMoves)
+    moves = db.Column(db.BigInteger(), nullable=False)
+    timestamp = db.Column(db.TIMESTAMP)
+    finishedAt = db.Column(db.TIMESTAMP, name="finishedat")
+
+    # returns a (detached) Game with the moves of the archive, so all read paths can use it like any other game
+    def toGame(self):
+        game = Game(self.attacker, False)
+        game.gameId = self.gameId
+        game.defender = self.defender
+        game.winner = self.winner
+        game.isDraw = self.isDraw
+        game.gameFinished = True
+        game.started = True
+        game.gameKey = None
+        game.timestamp = self.timestamp
+        game.archivedMoves = archive.archivedMoves(self.gameId, self.moves, self.attacker, self.defender, self.finishedAt)
+        return game
+
+    @staticmethod
+    # merges games and archived games (both ordered descending by their id) to the newest limit games
+    def merge(games, archivedGames, limit):
+        return sorted(games + [archivedGame.toGame() for archivedGame in archivedGames], key=lambda game: game.gameId, reverse=True)[:int(limit)]
+
+# elo rating of a player, updated when a game finishes (see rating.py)
+class Rating(db.Model, SerializerMixin):
+    __tablename__ = "ratings"
+
+    # columns
+    username = db.Column(db.String(16), db.ForeignKey("users.username"), primary_key=True)
+    rating = db.Column(db.Float(), nullable=False)
+    # rated games of the player
+    games = db.Column(db.Integer(), nullable=False, default=0)
+    updated = db.Column(db.TIMESTAMP, server_default=db.text('CURRENT_TIMESTAMP'), onupdate=db.func.now())
+
+# the ratings are changed with the game that finishes, the ranks are kept in memory (see RATING_* in web.env)
+ratings = rating.RatingEngine(Rating, os.environ["BOT_USERNAME"], os.environ.get("RATING_BOT_POLICY", "fixed"), float(os.environ.get("RATING_K", 32)), float(os.environ.get("RATING_INITIAL", 1500)), float(os.environ.get("RATING_BOT_RATING", 1500)), log)
+
+# how often a position (all of its symmetries, see positions.py) led to a win of either player or a draw
+class PositionStat(db.Model, SerializerMixin):
+    __tablename__ = "position_stats"
+
+    # columns
+    code = db.Column(db.Integer(), primary_key=True, autoincrement=False)
+    # pieces on the board
+    moves = db.Column(db.SmallInteger(), nullable=False)
+    attackerWins = db.Column(db.Integer(), nullable=False, default=0, name="attackerwins")
+    defenderWins = db.Column(db.Integer(), nullable=False, default=0, name="defenderwins")
+    draws = db.Column(db.Integer(), nullable=False, default=0)
+
+# the counts are added with the game that finishes
+positionStats = positions.PositionStats(PositionStat.__table__, log)
+
 # table to store sessionKeys to (=tokens). Tokens allow faster and more secure authentication since they expire after a certain time
 class Session(db.Model, SerializerMixin):
     __tablename__ = "sessions"
@@ -439,7 +699,7 @@ class Session(db.Model, SerializerMixin):
             return instance
         except Exception as e:
             # throw error if failed
-            app.logger.error(e)
+            log.exception("failed to generate a token", username=username)
             return False
 
     @staticmethod
@@ -447,16 +707,20 @@ class Session(db.Model, SerializerMixin):
     def find(sessionKey):
         return db.session.query(Session).filter(Session.sessionKey==sessionKey)
 
+    @staticmethod
+    # the Authorisation Bearer from the header, None without one
+    def requestToken(request):
+        return re.match(r"(Bearer)\ ([0-f]*)", request.headers["Authorisation"]).groups()[-1] if "Authorisation" in request.headers else None
+
     @staticmethod
     # authenticate a request by the session, takes the Authorisation Bearer from the header
     def authenticateRequest(request):
-        token = re.match(r"(Bearer)\ ([0-f]*)", request.headers["Authorisation"]).groups()[-1] if "Authorisation" in request.headers else None
-        return Session.authenticateToken(token)
+        return Session.authenticateToken(Session.requestToken(request))
 
     @staticmethod
     # authenticate a token and return the username
     def authenticateToken(token):
-        app.logger.info(f"authenticating token {token}")
+        log.sampled(logging.DEBUG, "authenticating token", hasToken=token is not None)
         session = Session.find(token).one() if token else None
         return session.username if session else None
 
@@ -524,13 +788,45 @@ class Competition(db.Model, SerializerMixin):
     def hasJoined(username):
         return db.session.query(Competition).filter(Competition.username == username).count() > 0
 
+# invalidate the cached game lists when a game or move is added or changed
+@event.listens_for(Game, "after_insert")
+@event.listens_for(Move, "after_insert")
+def invalidateGameLists(mapper, connection, target):
+    responseCache.invalidateOnCommit(object_session(target), "games", "userGames")
+
+# invalidate all game lists and the user list (leaderboard) when a game changes (e.g. finishes)
+@event.listens_for(Game, "after_update")
+def invalidateGameAndUserLists(mapper, connection, target):
+    responseCache.invalidateOnCommit(object_session(target), "games", "userGames", "users")
+
+# a new user shows up in the user list
+@event.listens_for(User, "after_insert")
+def invalidateUserList(mapper, connection, target):
+    responseCache.invalidateOnCommit(object_session(target), "users")
+
+# the lobby feed gets the new games and moves and the games that finished, published after the commit
+@event.listens_for(Game, "after_insert")
+def recordCreatedGame(mapper, connection, target):
+    lobbyFeed.record(object_session(target), "created", target.gameId, {"attacker": target.attacker, "defender": target.defender, "started": bool(target.started)}, (target.attacker, target.defender))
+
+@event.listens_for(Move, "after_insert")
+def recordMove(mapper, connection, target):
+    gameId = int(target.gameId)
+    lobbyFeed.record(object_session(target), "move", gameId, {"player": target.player, "position": target.movePosition, "index": target.moveIndex}, lambda: connection.execute(select(Game.attacker, Game.defender).where(Game.gameId == gameId)).one())
+
+@event.listens_for(Game, "after_update")
+def recordFinishedGame(mapper, connection, target):
+    if target.gameFinished and inspect(target).attrs.gameFinished.history.added:
+        lobbyFeed.record(object_session(target), "finished", target.gameId, {"winner": target.winner, "isDraw": bool(target.isDraw)}, (target.attacker, target.defender))
+
 # list where websocket-connections are stored and can subscribe to games to recieve updates
 class GameSubscriptionList:
     # subscription list: {gameId: [socket, msgId][]]}
     subscriptions = {}
 
     def __init__(self):
-        pass
+        # full state of the subscribed games with their seq, kept up to date by the moves: {gameId: info}
+        self.gameInfos = {}
 
     # subscribe to a game
     def add(self, gameId, msgId, socket): 
@@ -538,75 +834,111 @@ class GameSubscriptionList:
             # if the gameId is not yet subscribed, add it with an empty array
             if not gameId in self.subscriptions:
                 self.subscriptions[gameId] = []
+            # a socket that subscribes again only gets the updates with the new msgId
+            self.subscriptions[gameId] = [(subscriber, subscriberMsgId) for (subscriber, subscriberMsgId) in self.subscriptions[gameId] if subscriber is not socket]
             # add the subscription
             self.subscriptions[gameId].append((socket, msgId))
-            app.logger.info(f"added socket to list of game #{gameId}")
+            log.debug("added socket to list of game", gameId=gameId)
             return True
         except Exception as e:
-            app.logger.info(e)
+            log.error("failed to add socket to list of game", gameId=gameId, error=e)
             return False
 
     # unsubscribe from a game
     def remove(self, socket, gameId=False):
         try:
             if gameId:
-                # BUG: the socket is not directly in the array, the elements in the array are [socket, msgId]
-                while socket in self.subscriptions[gameId]:
-                    self.subscriptions[gameId].remove(socket)
-                app.logger.info(f"removed socket from list of game #{gameId}")
+                # the elements in the array are (socket, msgId)
+                subscribers = [(subscriber, msgId) for (subscriber, msgId) in self.subscriptions[gameId] if subscriber is not socket]
+                # forget games without subscribers, so the list doesn't grow forever
+                if subscribers:
+                    self.subscriptions[gameId] = subscribers
+                else:
+                    del self.subscriptions[gameId]
+                    self.gameInfos.pop(gameId, None)
+                log.debug("removed socket from list of game", gameId=gameId)
             else:
-                for gameId in self.subscriptions.keys():
+                # copy the keys, remove() deletes games without subscribers
+                for gameId in list(self.subscriptions.keys()):
                     self.remove(socket, gameId)
         except Exception as e:
             return False
         return True
 
-    # broadcast data to all subscribers
-    def broadcast(self, gameId, data):
-        # log
-        app.logger.info(f"broadcasting data {data} to game #{gameId}", self.subscriptions[gameId])
-        # for every subscriber
-        for (socket, msgId) in self.subscriptions[gameId]:
+    # broadcasts a move to all subscribers of its game: subscribers using protocol 2 get the change (delta) only,
+    # all others get the full state of the game
+    def broadcastMove(self, game, move):
+        subscribers = self.subscriptions.get(game.gameId)
+        if not subscribers:
+            return
+        log.sampled(logging.DEBUG, "broadcasting move to game", gameId=game.gameId, subscribers=len(subscribers))
+        # the payloads are encoded once, only the msgId differs per subscriber
+        delta = responses.dumps(game.getMoveDelta(move))
+        info = None
+        for (socket, msgId) in subscribers:
             try:
-                # send the data
-                socket.send("broadcast", data, msgId)
+                if socket.protocolVersion >= 2:
+                    socket.sendEncoded("move", delta, msgId)
+                else:
+                    # only build the full state if someone needs it
+                    if info is None:
+                        info = responses.encodeGameInfo(self.getGameInfo(game, move))
+                    socket.sendEncoded("broadcast", info, msgId)
             except:
                 # socket is probably closed, just ignore
                 pass
-        # log
-        app.logger.info(f"broadcasted data to game #{str(gameId)}")
-        return
 
-    # broadcasts a games data to all subscribers given a gameId
-    def broadcastState(self, gameId):
-        try:
-            # get the games data
-            data = Game.find(gameId).getGameInfo()
-            # log the data
-            app.logger.info(data)
-            # broadcast the data
-            self.broadcast(gameId, data)
-        except Exception as e:
-            # log the error
-            app.logger.error(e)
-            app.logger.error(f"failed to broadcast game {gameId}")
-        return
+    # returns the full state of a game after a move. the state is updated with the move if the previous one is
+    # known, so it doesn't have to be rebuilt from the db
+    def getGameInfo(self, game, move):
+        info = self.gameInfos.get(game.gameId)
+        if info is None or info["seq"] != move.moveIndex:
+            info = game.getSnapshot()
+        else:
+            info["gameField"][move.movePosition] = 1 if move.player == game.attacker else -1
+            info["seq"] = move.moveIndex + 1
+            info.update(winner=game.winner, isFinished=game.gameFinished, isDraw=game.isDraw, defender=game.defender)
+        self.gameInfos[game.gameId] = info
+        # the seq is not part of the state for protocol 1
+        return {key: value for key, value in info.items() if key != "seq"}
 
 # create a new instance of the game subscription list
 gameSubscriptions = GameSubscriptionList()
+metrics.registry.gauge("game_subscriptions", "Subscriptions of WebSockets to games", function=lambda: sum(len(subscribers) for subscribers in gameSubscriptions.subscriptions.values()))
+metrics.registry.gauge("subscribed_games", "Games with at least one subscription", function=lambda: len(gameSubscriptions.subscriptions))
 
 # extend the WebSocketHandler class to add the gameSubscriptions list
 class WebSocket(WebSocketHandler):
+    # known actions, used to label the metrics
+    ACTIONS = ["ping", "negotiate", "subscribeGame", "unsubscribeGame", "resyncGame", "viewGame", "makeMove", "findMatch", "cancelMatch", "subscribeLobby", "unsubscribeLobby", "help"]
+    # supported versions of the protocol:
+    # 1: subscribers get the full state of the game after every move ("broadcast")
+    # 2: subscribers get a snapshot on subscribeGame and only the changes after that ("move", with a seq)
+    PROTOCOL_VERSIONS = [1, 2]
+    # the version is 1 until the client negotiates another one
+    protocolVersion = 1
+    # all open connections, used by the reaper
+    connections = set()
+
     # allow all origins
     def check_origin(self, origin):
         return True
+
+    # permessage-deflate, configured with WS_COMPRESSION_LEVEL
+    def get_compression_options(self):
+        return outbox.compressionOptions()
  
     # on open log the connection
     def open(self):
-        print("Socket opened.")
+        self.outbox = outbox.Outbox(self)
+        self.lastActivity = time.monotonic()
+        WebSocket.connections.add(self)
+        WS_CONNECTIONS.inc()
+        log.sampled(logging.DEBUG, "socket opened")
 
     # when a message is received, act accordingly
     def on_message(self, data):
+        self.lastActivity = time.monotonic()
         try:
             # decode the json
             message = data if type(data) == "dict" else json.loads(data)
@@ -619,20 +951,68 @@ class WebSocket(WebSocketHandler):
         except:
             return self.error(None,["unparseable data",data], msgId)
 
+        # handle the action and measure how long it took
+        label = action if action in self.ACTIONS else "unknown"
+        # commits of the action are recorded for the socket (read your writes on the read replica)
+        readRouter.setClient(db.session, ("socket", id(self)))
+        with metrics.scope(WS_ACTION_DURATION, f"websocket:{label}", action=label):
+            # only the actions without the database work while the server starts (or stops)
+            if not readiness.ready() and action not in ("ping", "negotiate", "help"):
+                return self.error(action, readiness.reason(), msgId, arguments)
+            if action not in rateLimiter.limits:
+                return self.handleAction(action, arguments, msgId)
+            # reject the expensive actions early if the server is overloaded or the client is over its budget
+            if admission.check(action):
+                return self.error(action, "server busy", msgId, arguments)
+            retryAfter = rateLimiter.hit(action, [("ip", self.request.remote_ip), ("user", arguments.get("token") or arguments.get("gameKey"))])
+            if retryAfter:
+                return self.send(action, {"data":"rate limited", "args":arguments, "retryAfter":round(retryAfter, 1)}, msgId, True)
+            return self.handleAction(action, arguments, msgId)
+
+    # act according to the action of a message
+    def handleAction(self, action, arguments, msgId):
         # return pong on ping
         if action == "ping":
             return self.send(action, "pong", msgId)
 
+        # choose the highest version of the protocol that both sides support
+        if action == "negotiate":
+            versions = [version for version in arguments.get("versions", [1]) if version in self.PROTOCOL_VERSIONS]
+            if not versions:
+                return self.error(action, "no supported protocol version", msgId, arguments)
+            self.protocolVersion = max(versions)
+            self.send(action, {"version":self.protocolVersion, "batching":bool(arguments.get("batching", False))}, msgId)
+            # messages of the same tick are sent as one array from now on
+            self.outbox.batching = bool(arguments.get("batching", False))
+            return
+
         # subscribe to a game
         if action == "subscribeGame":
             # verify that gameId is in arguments
             if "gameId" not in arguments:
                 return self.error(action, "parameter not given: gameId", msgId, arguments)
+            try:
+                gameId = int(arguments["gameId"])
+                # protocol 2 starts with a snapshot, the following moves are sent as changes
+                snapshot = Game.find(gameId).getSnapshot() if self.protocolVersion >= 2 else None
+            except Exception as e:
+                return self.error(action, "game not found", msgId, arguments)
             # try to subscribe to the game, respond with an error if it fails
-            if not gameSubscriptions.add(arguments["gameId"], msgId, self):
+            if not gameSubscriptions.add(gameId, msgId, self):
                 return self.error(action, "failed to subscribe to game", msgId, arguments)
             # respond with success
-            return self.send(action, {"gameId":arguments["gameId"]}, msgId)
+            return self.send(action, {"gameId":gameId, "snapshot":snapshot} if snapshot else {"gameId":gameId}, msgId)
+
+        # get a new snapshot of a game, e.g. if a client missed a move (gap in seq)
+        if action == "resyncGame":
+            # verify that gameId is in arguments
+            if "gameId" not in arguments:
+                return self.error(action, "parameter not given: gameId", msgId, arguments)
+            try:
+                snapshot = Game.find(int(arguments["gameId"])).getSnapshot()
+            except Exception as e:
+                return self.error(action, "game not found", msgId, arguments)
+            return self.send(action, snapshot, msgId)
         
         # unsubscribe from a game
         if action == "unsubscribeGame":
@@ -640,7 +1020,7 @@ class WebSocket(WebSocketHandler):
             if "gameId" not in arguments:
                 return self.error(action, "parameter not given: gameId", msgId, arguments)
             # try to unsubscribe from the game, respond with an error if it fails
-            if not gameSubscriptions.remove(self, arguments["gameId"]):
+            if not gameSubscriptions.remove(self, int(arguments["gameId"])):
                 return self.error(action, "failed to unsubscribe from game", msgId, arguments)
             # respond with success
             return self.send(action, {"gameId":arguments["gameId"]}, msgId) 
@@ -650,12 +1030,10 @@ class WebSocket(WebSocketHandler):
             # verify that gameId is in arguments
             if "gameId" not in arguments:
                 return self.error(action, "parameter not given: gameId", msgId, arguments)
-            # find the game
-            game = Game.find(arguments["gameId"])
-            # get the games data
-            data = game.getGameInfo()
-            # send the data
-            return self.send(action, data, msgId)
+            # find the game and encode its data (on the read replica if the socket didn't just make a move)
+            encoded = readRouter.read(db.session, ("socket", id(self)), lambda: responses.encodeGameInfo(Game.find(arguments["gameId"]).getGameInfo()))
+            # send the games data
+            return self.sendEncoded(action, encoded, msgId)
         
         # make a move
         if action == "makeMove":
@@ -679,34 +1057,106 @@ class WebSocket(WebSocketHandler):
                 return self.error(action, "Game finished, no moves allowed", msgId, arguments)
             try:
                 # make the move
-                db.session.add(Move(game.gameId, int(arguments["movePosition"]), username))
+                move = Move(game.gameId, int(arguments["movePosition"]), username)
+                db.session.add(move)
                 # commit the move
                 db.session.commit()
             except Exception as e:
-                app.logger.error(e)
+                log.exception("failed to make move", gameId=game.gameId, position=arguments.get("movePosition"), user=username)
                 return self.error(action, "failed to make move", msgId, arguments)
             # respond with success
             self.send(action, {"success": True}, msgId)
-            # broadcast the new game data
-            gameSubscriptions.broadcastState(game.gameId)
-            # re-calculate games state after commit of move
-            game.determineState()
+            # re-calculate games state after commit of move and broadcast the move (with the new state of the game)
+            determineAndBroadcast(game, move)
             # ask the bot to make a move
             makeBotMove(game.gameId)
             return 
+
+        # wait for another player, both get "matchFound" with the new game
+        if action == "findMatch":
+            try:
+                username = Session.authenticateToken(arguments["token"]) if "token" in arguments else None
+            except Exception as e:
+                username = None
+            if not username:
+                return self.error(action, "authentication failed", msgId, arguments)
+            return self.findMatch(username, msgId)
+
+        # leave the matchmaking queue
+        if action == "cancelMatch":
+            try:
+                username = Session.authenticateToken(arguments["token"]) if "token" in arguments else None
+            except Exception as e:
+                username = None
+            if not username:
+                return self.error(action, "authentication failed", msgId, arguments)
+            return self.send(action, {"cancelled": matchmakingQueue.cancel(username)}, msgId)
         
+        # follow the events of all games (or of the games of some players), replays the ones missed since a seq
+        if action == "subscribeLobby":
+            players = arguments.get("players")
+            types = arguments.get("types")
+            if players is not None and (not isinstance(players, list) or len(players) > 100):
+                return self.error(action, "players has to be a list of at most 100 usernames", msgId, arguments)
+            if types is not None and (not isinstance(types, list) or not set(types) <= set(lobby.TYPES)):
+                return self.error(action, f"types has to be a list of {lobby.TYPES}", msgId, arguments)
+            since = arguments.get("since")
+            if since is not None and type(since) is not int:
+                return self.error(action, "since has to be the seq of an event", msgId, arguments)
+            state, missed = lobbyFeed.subscribe(self, msgId, players, types, arguments.get("epoch"), since)
+            self.send(action, state, msgId)
+            for encoded in missed:
+                self.sendEncoded("lobby", encoded, msgId)
+            return
+
+        # stop following the lobby
+        if action == "unsubscribeLobby":
+            return self.send(action, {"unsubscribed": lobbyFeed.remove(self)}, msgId)
+
         # get a list of all commands
         if action == "help":
-            self.send(action, {"makeMove":{"args":["gameId", "movePosition", "?token", "?gameKey"], "desc":"makes a move on a certain game at the given position"}, "viewGame":{"args":["gameId"], "desc":"returns all the moves made on a certain game and its state"}, "ping":{"args":[], "desc":"returns \"pong\", use this to test the connection and its speed"}}, msgId)
+            self.send(action, {"makeMove":{"args":["gameId", "movePosition", "?token", "?gameKey"], "desc":"makes a move on a certain game at the given position"}, "viewGame":{"args":["gameId"], "desc":"returns all the moves made on a certain game and its state"}, "ping":{"args":[], "desc":"returns \"pong\", use this to test the connection and its speed"}, "negotiate":{"args":["versions", "?batching"], "desc":"chooses the highest supported protocol version of the given ones. version 2 sends a snapshot on subscribeGame and only the changes (\"move\" with a seq) after that. with batching, messages of the same tick are sent as one json array"}, "shutdown":{"args":[], "desc":"sent by the server before it restarts and closes the socket (1012), reconnect after reconnectAfter seconds"}, "resync":{"args":[], "desc":"sent by the server after messages were dropped because the client was too slow, contains the gameIds to get again (resyncGame) and whether to subscribe to the lobby again (with since)"}, "subscribeGame":{"args":["gameId"], "desc":"sends updates of a game until unsubscribeGame"}, "unsubscribeGame":{"args":["gameId"], "desc":"stops the updates of a game"}, "resyncGame":{"args":["gameId"], "desc":"returns a snapshot of a game with its seq, use this if a change was missed (protocol 2)"}, "findMatch":{"args":["token"], "desc":"waits for another player. both players get \"matchFound\" with the new game and are subscribed to it"}, "cancelMatch":{"args":["token"], "desc":"stops waiting for another player"}, "subscribeLobby":{"args":["?players", "?types", "?epoch", "?since"], "desc":"sends the events of all games (\"lobby\" with a seq): created, started, move and finished, only of the games of the given players and of the given types. with the epoch and seq of the last event, the missed events are sent again (or reset is true if they are not known anymore)"}, "unsubscribeLobby":{"args":[], "desc":"stops the events of the lobby"}}, msgId)
             return 
 
         # respond with an error that the action is not recognized
         return self.error(action, "unknown action. send {\"action\"=\"help\"} to recieve docs", msgId, arguments)
 
+    # pairs the user with the player that waited the longest, or queues it
+    def findMatch(self, username, msgId):
+        opponent = matchmakingQueue.enqueue(username, self, msgId)
+        # the socket of the opponent may have closed without leaving the queue
+        while opponent is not None and opponent.socket not in WebSocket.connections:
+            opponent = matchmakingQueue.enqueue(username, self, msgId)
+        if opponent is None:
+            return self.send("findMatch", {"queued": True, "waiting": len(matchmakingQueue)}, msgId)
+        try:
+            # the player that waited starts
+            game = Game.createMatch(opponent.username, username)
+        except Exception as e:
+            log.error("failed to create match", error=e)
+            db.session.rollback()
+            matchmakingQueue.add(opponent, first=True)
+            return self.error("findMatch", "failed to create game", msgId)
+        # both players follow the game and get its id (as they would by startNewGame and joinGame)
+        for (socket, socketMsgId, player) in [(opponent.socket, opponent.msgId, opponent.username), (self, msgId, username)]:
+            gameSubscriptions.add(game.gameId, socketMsgId, socket)
+            socket.send("matchFound", {"gameId": game.gameId, "gameIdHex": game.idToHexString(), "attacker": game.attacker, "defender": game.defender, "opponent": game.defender if player == game.attacker else game.attacker}, socketMsgId)
+
     # on close unsubsribe from all subscribed games
     def on_close(self):
+        self.outbox.closed = True
+        # the reaper may have removed the connection already
+        if self in WebSocket.connections:
+            WebSocket.connections.discard(self)
+            WS_CONNECTIONS.dec()
         gameSubscriptions.remove(self)
-        print("Socket closed.")
+        lobbyFeed.remove(self)
+        matchmakingQueue.cancelSocket(self)
+        log.sampled(logging.DEBUG, "socket closed")
+
+    # answer to the pings of the server (websocket_ping_interval), the client is still there
+    def on_pong(self, data):
+        self.lastActivity = time.monotonic()
 
     # send an error message to the client
     def error(self, action, data, msgId, arguments = {}):
@@ -714,8 +1164,91 @@ class WebSocket(WebSocketHandler):
 
     # send a message to the client
     def send(self, action, data, msgId, error=False):
-        message = {"action":action, "success": False, "error":data, "msgId":msgId} if error else {"action":action, "success":True, "data":data, "msgId":msgId}
-        self.write_message(json.dumps(message))
+        self.outbox.put(responses.encodeMessage(action, responses.dumps(data), msgId, error))
+
+    # send data that is encoded already (e.g. once for all subscribers of a broadcast)
+    def sendEncoded(self, action, encodedData, msgId, error=False):
+        self.outbox.put(responses.encodeMessage(action, encodedData, msgId, error))
+
+    # tell the client that messages were dropped (because it was too slow), it should get the subscribed games again
+    def resync(self):
+        gameIds = [gameId for gameId, subscribers in gameSubscriptions.subscriptions.items() if any(socket is self for socket, _ in subscribers)]
+        # a socket of the lobby should subscribe again with the seq of the last event it got
+        self.send("resync", {"gameIds":gameIds, "lobby":self in lobbyFeed}, None)
+
+# closes connections that did not send anything (not even a pong) for WS_IDLE_TIMEOUT seconds and removes
+# subscriptions of sockets that are not open anymore, called periodically by the IOLoop
+def reapConnections():
+    now = time.monotonic()
+    idleTimeout = float(os.environ.get("WS_IDLE_TIMEOUT", 120))
+    for socket in list(WebSocket.connections):
+        if idleTimeout > 0 and now - socket.lastActivity > idleTimeout:
+            WS_REAPED.inc(reason="idle")
+            # a half-open connection never answers the close, so forget it right away
+            WebSocket.connections.discard(socket)
+            WS_CONNECTIONS.dec()
+            gameSubscriptions.remove(socket)
+            lobbyFeed.remove(socket)
+            socket.close(1001, "idle")
+    # subscriptions of closed sockets
+    for subscribers in list(gameSubscriptions.subscriptions.values()):
+        for socket in {socket for (socket, _) in subscribers if socket not in WebSocket.connections}:
+            WS_REAPED.inc(reason="closed")
+            gameSubscriptions.remove(socket)
+    for socket in [socket for socket in lobbyFeed.subscribers if socket not in WebSocket.connections]:
+        WS_REAPED.inc(reason="closed")
+        lobbyFeed.remove(socket)
+
+# start measuring the request
+@app.before_request
+def startRequestMetrics():
+    g.requestScope = metrics.RequestScope()
+
+# all routes that use the database are POST, they are answered with 503 until the database is ready (and once the server stops)
+@app.before_request
+def requireReady():
+    if request.method == "POST" and not readiness.ready():
+        return jsonResponse({"success":False, "error":readiness.reason()}, 503, {"Retry-After": "1"})
+
+# the client of a request for the read replica: its session token or, without one, its ip
+def readClient():
+    token = request.headers.get("Authorisation")
+    return ("token", token) if token else ("ip", request.remote_addr)
+
+# commits of the request are recorded for its client, which reads from the primary for a while after
+@app.before_request
+def setReadClient():
+    g.readClient = readClient()
+    readRouter.setClient(db.session, g.readClient)
+
+# keys of the rate limits of a request: the ip, and the session token except for login/signup. those are only
+# limited per ip, a bucket of the submitted username would let anyone lock its owner out
+def rateLimitKeys(action):
+    if action in ("login", "signup"):
+        return [("ip", request.remote_addr)]
+    return [("ip", request.remote_addr), ("user", request.headers.get("Authorisation"))]
+
+# answers the expensive routes with 429 if the server is overloaded or the client is over its budget. only the
+# POST requests count, page loads of the SPA fallback and CORS preflights share the paths
+@app.before_request
+def admitRequest():
+    action = request.path.strip("/")
+    if request.method != "POST" or action not in rateLimiter.limits:
+        return
+    if admission.check(action, request.environ.get(ratelimit.QUEUE_DELAY)):
+        return jsonResponse({"success":False, "error":"server busy"}, 429, {"Retry-After": "1"})
+    retryAfter = rateLimiter.hit(action, rateLimitKeys(action))
+    if retryAfter:
+        return jsonResponse({"success":False, "error":"rate limited", "retryAfter":round(retryAfter, 1)}, 429, {"Retry-After": str(int(retryAfter) + 1)})
+
+# observe the duration and the queries of the request
+@app.after_request
+def recordRequestMetrics(response):
+    requestScope = g.pop("requestScope", None)
+    if requestScope:
+        route = request.endpoint or "unmatched"
+        requestScope.finish(HTTP_DURATION, f"http:{route}", route=route, method=request.method, status=response.status_code)
+    return response
 
 # set headers for the cors (used for development, but doesn't matter if present in production)
 @app.after_request
@@ -736,10 +1269,10 @@ def appLoader(path):
     else:
         try:
             # serve the file
-            return send_from_directory('/build/', path)
+            return send_from_directory(BUILD_DIR, path)
         except:
             # serve the index.html file if the file doesn't exist
-            return send_from_directory('/build/', 'index.html')
+            return send_from_directory(BUILD_DIR, 'index.html')
 
 # authentication
 
@@ -756,7 +1289,7 @@ def getsalt():
     except:
         response["success"] = False
     # return the response
-    return json.dumps(response)
+    return jsonResponse(response)
 
 # returns the token for a user
 @app.route("/login", methods=["POST"])
@@ -767,7 +1300,7 @@ def loginSubmission():
     except:
         response = {"success": False}
     # return the response
-    return json.dumps(response)
+    return jsonResponse(response)
 
 # creates an account
 @app.route("/signup", methods=["POST"])
@@ -786,10 +1319,10 @@ def signupSubmission():
             # re-raise the exception
             raise Exception(e)
     except Exception as e:
-        app.logger.error(e)
+        log.exception("signup failed", username=request.form.get("username"))
         response = {"success": False}
     # return the response
-    return json.dumps(response)
+    return jsonResponse(response)
 
 # join the competition
 @app.route("/joinCompetition", methods=["POST"])
@@ -801,10 +1334,10 @@ def joinCompetition():
         sendMail(User.find(competition.username).one().email, "Confirmation", EMAIL_TEMPLATES["joinedcompetition"], {"username":competition.username, "domain":os.environ["DOMAIN"]})
         response = {"success":True}
     except Exception as e:
-        app.logger.error(e)
+        log.exception("failed to join the competition", username=request.form.get("username"))
         response = {"success": False}
     # return the response
-    return json.dumps(response)
+    return jsonResponse(response)
 
 # DEPRECATED
 # @app.route("/games/<gameId>", methods=["POST"])
@@ -819,9 +1352,34 @@ def joinCompetition():
 #         app.logger.error(e)
 #     return json.dumps(response)
 
+# answers with the cached response of an endpoint or builds (and caches) it. answers with 304 if the
+# client already has the current version (If-None-Match), errors are not cached
+def cachedResponse(namespace, key, build, encode=responses.dumps):
+    # a client that just wrote doesn't get a response that may have been built before its change was replicated
+    entry = None if readRouter.recentlyWrote(g.readClient) else responseCache.get(namespace, key)
+    if entry is None:
+        # built from the read replica if the client may use it, from the primary if it fails there
+        response, target = readRouter.readFrom(db.session, g.readClient, build, lambda response: response["success"])
+        if not response["success"]:
+            return jsonResponse(response)
+        # only responses of the primary are cached: the replica may not have the change that invalidated the
+        # entry yet, its response would be served (and confirmed with 304) until the entry expires
+        if target == "replica":
+            entry = CachedResponse(encode(response), 0)
+        else:
+            entry = responseCache.set(namespace, key, encode(response))
+    if entry.matches(request.headers.get("If-None-Match")):
+        return Response(status=304, headers={"ETag": entry.etag, "Cache-Control": "no-cache"})
+    return jsonResponse(entry.body, headers={"ETag": entry.etag, "Cache-Control": "no-cache"})
+
 # get a list of all games
 @app.route("/games", methods=["POST"])
 def getGameList():
+    # answer from the cache if no game changed since the last request with the same cursor
+    return cachedResponse("games", request.form.get("gameId", "inf"), buildGameList, responses.encodeGameList)
+
+# builds the response of /games
+def buildGameList():
     response = {"success":True}
     # get the limit
     LIMIT = os.environ["GAMELIST_LIMIT"]
@@ -831,49 +1389,64 @@ def getGameList():
         # get the id of the last loaded game from the request. only older games will be loaded
         lastGameId = float(request.form["gameId"] if "gameId" in request.form else "inf")
         # get the games
-        for game in db.session.query(Game).filter(Game.gameId < lastGameId).order_by(Game.gameId.desc()).limit(LIMIT).all():
+        hotGames = db.session.query(Game).filter(Game.gameId < lastGameId).order_by(Game.gameId.desc()).limit(LIMIT).all()
+        archivedGames = db.session.query(ArchivedGame).filter(ArchivedGame.gameId < lastGameId).order_by(ArchivedGame.gameId.desc()).limit(LIMIT).all()
+        for game in ArchivedGame.merge(hotGames, archivedGames, LIMIT):
             # add the game to the array
             games.append(game.getGameInfo())
         # return the games
         response["data"]=games
     except Exception as e:
         response["success"]=False
-        app.logger.error(e)
+        log.exception("failed to build the game list", lastGameId=request.form.get("gameId"))
     # return the response
-    return json.dumps(response)
+    return response
 
 # get a list of all USERS
 @app.route("/users", methods=["POST"])
 def getUserList():
+    # answer from the cache if no game finished and no user signed up since the last request
+    return cachedResponse("users", "all", buildUserList, responses.encodeUserList)
+
+# the columns of games (and archived games) the leaderboard needs
+ALL_GAMES_SQL = """(SELECT attacker, defender, winner, "gameFinished" FROM games UNION ALL SELECT attacker, defender, winner, TRUE AS "gameFinished" FROM archived_games)"""
+
+# builds the response of /users
+def buildUserList():
     response = {"success": True}
     LIMIT = os.environ["GAMELIST_LIMIT"]
     try:
         # TODO: translate it to sqlalchemy-stuff later 
         # get the users and their stats
-        userList = db.session.execute("""SELECT users.username, COALESCE(wincount, 0) AS wincount, COALESCE(defeatcount, 0) AS defeatcount, COALESCE(drawcount, 0) AS drawcount from users
+        userList = db.session.execute(db.text(f"""SELECT users.username, COALESCE(wincount, 0) AS wincount, COALESCE(defeatcount, 0) AS defeatcount, COALESCE(drawcount, 0) AS drawcount from users
 LEFT JOIN (
-    SELECT username, COUNT(games.winner) AS wincount FROM users RIGHT JOIN games ON users.username = games.attacker OR users.username = games.defender WHERE games.winner = users.username AND games."gameFinished" IS TRUE GROUP BY username
+    SELECT username, COUNT(games.winner) AS wincount FROM users RIGHT JOIN {ALL_GAMES_SQL} AS games ON users.username = games.attacker OR users.username = games.defender WHERE games.winner = users.username AND games."gameFinished" IS TRUE GROUP BY username
     ) as w on w.username = users.username
 LEFT JOIN(
-    SELECT username, COUNT(games.winner) AS defeatcount FROM users RIGHT JOIN games ON users.username = games.attacker OR users.username = games.defender WHERE games.winner != users.username AND games."gameFinished" IS TRUE GROUP BY username
+    SELECT username, COUNT(games.winner) AS defeatcount FROM users RIGHT JOIN {ALL_GAMES_SQL} AS games ON users.username = games.attacker OR users.username = games.defender WHERE games.winner != users.username AND games."gameFinished" IS TRUE GROUP BY username
     ) as d on d.username = users.username
 LEFT JOIN(
-    SELECT username, COUNT(games.*) AS drawcount FROM users RIGHT JOIN games ON users.username = games.attacker OR users.username = games.defender WHERE games.winner IS NULL AND games."gameFinished" IS TRUE GROUP BY username
+    SELECT username, COUNT(games.*) AS drawcount FROM users RIGHT JOIN {ALL_GAMES_SQL} AS games ON users.username = games.attacker OR users.username = games.defender WHERE games.winner IS NULL AND games."gameFinished" IS TRUE GROUP BY username
     ) as e on e.username = users.username
     
-ORDER BY wincount DESC NULLS LAST;""").all()
+ORDER BY wincount DESC NULLS LAST;""")).all()
         # create an array of users
         userData = [{"username":user.username, "winCount":user.wincount, "defeatCount":user.defeatcount, "drawCount":user.drawcount} for user in userList]
         response["data"] = userData
     except Exception as e:
         response["success"] = False
-        app.logger.error(e)
+        log.exception("failed to build the user list")
     # return the response
-    return json.dumps(response)
+    return response
 
 # get all games played by a user
 @app.route("/users/<username>", methods=["POST"])
 def returnUserPage(username):
+    # answer from the cache if no game changed since the last request for this user with the same cursor
+    return cachedResponse("userGames", (username, request.form.get("gameId", "inf")), lambda: buildUserPage(username))
+
+# builds the response of /users/<username>
+def buildUserPage(username):
     response = {"success":True}
     # get the limit
     LIMIT = os.environ["GAMELIST_LIMIT"]
@@ -891,9 +1464,42 @@ def returnUserPage(username):
         response["data"]={"user":user.username, "games": games}
     except Exception as e:
         response["success"] = False
-        app.logger.error(e)
+        log.exception("failed to build the user page", username=username, lastGameId=request.form.get("gameId"))
+    # return the response
+    return response
+
+# the players ordered by their rating: the top `limit` from `offset` on and, with `username`, the rank of that player
+@app.route("/ranking", methods=["POST"])
+def getRanking():
+    response = {"success":True}
+    try:
+        # answered from the rank index in memory, not the database
+        limit = min(int(request.form.get("limit", os.environ["GAMELIST_LIMIT"])), 100)
+        offset = max(int(request.form.get("offset", 0)), 0)
+        data = {"players": len(ratings.index), "top": ratings.index.top(limit, offset)}
+        if "username" in request.form:
+            rank = ratings.index.rank(request.form["username"])
+            data["user"] = ratings.index.entry(request.form["username"], rank) if rank else None
+        response["data"] = data
+    except Exception as e:
+        response["success"] = False
+        log.exception("failed to answer the ranking", username=request.form.get("username"))
+    # return the response
+    return jsonResponse(response)
+
+# the stats of a position (`board`: the game field as json, like in /viewGame) and of the positions after each
+# possible next move
+@app.route("/positions", methods=["POST"])
+def getPositionStats():
+    response = {"success":True}
+    try:
+        board = json.loads(request.form.get("board", "[0, 0, 0, 0, 0, 0, 0, 0, 0]"))
+        response["data"] = readRouter.read(db.session, g.readClient, lambda: positionStats.children(db.session, board))
+    except Exception as e:
+        response["success"] = False
+        log.exception("failed to answer the position stats", board=request.form.get("board"))
     # return the response
-    return json.dumps(response)
+    return jsonResponse(response)
 
 # check if the credentials are correct
 @app.route("/checkCredentials", methods=["POST"])
@@ -904,26 +1510,26 @@ def checkCredentials():
         if(username == None):
             raise Exception("invalid token")
         response = {"success": True, "data": username}
-        return json.dumps(response)
+        return jsonResponse(response)
     except Exception as e:
-        app.logger.error(e)
+        log.exception("failed to check the credentials")
         response = {"success": False}
-        return json.dumps(response)
+        return jsonResponse(response)
 
 # start a new game
 @app.route("/startNewGame", methods=["POST"])
 def startNewGame():
     try:
-        app.logger.error("starting new game")
+        log.debug("starting new game")
         # create a game from the request
         game = Game.createFromRequest(request)
         # transform it to a json response
         response = game.toResponse()
-        return json.dumps(response)
+        return jsonResponse(response)
     except Exception as e:
-        app.logger.error(e)
+        log.exception("failed to start a new game", remote=request.remote_addr)
         response={"success": False}
-        return json.dumps(response)
+        return jsonResponse(response)
 
 # join a game
 @app.route("/joinGame", methods=["POST"])
@@ -933,11 +1539,11 @@ def joinGame():
         game = Game.join(request)
         # transform it to a json response
         response = game.toResponse()
-        return json.dumps(response)
+        return jsonResponse(response)
     except Exception as e:
-        app.logger.error(e)
+        log.exception("failed to join the game", gameId=request.form.get("gameId"))
         response={"success": False}
-        return json.dumps(response)
+        return jsonResponse(response)
 
 # DEPRECATED: use WebSocket instead
 # make a move
@@ -957,46 +1563,81 @@ def makeMove():
         if game.gameFinished:
             raise ValueError("Game finished, no moves allowed")
         # add a new move with the data from the request to the database
-        db.session.add(Move(game.gameId, int(request.form["movePosition"]), username))
+        move = Move(game.gameId, int(request.form["movePosition"]), username)
+        db.session.add(move)
         # commit the changes
         db.session.commit()
-        # re-calculate games state after commit of move
-        game.determineState()
-        # send an update to all subscribers
-        gameSubscriptions.broadcastState(game.gameId)
+        # re-calculate games state after commit of move and send the move to all subscribers
+        determineAndBroadcast(game, move)
         # if game is not finished and bot is attacker or defender, let RL-A decide on the next move
         makeBotMove(game.gameId)
         response = {"success": True}
     except Exception as e:
         # app.logger.error(traceback.format_exc())
         response = {"success": False}
-    return json.dumps(response)
+    return jsonResponse(response)
 
 # view a game
 @app.route("/viewGame", methods=["POST"])
 def sendGameInfo():
     response = {"success":True}
     try:
-        # find the game and get its gameInfo
-        response["data"] = Game.find(request.form["gameId"]).getGameInfo()
+        # find the game and get its gameInfo (from the read replica if the client may use it)
+        response["data"] = readRouter.read(db.session, g.readClient, lambda: Game.find(request.form["gameId"]).getGameInfo())
     except Exception as e:
-        app.logger.error(e)
+        log.exception("failed to view the game", gameId=request.form.get("gameId"))
         response["success"] = False
     # return the response
-    return json.dumps(response)
+    return jsonResponse(response)
 
 # get the version of the Backend
 @app.route("/version", methods=["POST"])
 def getVersion():
     response = {"success":True}
     try:
-        # get the version from git
-        remoteVersion = os.popen("git ls-remote origin -h HEAD").read().rstrip()
-        # return the data and find out if the newest version is the same as the running version
-        response["data"]={"versionHash":versionHash, "upToDate":remoteVersion.startswith(versionHash)}
+        # return the known versions, the remote one is refreshed in the background
+        response["data"]=versionChecker.toDict()
     except Exception as e:
         response["success"] = False
-    return json.dumps(response)
+    return jsonResponse(response)
+
+# start the sampling profiler for some seconds (admins only)
+@app.route("/admin/profiler/start", methods=["POST"])
+def startProfiler():
+    if not isAdminRequest(request):
+        return jsonResponse({"success": False}, 403)
+    # limit the duration to 10 minutes and the interval to 1ms
+    try:
+        seconds = min(float(request.form.get("seconds", os.environ.get("PROFILE_SECONDS", 30))), 600)
+        interval = max(float(request.form.get("interval", 0.01)), 0.001)
+    except ValueError:
+        return jsonResponse({"success": False})
+    if not seconds > 0:
+        return jsonResponse({"success": False})
+    started = samplingProfiler.start(seconds, interval)
+    return jsonResponse({"success": started, "data": samplingProfiler.status()})
+
+# stop the sampling profiler and return the collapsed stacks (admins only)
+@app.route("/admin/profiler/stop", methods=["POST"])
+def stopProfiler():
+    if not isAdminRequest(request):
+        return jsonResponse({"success": False}, 403)
+    samplingProfiler.stop()
+    return Response(samplingProfiler.lastResult or "", content_type="text/plain; charset=utf-8")
+
+# get the state of the profiler and the collapsed stacks of the last run (admins only)
+@app.route("/admin/profiler", methods=["POST"])
+def getProfilerResult():
+    if not isAdminRequest(request):
+        return jsonResponse({"success": False}, 403)
+    return jsonResponse({"success": True, "data": {**samplingProfiler.status(), "collapsed": samplingProfiler.lastResult}})
+
+# get the longest stalls of the IOLoop with the stack that blocked it (admins only)
+@app.route("/admin/blocked", methods=["POST"])
+def getBlockedLoopReport():
+    if not isAdminRequest(request):
+        return jsonResponse({"success": False}, 403)
+    return jsonResponse({"success": True, "data": blockedLoopWatchdog.report() if blockedLoopWatchdog else None})
 
 # for .well-known stuff (e.g. acme-challenges for ssl-certs)
 # 
@@ -1006,16 +1647,50 @@ def getVersion():
 def wellKnown(filename):
     return send_from_directory("/.well-known", filename)
 
+# metrics in the prometheus text format (see https://prometheus.io/docs/instrumenting/exposition_formats/)
+@app.route("/metrics", methods=["GET"])
+def metricsEndpoint():
+    return Response(metrics.registry.render(), content_type=metrics.CONTENT_TYPE)
+
 # robots.txt (see https://www.robotstxt.org/)
 @app.route("/robots.txt")
 def robots():
     return "User-agent: *\nDisallow: *"
 
 
+# the steps of a graceful shutdown (see shutdown.py) of the http servers
+def addShutdownSteps(gracefulShutdown, servers):
+    # stop accepting connections (/readyz answers 503 from then on)
+    def stopListening():
+        readiness.stop()
+        for server in servers:
+            server.stop()
+    gracefulShutdown.add("listen", stopListening)
+    # tell the websockets when to reconnect (a random delay of up to SHUTDOWN_RECONNECT_JITTER seconds, so the
+    # clients don't all come back at the same moment) and close them with 1012 (service restart)
+    async def closeWebSockets():
+        jitter = float(os.environ.get("SHUTDOWN_RECONNECT_JITTER", 5))
+        for socket in list(WebSocket.connections):
+            socket.send("shutdown", {"reason":"restart", "reconnectAfter":round(random.uniform(0, jitter), 2)}, None)
+            socket.outbox.flush()
+            socket.close(1012, "service restart")
+        # the clients answer the close, on_close removes them
+        while WebSocket.connections:
+            await tornado.gen.sleep(0.05)
+    gracefulShutdown.add("websockets", closeWebSockets)
+    # the requests on open connections are finished (flask handles them on the IOLoop, so a move is either
+    # committed and answered or not started), then the connections are closed
+    gracefulShutdown.add("http", lambda: tornado.gen.multi([server.close_all_connections() for server in servers]))
+    # archive, replica check, digests that are being sent
+    gracefulShutdown.add("background", gracefulShutdown.waitForBackground)
+    # send the digests of all players now instead of after their window, even if the deadline was reached
+    gracefulShutdown.add("mails", lambda: tornado.ioloop.IOLoop.current().run_in_executor(None, functools.partial(mailDigests.flush, everything=True)), always=True)
+
 # start the server
 if __name__ == "__main__":   
-    # versionHash = os.popen("git rev-parse HEAD").read().rstrip()
-    versionHash = "NONE"
+    # the websocket handlers and the callbacks of the IOLoop run outside of flask's requests, they use the
+    # context of the main thread (Flask-SQLAlchemy 3 needs one to reach the database)
+    app.app_context().push()
 
     # add sample data for testing
     def addSampleData(dataCount=0):
@@ -1041,57 +1716,151 @@ if __name__ == "__main__":
             db.session.commit()  
         return
 
-    # returns true if server is reachable
-    def serverUp():
-        try:
-            db.create_all()
-            print("database initialized")
-            return True
-        except Exception as e:
-            print("Failed to initialize")
-            print(e)
-            return False
+    # creates the tables, the bot user and the sample data, returns false if the database is not reachable (yet).
+    # runs in a thread of the executor while the server already listens
+    def initDatabase():
+        with app.app_context():
+            try:
+                db.create_all()
+                # the heartbeat of the read replica
+                readRouter.createTables(db.engine)
+                print("database initialized")
+            except Exception as e:
+                print("Failed to initialize")
+                print(e)
+                return False
 
-    app.debug = True
-    
-    # wait for database to be reachable before starting flask server
-    print("waiting for server to start")
-    while not serverUp():
-        print("databaseserver unreachable, waiting 5s")
-        time.sleep(5)
+            # add bot-user for RL-A
+            try:
+                log.info("adding the bot user")
+                if User.find(os.environ["BOT_USERNAME"]).count() == 0:
+                    db.session.add(User(os.environ["BOT_USERNAME"], os.environ["BOT_EMAIL"], secrets.token_hex(256//2), secrets.token_hex(256//2)))
+                    db.session.commit()
+                    log.info("bot user added")
+                else:
+                    log.info("bot user already exists")
+                # print(db.session.query(User).all())
+            except Exception as e:
+                log.exception("failed to add the bot user")
+                pass
 
-    # add bot-user for RL-A
-    try:
-        app.logger.info("adding a bot user")
-        if User.find(os.environ["BOT_USERNAME"]).count() == 0:
-            db.session.add(User(os.environ["BOT_USERNAME"], os.environ["BOT_EMAIL"], secrets.token_hex(256//2), secrets.token_hex(256//2)))
-            db.session.commit()
-            app.logger.info("bot user added")
-        else:
-            app.logger.info("bot user already exists")
-        # print(db.session.query(User).all())
-    except Exception as e:
-        app.logger.info("failed to add bot user")
-        pass
+            try:
+                print("adding sample data")
+                addSampleData(0)
+            except Exception as e:
+                print(e)
 
-    try:
-        print("adding sample data")
-        addSampleData(0)
-    except Exception as e:
-        print(e)
+            # the ranks are answered from memory
+            ratings.load(db.session)
+            return True
 
-    print("server reached and initialized, starting web-service")
+    # waits for the database with exponential backoff: from DB_WAIT_INITIAL seconds up to DB_WAIT_MAX between attempts
+    def databaseDelays():
+        return startup.backoffDelays(float(os.environ.get("DB_WAIT_INITIAL", 0.1)), float(os.environ.get("DB_WAIT_MAX", 5)))
+
+    # moves finished games older than ARCHIVE_AFTER_DAYS to archived_games, reports the latency of the queries
+    # that scan games and moves before and after
+    archiver = archive.Archiver(db, Game, Move, ArchivedGame, {
+        "gameList": lambda: db.session.query(Game).order_by(Game.gameId.desc()).limit(os.environ["GAMELIST_LIMIT"]).all(),
+        "userGames": lambda: User.find(os.environ["BOT_USERNAME"]).one().getGames(os.environ["GAMELIST_LIMIT"], float("inf")),
+        "userList": buildUserList,
+        "moveIndex": lambda: db.session.query(Move).order_by(Move.gameId.desc(), Move.moveIndex.desc()).first(),
+    }, log)
+    ARCHIVE_AFTER_DAYS = float(os.environ.get("ARCHIVE_AFTER_DAYS", 30))
+    ARCHIVE_BATCH_SIZE = int(os.environ.get("ARCHIVE_BATCH_SIZE", 500))
+
+    # `python main.py archive [days] [--vacuum-full]` archives once and prints the report instead of starting the server
+    if len(sys.argv) > 1 and sys.argv[1] == "archive":
+        for delay in databaseDelays():
+            if initDatabase():
+                break
+            time.sleep(delay)
+        days = float(sys.argv[2]) if len(sys.argv) > 2 and not sys.argv[2].startswith("--") else ARCHIVE_AFTER_DAYS
+        print(json.dumps(archiver.run(days, ARCHIVE_BATCH_SIZE, vacuumFull="--vacuum-full" in sys.argv), indent=2))
+        sys.exit(0)
+
+    # the players and the winner of all finished games (and archived games), oldest first
+    def finishedGames():
+        rows = union_all(
+            select(Game.gameId.label("gameid"), Game.attacker, Game.defender, Game.winner).where(Game.gameFinished == True),
+            select(ArchivedGame.gameId, ArchivedGame.attacker, ArchivedGame.defender, ArchivedGame.winner),
+        ).subquery()
+        for row in db.session.execute(select(rows).order_by(rows.c.gameid).execution_options(yield_per=5000)):
+            yield row[1:]
+
+    # `python main.py ratings rebuild` recomputes all ratings from the finished games instead of starting the server
+    if len(sys.argv) > 2 and sys.argv[1:3] == ["ratings", "rebuild"]:
+        for delay in databaseDelays():
+            if initDatabase():
+                break
+            time.sleep(delay)
+        print(json.dumps(ratings.rebuild(db.session, finishedGames()), indent=2))
+        sys.exit(0)
+
+    # the moves ((field, 1 or -1)) and the result (1: the attacker won, -1: the defender won, 0: draw) of all finished
+    # games, streamed ordered by game
+    def finishedGameMoves():
+        def result(attacker, winner, isDraw):
+            return 0 if isDraw else 1 if winner == attacker else -1
+        rows = select(Game.gameId, Game.attacker, Game.winner, Game.isDraw, Move.moveIndex, Move.movePosition).join(Move, Move.gameId == Game.gameId).where(Game.gameFinished == True).order_by(Game.gameId, Move.moveIndex)
+        for gameId, gameRows in itertools.groupby(db.session.execute(rows.execution_options(yield_per=5000)), key=lambda row: row[0]):
+            gameRows = list(gameRows)
+            yield [(row[5], 1 if row[4] % 2 == 0 else -1) for row in gameRows], result(*gameRows[0][1:4])
+        archived = select(ArchivedGame.moves, ArchivedGame.attacker, ArchivedGame.winner, ArchivedGame.isDraw)
+        for packed, attacker, winner, isDraw in db.session.execute(archived.execution_options(yield_per=5000)):
+            yield [(field, 1 if index % 2 == 0 else -1) for index, field in enumerate(archive.unpackMoves(packed))], result(attacker, winner, isDraw)
+
+    # `python main.py positions rebuild` recomputes the position stats from the finished games instead of starting the server
+    if len(sys.argv) > 2 and sys.argv[1:3] == ["positions", "rebuild"]:
+        for delay in databaseDelays():
+            if initDatabase():
+                break
+            time.sleep(delay)
+        print(json.dumps(positionStats.rebuild(db.session, finishedGameMoves()), indent=2))
+        sys.exit(0)
+
+    # WARMUP: "background" loads the RL-A, the email templates and the build after the server started listening,
+    # "eager" before, "lazy" only on first use (the build is then served by flask)
+    WARMUP = os.environ.get("WARMUP", "background")
+
+    # read the react build into memory (precompressed), so the files can be served without flask.
+    # until it is loaded, flask serves the files from the disk
+    buildIndex = staticfiles.BuildIndex(BUILD_DIR, log, load=False)
+
+    # loads everything that is loaded lazily otherwise
+    def warmUp():
+        solver.get()
+        readiness.set("solver")
+        loadTemplates()
+        readiness.set("emailTemplates")
+        buildIndex.load(log)
+        readiness.set("build")
+    if WARMUP == "eager":
+        warmUp()
 
     print("ssl enabled:", os.environ["ENABLE_SSL"])
 
-    # create a WSGI container from flask
-    flaskApp = tornado.wsgi.WSGIContainer(app)
+    # the server listens right away, requests that need the database are answered with 503 until it is ready
+    readiness.require("database")
+
+    # create a WSGI container from flask (that tells flask how long a request waited, see admitRequest)
+    flaskApp = ratelimit.TimedWSGIContainer(app)
     container = Application([
         # when a client requests for /ws, call the websokect handler to upgrade the connection to a websocket
         (r'/ws', WebSocket),
-        # handle all other requests with flask
-        (r'.*', FallbackHandler, dict(fallback=flaskApp))
-    ])
+        # liveness and readiness for the orchestrator (and the load test), answered without flask
+        (r'/healthz', startup.HealthHandler),
+        (r'/readyz', startup.ReadyHandler, dict(readiness=readiness)),
+        # stream all games as ndjson or csv (admins only), not through flask since the WSGIContainer buffers responses
+        (r'/export/games', export.ExportHandler, dict(engine=db.engine, games=Game.__table__, moves=Move.__table__, archived=ArchivedGame.__table__, isAllowed=isAdminTornadoRequest)),
+        # serve files of the build from memory, handle all other requests with flask
+        (r'.*', staticfiles.BuildFileHandler, dict(fallback=flaskApp, index=buildIndex, isAppRoute=isAppRoute, redirectToHttps=sslEnabled()))
+    ],
+        # ping every websocket, close it if it doesn't answer in time (0 disables the pings)
+        websocket_ping_interval=float(os.environ.get("WS_PING_INTERVAL", 20)),
+        # tornado doesn't allow a timeout longer than the interval
+        websocket_ping_timeout=float(os.environ.get("WS_PING_TIMEOUT", 20)),
+    )
 
     # set up a http server and start it
     http_server = tornado.httpserver.HTTPServer(container)
@@ -1105,7 +1874,60 @@ if __name__ == "__main__":
         })
         https_server.listen(os.environ["HTTPS_PORT"])
 
+    # read the version and start checking the remote for updates
+    versionChecker.start()
+
+    # SIGUSR1 starts the sampling profiler, the result is written to PROFILE_DIR
+    signal.signal(signal.SIGUSR1, lambda signum, frame: samplingProfiler.start(float(os.environ.get("PROFILE_SECONDS", 30))))
+
+    # log the stack if the IOLoop is blocked for longer than BLOCKED_LOOP_THRESHOLD seconds
+    if float(os.environ.get("BLOCKED_LOOP_THRESHOLD", 0)) > 0:
+        blockedLoopWatchdog = profiler.BlockedLoopWatchdog(float(os.environ["BLOCKED_LOOP_THRESHOLD"]), log).start(tornado.ioloop.IOLoop.current())
+
+    # archive in the background every ARCHIVE_INTERVAL seconds (0 disables it)
+    def archiveInBackground():
+        with app.app_context():
+            archiver.run(ARCHIVE_AFTER_DAYS, ARCHIVE_BATCH_SIZE)
+    if float(os.environ.get("ARCHIVE_INTERVAL", 86400)) > 0:
+        tornado.ioloop.PeriodicCallback(lambda: serverShutdown.background(archiveInBackground), float(os.environ.get("ARCHIVE_INTERVAL", 86400)) * 1000).start()
+
+    # send the digests of the players whose window is over (in a thread, sending blocks)
+    if mailDigests.window > 0:
+        tornado.ioloop.PeriodicCallback(lambda: serverShutdown.background(mailDigests.flush), min(mailDigests.window / 4, 10) * 1000).start()
+
+    # measure the lag of the IOLoop for the admission of websocket actions
+    admission.start()
+
+    # close idle websockets and clean up the subscriptions of closed ones
+    tornado.ioloop.PeriodicCallback(reapConnections, float(os.environ.get("WS_REAP_INTERVAL", 30)) * 1000).start()
+
+    # wait for the database in the background, then the server is ready
+    async def waitForDatabase():
+        attempts = await startup.waitFor(initDatabase, databaseDelays(), log, "database")
+        readiness.set("database")
+        # measure the lag of the read replica every REPLICA_CHECK_INTERVAL seconds, it is used once the heartbeat reached it
+        if readRouter.enabled():
+            checkReplica = lambda: serverShutdown.background(readRouter.check, db.engine)
+            checkReplica()
+            tornado.ioloop.PeriodicCallback(checkReplica, float(os.environ.get("REPLICA_CHECK_INTERVAL", 5)) * 1000).start()
+        log.info("server reached and initialized", attempts=attempts, seconds=round(readiness.required["database"], 3))
+    tornado.ioloop.IOLoop.current().add_callback(waitForDatabase)
+
+    if WARMUP == "background":
+        serverShutdown.background(warmUp)
+
+    # on SIGTERM: stop accepting connections, close the websockets, finish the requests and flush the mails
+    addShutdownSteps(serverShutdown, [http_server, https_server] if sslEnabled() else [http_server])
+    serverShutdown.install()
+
     print("servers started")
     # start an IOLoop
     tornado.ioloop.IOLoop.current().start()
+    # the digests that could not be sent are lost with the process
+    if mailDigests.unsent():
+        log.warning("dropped game digests", digests=mailDigests.unsent())
+    # the threads of the work that didn't finish within SHUTDOWN_DEADLINE would keep the process alive
+    if serverShutdown.timedOut:
+        logging.shutdown()
+        os._exit(1)
     
\ No newline at end of file
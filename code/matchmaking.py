@@ -0,0 +1,72 @@
+# pairs players that are looking for a human opponent (findMatch over the websocket).
+# the queue lives in memory and is only used from the IOLoop, so pairing needs no locks: the player that
+# waited the longest is matched with the next one, enqueueing, pairing and cancelling are O(1).
+import time
+from collections import OrderedDict
+
+from metrics import registry
+
+MATCHES = registry.counter("matchmaking_matches_total", "Players paired by the matchmaking")
+WAIT_DURATION = registry.histogram("matchmaking_wait_seconds", "Time a player waited in the queue until a match was found", buckets=(0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300))
+
+# a player in the queue
+class WaitingPlayer:
+    def __init__(self, username, socket, msgId):
+        self.username = username
+        self.socket = socket
+        self.msgId = msgId
+        self.since = time.monotonic()
+
+class MatchmakingQueue:
+    def __init__(self):
+        # username => WaitingPlayer, the longest waiting first
+        self.waiting = OrderedDict()
+        # socket => username, to cancel when a socket closes
+        self.sockets = {}
+        registry.gauge("matchmaking_waiting_players", "Players waiting for a match", function=lambda: len(self.waiting))
+
+    def __len__(self):
+        return len(self.waiting)
+
+    def __contains__(self, username):
+        return username in self.waiting
+
+    # adds a player to the queue, returns the opponent (a WaitingPlayer) if there is one waiting.
+    # a player that is already waiting keeps its place but gets the updates on the new socket
+    def enqueue(self, username, socket, msgId):
+        player = self.waiting.get(username)
+        if player is not None:
+            self.sockets.pop(player.socket, None)
+            player.socket, player.msgId = socket, msgId
+            self.sockets[socket] = username
+            return None
+        if self.waiting:
+            opponent = self.waiting.popitem(last=False)[1]
+            self.sockets.pop(opponent.socket, None)
+            MATCHES.inc(2)
+            WAIT_DURATION.observe(time.monotonic() - opponent.since)
+            WAIT_DURATION.observe(0)
+            return opponent
+        self.add(WaitingPlayer(username, socket, msgId))
+        return None
+
+    # puts a player (back) into the queue, first=True puts it at the front (e.g. if its opponent was gone)
+    def add(self, player, first=False):
+        self.waiting[player.username] = player
+        self.sockets[player.socket] = player.username
+        if first:
+            self.waiting.move_to_end(player.username, last=False)
+
+    # removes a player from the queue, returns False if it wasn't waiting
+    def cancel(self, username):
+        player = self.waiting.pop(username, None)
+        if player is None:
+            return False
+        self.sockets.pop(player.socket, None)
+        return True
+
+    # removes the player of a closed socket
+    def cancelSocket(self, socket):
+        username = self.sockets.pop(socket, None)
+        if username is not None:
+            self.waiting.pop(username, None)
@@ -0,0 +1,219 @@
+# counters, gauges and histograms that can be rendered in the prometheus text format
+# (see https://prometheus.io/docs/instrumenting/exposition_formats/)
+import os, time, bisect, contextvars
+from contextlib import contextmanager
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# default buckets for durations in seconds
+DURATION_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+# buckets for the number of queries per request
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100, 250)
+
+# escapes a label value
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+# formats a number for the text format
+def formatValue(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+# base class of all metrics, stores one value per combination of labels
+class Metric:
+    type = None
+
+    def __init__(self, name, description, labelNames=()):
+        self.name = name
+        self.description = description
+        self.labelNames = tuple(labelNames)
+        self.values = {}
+
+    # returns the key of the labels, in the order of labelNames
+    def key(self, labels):
+        if not self.labelNames:
+            return ()
+        return tuple(str(labels.get(name, "")) for name in self.labelNames)
+
+    # formats the labels for the key, with additional labels (e.g. le for histograms)
+    def formatLabels(self, key, extra=()):
+        pairs = list(zip(self.labelNames, key)) + list(extra)
+        if not pairs:
+            return ""
+        return "{" + ",".join(f'{name}="{escape(value)}"' for name, value in pairs) + "}"
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} {self.type}"]
+        lines.extend(self.renderValues())
+        return lines
+
+    def renderValues(self):
+        return [f"{self.name}{self.formatLabels(key)} {formatValue(value)}" for key, value in self.values.items()]
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def get(self, **labels):
+        return self.values.get(self.key(labels), 0)
+
+class Gauge(Metric):
+    type = "gauge"
+
+    # function can be given to compute the value (without labels) when the metrics are rendered
+    def __init__(self, name, description, labelNames=(), function=None):
+        super().__init__(name, description, labelNames)
+        self.function = function
+
+    def set(self, value, **labels):
+        self.values[self.key(labels)] = value
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def get(self, **labels):
+        return self.function() if self.function else self.values.get(self.key(labels), 0)
+
+    def renderValues(self):
+        if self.function:
+            return [f"{self.name} {formatValue(self.function())}"]
+        return super().renderValues()
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name, description, labelNames=(), buckets=DURATION_BUCKETS):
+        super().__init__(name, description, labelNames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        # values: [counts per bucket (last one is +Inf), sum, count]
+        if key not in self.values:
+            self.values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        entry = self.values[key]
+        entry[0][bisect.bisect_left(self.buckets, value)] += 1
+        entry[1] += value
+        entry[2] += 1
+
+    # measures the duration of a with-block
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def renderValues(self):
+        lines = []
+        for key, (counts, total, count) in self.values.items():
+            cumulative = 0
+            for bound, bucketCount in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucketCount
+                lines.append(f"{self.name}_bucket{self.formatLabels(key, [('le', formatValue(bound))])} {cumulative}")
+            lines.append(f"{self.name}_sum{self.formatLabels(key)} {formatValue(total)}")
+            lines.append(f"{self.name}_count{self.formatLabels(key)} {count}")
+        return lines
+
+# list of all metrics
+class Registry:
+    def __init__(self):
+        self.metrics = {}
+
+    def add(self, metric):
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, description, labelNames=()):
+        return self.add(Counter(name, description, labelNames))
+
+    def gauge(self, name, description, labelNames=(), function=None):
+        return self.add(Gauge(name, description, labelNames, function))
+
+    def histogram(self, name, description, labelNames=(), buckets=DURATION_BUCKETS):
+        return self.add(Histogram(name, description, labelNames, buckets))
+
+    # returns all metrics in the text format
+    def render(self):
+        lines = []
+        for metric in self.metrics.values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+registry = Registry()
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+QUERY_DURATION = registry.histogram("db_query_duration_seconds", "Duration of single SQL queries")
+REQUEST_QUERIES = registry.histogram("db_queries_per_request", "Number of SQL queries per HTTP request or WebSocket action", ["handler"], COUNT_BUCKETS)
+REQUEST_QUERY_DURATION = registry.histogram("db_query_duration_per_request_seconds", "Total duration of the SQL queries per HTTP request or WebSocket action", ["handler"])
+
+# resident memory of the process, read from /proc (linux only)
+def residentMemory():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return 0
+
+registry.gauge("process_resident_memory_bytes", "Resident memory size in bytes", function=residentMemory)
+registry.gauge("process_cpu_seconds_total", "Total user and system CPU time spent in seconds", function=lambda: sum(os.times()[:2]))
+
+# the request (or websocket action) that is currently handled, queries are counted on it
+currentScope = contextvars.ContextVar("currentScope", default=None)
+
+# counts the queries and their duration while a request is handled
+class RequestScope:
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.queries = 0
+        self.queryDuration = 0.0
+        currentScope.set(self)
+
+    # stops counting and observes the duration of the request in the histogram
+    def finish(self, histogram, handler, **labels):
+        duration = time.perf_counter() - self.start
+        if currentScope.get() is self:
+            currentScope.set(None)
+        histogram.observe(duration, **labels)
+        REQUEST_QUERIES.observe(self.queries, handler=handler)
+        REQUEST_QUERY_DURATION.observe(self.queryDuration, handler=handler)
+        return duration
+
+# measures a with-block as a request
+@contextmanager
+def scope(histogram, handler, **labels):
+    requestScope = RequestScope()
+    try:
+        yield requestScope
+    finally:
+        requestScope.finish(histogram, handler, **labels)
+
+# time every query of every engine
+@event.listens_for(Engine, "before_cursor_execute")
+def beforeCursorExecute(connection, cursor, statement, parameters, context, executemany):
+    connection.info.setdefault("queryStart", []).append(time.perf_counter())
+
+@event.listens_for(Engine, "after_cursor_execute")
+def afterCursorExecute(connection, cursor, statement, parameters, context, executemany):
+    duration = time.perf_counter() - connection.info["queryStart"].pop()
+    QUERY_DURATION.observe(duration)
+    requestScope = currentScope.get()
+    if requestScope:
+        requestScope.queries += 1
+        requestScope.queryDuration += duration
+
+# a failed query never reaches after_cursor_execute
+@event.listens_for(Engine, "handle_error")
+def handleError(context):
+    if context.connection is not None and context.connection.info.get("queryStart"):
+        context.connection.info["queryStart"].pop()
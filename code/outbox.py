@@ -0,0 +1,106 @@
+# outgoing messages of a websocket:
+# - messages sent in the same tick of the IOLoop can be coalesced into one frame (a json array)
+# - the bytes that were handed to tornado but not yet written to the socket are counted per connection.
+#   a connection over its limit gets no more messages and is asked to resync once it caught up,
+#   if it stays over the limit for longer than the grace period it is closed.
+import os, time
+
+from tornado.ioloop import IOLoop
+
+from metrics import registry
+
+# zlib level of permessage-deflate, 0 disables compression
+COMPRESSION_LEVEL = int(os.environ.get("WS_COMPRESSION_LEVEL", 6))
+# memory used by zlib per connection (1-9), lower values use less memory but compress worse
+COMPRESSION_MEM_LEVEL = int(os.environ.get("WS_COMPRESSION_MEM_LEVEL", 5))
+# bytes (before compression) that may be waiting to be written to a connection
+MAX_BUFFER = int(os.environ.get("WS_MAX_BUFFER", 1024 * 1024))
+# seconds a connection may stay over MAX_BUFFER before it is closed
+BUFFER_GRACE = float(os.environ.get("WS_BUFFER_GRACE", 10))
+
+OUTBOUND_FRAMES = registry.counter("websocket_frames_total", "Frames written to websockets")
+BATCHED_MESSAGES = registry.counter("websocket_batched_messages_total", "Messages sent as part of a batch")
+OUTBOUND_BYTES = registry.counter("websocket_sent_bytes_total", "Bytes (before compression) written to websockets")
+DROPPED_MESSAGES = registry.counter("websocket_dropped_messages_total", "Messages not sent because the connection was over its buffer limit")
+SLOW_CLOSES = registry.counter("websocket_slow_closes_total", "Connections closed because they stayed over their buffer limit")
+
+# the options for WebSocketHandler.get_compression_options
+def compressionOptions():
+    if COMPRESSION_LEVEL <= 0:
+        return None
+    return {"compression_level": COMPRESSION_LEVEL, "mem_level": COMPRESSION_MEM_LEVEL}
+
+class Outbox:
+    def __init__(self, socket, maxBuffer=MAX_BUFFER, grace=BUFFER_GRACE):
+        self.socket = socket
+        self.maxBuffer = maxBuffer
+        self.grace = grace
+        # whether messages are coalesced, negotiated by the client
+        self.batching = False
+        # messages waiting for the end of the tick
+        self.queue = []
+        # bytes handed to tornado that are not yet written
+        self.pending = 0
+        # time the connection went over its limit, None if it is below
+        self.overSince = None
+        # whether messages were dropped and the client has to resync
+        self.needsResync = False
+        self.closed = False
+
+    # sends a message (encoded json, see responses.encodeMessage), or queues it until the end of the tick if
+    # batching is enabled
+    def put(self, message):
+        # a closed connection is a normal disconnect, not a drop
+        if self.closed:
+            return
+        if self.isOverLimit():
+            DROPPED_MESSAGES.inc()
+            self.needsResync = True
+            return
+        if not self.batching:
+            return self.write(message)
+        if not self.queue:
+            IOLoop.current().add_callback(self.flush)
+        self.queue.append(message)
+
+    # writes all queued messages in one frame
+    def flush(self):
+        queue, self.queue = self.queue, []
+        if queue and not self.closed:
+            BATCHED_MESSAGES.inc(len(queue))
+            self.write("[" + ",".join(queue) + "]")
+
+    def write(self, data):
+        size = len(data)
+        try:
+            future = self.socket.write_message(data)
+        except Exception:
+            # the connection is closed
+            return
+        OUTBOUND_FRAMES.inc()
+        OUTBOUND_BYTES.inc(size)
+        self.pending += size
+        future.add_done_callback(lambda _: self.written(size))
+
+    # called when tornado wrote a frame to the socket
+    def written(self, size):
+        self.pending -= size
+        if self.pending <= self.maxBuffer:
+            self.overSince = None
+        # ask the client to resync once it caught up with half of the buffer
+        if self.needsResync and self.pending <= self.maxBuffer // 2 and not self.closed:
+            self.needsResync = False
+            self.socket.resync()
+
+    # checks the limit, closes the connection if it stayed over it for too long
+    def isOverLimit(self):
+        if self.pending <= self.maxBuffer:
+            return False
+        now = time.monotonic()
+        if self.overSince is None:
+            self.overSince = now
+        elif now - self.overSince > self.grace:
+            SLOW_CLOSES.inc()
+            self.closed = True
+            self.socket.close(1008, "client too slow")
+        return True
@@ -0,0 +1,139 @@
+# statistics of the positions of the finished games (an opening explorer, and data to train the policies on): how
+# often a position led to a win of the attacker, a win of the defender or a draw.
+# a position is stored once for all of its 8 symmetries (rotations and reflections) under its canonical code: the
+# board as a base-3 number (0 empty, 1 attacker, 2 defender, the first field is the lowest digit), the smallest of
+# the 8 variants. the counts of a game are added in the transaction that marks it finished (one upsert), and can
+# be rebuilt from all games in one streaming pass (`python main.py positions rebuild`).
+import time
+
+from sqlalchemy import select, update, bindparam
+
+from metrics import registry
+
+RECORDED_GAMES = registry.counter("position_stats_games_total", "Finished games added to the position stats")
+
+# the columns of the counters by the result of the game (1: the attacker won, -1: the defender won, 0: draw)
+COUNTERS = {1: "attackerwins", -1: "defenderwins", 0: "draws"}
+DIGITS = {0: 0, 1: 1, -1: 2}
+
+# SYMMETRIES[s][i] is the field of the board that is moved to field i by symmetry s
+def symmetries():
+    rotate = [3 * (2 - column) + row for row in range(3) for column in range(3)]
+    mirror = [3 * row + (2 - column) for row in range(3) for column in range(3)]
+    result = []
+    current = list(range(9))
+    for _ in range(4):
+        result.append(current)
+        result.append([current[index] for index in mirror])
+        current = [current[index] for index in rotate]
+    return result
+SYMMETRIES = symmetries()
+# WEIGHTS[s][field] is the value of a digit on field in the code of the board after symmetry s
+WEIGHTS = [[3 ** symmetry.index(field) for field in range(9)] for symmetry in SYMMETRIES]
+
+# the canonical code of a board (9 fields of 1, -1 and 0)
+def canonical(board):
+    digits = [DIGITS[value] for value in board]
+    return min(sum(digit * weight for digit, weight in zip(digits, weights)) for weights in WEIGHTS)
+
+# the canonical codes of all positions of a game, from the empty board on. moves are (field, 1 or -1) in order
+def gamePositions(moves):
+    board = [0] * 9
+    codes = [canonical(board)]
+    for field, value in moves:
+        board[field] = value
+        codes.append(canonical(board))
+    return codes
+
+# the player that moves next (1: attacker, -1: defender), None if the board isn't valid
+def nextPlayer(board):
+    if len(board) != 9 or any(value not in DIGITS for value in board):
+        return None
+    difference = board.count(1) - board.count(-1)
+    return 1 if difference == 0 else -1 if difference == 1 else None
+
+class PositionStats:
+    # table has the columns code, moves (pieces on the board) and the COUNTERS
+    def __init__(self, table, log=None):
+        self.table = table
+        self.log = log
+
+    # adds a finished game, in the transaction of the session
+    def record(self, session, moves, result):
+        codes = gamePositions(moves)
+        # every position of a game is different (the pieces are never removed)
+        self.upsert(session, [{"code": code, "moves": pieces, **{column: int(column == COUNTERS[result]) for column in COUNTERS.values()}} for pieces, code in enumerate(codes)])
+        RECORDED_GAMES.inc()
+
+    # adds the counters of the rows to the table. the rows are sorted, so concurrent transactions lock them in the same order
+    def upsert(self, session, rows):
+        rows = sorted(rows, key=lambda row: row["code"])
+        dialect = session.get_bind().dialect.name
+        if dialect == "postgresql":
+            from sqlalchemy.dialects.postgresql import insert
+        elif dialect == "sqlite":
+            from sqlalchemy.dialects.sqlite import insert
+        else:
+            return self.upsertGeneric(session, rows)
+        statement = insert(self.table).values(rows)
+        session.execute(statement.on_conflict_do_update(index_elements=[self.table.c.code], set_={column: self.table.c[column] + statement.excluded[column] for column in COUNTERS.values()}))
+
+    # the same for databases without "on conflict": the existing rows are locked and updated, the others inserted.
+    # a concurrent insert of the same new position fails the transaction, like any other conflict
+    def upsertGeneric(self, session, rows):
+        table = self.table
+        existing = set(session.execute(select(table.c.code).where(table.c.code.in_([row["code"] for row in rows])).with_for_update()).scalars())
+        updates = [{"b_code": row["code"], **{"b_" + column: row[column] for column in COUNTERS.values()}} for row in rows if row["code"] in existing]
+        if updates:
+            session.execute(update(table).where(table.c.code == bindparam("b_code")).values({column: table.c[column] + bindparam("b_" + column) for column in COUNTERS.values()}), updates)
+        inserts = [row for row in rows if row["code"] not in existing]
+        if inserts:
+            session.execute(table.insert(), inserts)
+
+    # the stats of a board and of the positions after each possible next move, read with one query on the primary key
+    def children(self, session, board):
+        player = nextPlayer(board)
+        if player is None:
+            raise ValueError("invalid board")
+        code = canonical(board)
+        children = []
+        for field in range(9):
+            if board[field] == 0:
+                child = list(board)
+                child[field] = player
+                children.append((field, canonical(child)))
+        rows = {row.code: row for row in session.execute(select(self.table).where(self.table.c.code.in_([code] + [childCode for _, childCode in children])))}
+        return {
+            "code": code,
+            "player": player,
+            "position": self.toDict(code, rows.get(code)),
+            "children": [dict(self.toDict(childCode, rows.get(childCode)), field=field) for field, childCode in children],
+        }
+
+    def toDict(self, code, row):
+        counts = {column: getattr(row, column) if row is not None else 0 for column in COUNTERS.values()}
+        return {"code": code, "attackerWins": counts["attackerwins"], "defenderWins": counts["defenderwins"], "draws": counts["draws"], "games": sum(counts.values())}
+
+    # recomputes the table from all finished games ((moves, result), see record) and replaces it in one transaction
+    def rebuild(self, session, games, batchSize=1000):
+        start = time.monotonic()
+        # code => [pieces, attacker wins, defender wins, draws], there are only a few hundred canonical positions
+        counts = {}
+        gameCount = 0
+        for moves, result in games:
+            gameCount += 1
+            column = 1 + list(COUNTERS).index(result)
+            for pieces, code in enumerate(gamePositions(moves)):
+                entry = counts.get(code)
+                if entry is None:
+                    entry = counts[code] = [pieces, 0, 0, 0]
+                entry[column] += 1
+        rows = [{"code": code, "moves": entry[0], **dict(zip(COUNTERS.values(), entry[1:]))} for code, entry in sorted(counts.items())]
+        session.execute(self.table.delete())
+        for index in range(0, len(rows), batchSize):
+            session.execute(self.table.insert(), rows[index:index + batchSize])
+        session.commit()
+        report = {"games": gameCount, "positions": len(rows), "seconds": round(time.monotonic() - start, 3)}
+        if self.log:
+            self.log.info("position stats rebuilt", **report)
+        return report
@@ -0,0 +1,147 @@
+# tools to find out why the (single threaded) server stalls:
+# - a sampling profiler that looks at the stack of the main thread in a fixed interval and writes collapsed
+#   stacks, which can be turned into a flamegraph (https://github.com/brendangregg/FlameGraph, speedscope.app)
+# - a watchdog that logs the stack of the main thread when the IOLoop did not run for a certain time,
+#   similar to the removed IOLoop.set_blocking_log_threshold of tornado
+import os, sys, time, heapq, threading, traceback
+from collections import Counter
+from datetime import datetime
+
+from tornado.ioloop import PeriodicCallback
+
+from metrics import registry
+
+BLOCKED_DURATION = registry.histogram("ioloop_blocked_seconds", "Duration of stalls of the IOLoop that were longer than the threshold", buckets=(0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60))
+
+# returns the name of a frame for the collapsed stacks
+def frameName(frame):
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+# returns the stack of a thread from the outermost to the innermost frame
+def threadStack(threadId):
+    frame = sys._current_frames().get(threadId)
+    stack = []
+    while frame is not None:
+        stack.append(frameName(frame))
+        frame = frame.f_back
+    stack.reverse()
+    return stack
+
+class SamplingProfiler:
+    def __init__(self, outputDir="/tmp", log=None):
+        self.outputDir = outputDir
+        self.log = log
+        self.thread = None
+        self.stopEvent = threading.Event()
+        # collapsed stack => number of samples
+        self.samples = Counter()
+        self.startedAt = None
+        self.lastResult = None
+
+    def isRunning(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    # starts sampling the given thread (the main thread by default) for some seconds, returns False if already running
+    def start(self, seconds, interval=0.01, threadId=None):
+        if self.isRunning():
+            return False
+        self.samples = Counter()
+        self.stopEvent.clear()
+        self.startedAt = datetime.now()
+        threadId = threadId or threading.main_thread().ident
+        self.thread = threading.Thread(target=self.run, args=(seconds, interval, threadId), name="profiler", daemon=True)
+        self.thread.start()
+        if self.log:
+            self.log.info("profiler started", seconds=seconds, interval=interval)
+        return True
+
+    # stops sampling early and waits until the result is written
+    def stop(self):
+        if not self.isRunning():
+            return False
+        self.stopEvent.set()
+        self.thread.join()
+        return True
+
+    def run(self, seconds, interval, threadId):
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline and not self.stopEvent.wait(interval):
+            stack = threadStack(threadId)
+            if stack:
+                self.samples[";".join(stack)] += 1
+        self.lastResult = self.collapsed()
+        self.write()
+
+    # returns the samples as collapsed stacks: "outer;inner;innermost count" per line
+    def collapsed(self):
+        return "".join(f"{stack} {count}\n" for stack, count in self.samples.most_common())
+
+    # writes the collapsed stacks to the output directory
+    def write(self):
+        path = os.path.join(self.outputDir, f"profile-{self.startedAt:%Y%m%d-%H%M%S}.folded")
+        try:
+            with open(path, "w") as f:
+                f.write(self.lastResult)
+            if self.log:
+                self.log.info("profiler finished", samples=sum(self.samples.values()), path=path)
+        except OSError as e:
+            if self.log:
+                self.log.error("failed to write profile", path=path, error=e)
+        return path
+
+    def status(self):
+        return {"running": self.isRunning(), "startedAt": self.startedAt.isoformat() if self.startedAt else None, "samples": sum(self.samples.values())}
+
+# logs the stack of the main thread if the IOLoop did not run for longer than threshold seconds
+class BlockedLoopWatchdog:
+    def __init__(self, threshold, log=None, keep=20):
+        self.threshold = threshold
+        self.log = log
+        self.keep = keep
+        self.interval = min(threshold / 2, 0.1)
+        self.lastBeat = time.monotonic()
+        self.threadId = None
+        # stack of the current stall, None if the loop is running
+        self.stall = None
+        # the slowest stalls as (duration, time, stack), smallest first
+        self.slowest = []
+
+    def start(self, ioloop):
+        self.threadId = threading.get_ident()
+        self.lastBeat = time.monotonic()
+        PeriodicCallback(self.beat, self.interval * 1000).start()
+        threading.Thread(target=self.watch, name="watchdog", daemon=True).start()
+        return self
+
+    # called by the IOLoop, if it is not called in time the loop is blocked
+    def beat(self):
+        now = time.monotonic()
+        stall = self.stall
+        if stall:
+            # the loop is running again, remember how long it was blocked
+            self.stall = None
+            duration = now - self.lastBeat
+            BLOCKED_DURATION.observe(duration)
+            entry = (duration, stall[0], stall[1])
+            if len(self.slowest) < self.keep:
+                heapq.heappush(self.slowest, entry)
+            else:
+                heapq.heappushpop(self.slowest, entry)
+            if self.log:
+                self.log.warning("IOLoop was blocked", seconds=round(duration, 3))
+        self.lastBeat = now
+
+    def watch(self):
+        while True:
+            time.sleep(self.interval)
+            if self.stall is None and time.monotonic() - self.lastBeat > self.threshold:
+                frame = sys._current_frames().get(self.threadId)
+                stack = "".join(traceback.format_stack(frame)) if frame else ""
+                self.stall = (datetime.now().isoformat(), stack)
+                if self.log:
+                    self.log.warning("IOLoop blocked", threshold=self.threshold, stack="\n" + stack)
+
+    # returns the slowest stalls, slowest first
+    def report(self):
+        return [{"seconds": duration, "time": at, "stack": stack} for duration, at, stack in sorted(self.slowest, reverse=True)]
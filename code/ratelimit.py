@@ -0,0 +1,125 @@
+# limits how often a client may call the expensive actions (they write to the database and may send mails or
+# run the solver) and rejects work right away when the server is overloaded:
+# - RateLimiter: a token bucket per action and key (the ip and, if known, the user or session). the budgets are
+#   configured with RATE_LIMITS, e.g. "login=10/60" allows 10 logins per 60 seconds (all at once, then one
+#   every 6 seconds). buckets that filled up again are forgotten.
+# - Admission: everything runs one after another on the IOLoop, so an overloaded server shows up as requests
+#   that waited long before they were handled. requests that waited longer than ADMISSION_MAX_DELAY seconds are
+#   rejected (429 or an error frame) instead of making the queue even longer.
+import time
+
+from tornado.ioloop import PeriodicCallback
+from tornado.wsgi import WSGIContainer
+
+from metrics import registry
+
+# action => calls/seconds, the actions are the paths of the routes and the websocket actions
+DEFAULT_LIMITS = "login=10/60,signup=20/3600,startNewGame=30/60,makeMove=60/60"
+# key of the queue delay in the wsgi environ (see TimedWSGIContainer)
+QUEUE_DELAY = "tornado.queue_delay"
+
+RATE_LIMITED = registry.counter("rate_limited_total", "Requests rejected by the rate limiter", ["action", "key"])
+SHED = registry.counter("admission_shed_total", "Requests rejected because the server was overloaded", ["action", "reason"])
+
+# parses "action=calls/seconds,..." to {action: (calls, seconds)}
+def parseLimits(spec):
+    limits = {}
+    for entry in spec.split(","):
+        if not entry.strip():
+            continue
+        action, _, budget = entry.partition("=")
+        calls, _, seconds = budget.partition("/")
+        limits[action.strip()] = (float(calls), float(seconds or 1))
+    return limits
+
+class TokenBucket:
+    __slots__ = ("tokens", "updated")
+
+    def __init__(self, tokens, updated):
+        self.tokens = tokens
+        self.updated = updated
+
+class RateLimiter:
+    def __init__(self, limits, pruneInterval=60):
+        # action => (calls, seconds)
+        self.limits = limits
+        # (action, kind of key, key) => TokenBucket
+        self.buckets = {}
+        self.pruneInterval = pruneInterval
+        self.lastPrune = time.monotonic()
+        registry.gauge("rate_limit_buckets", "Token buckets of the rate limiter", function=lambda: len(self.buckets))
+
+    # takes a token of every key (a list of (kind, key), keys that are None are skipped),
+    # returns 0 if the action is allowed, else the seconds until it is allowed again
+    def hit(self, action, keys, now=None):
+        limit = self.limits.get(action)
+        if limit is None:
+            return 0
+        calls, seconds = limit
+        rate = calls / seconds
+        now = time.monotonic() if now is None else now
+        if now - self.lastPrune > self.pruneInterval:
+            self.prune(now)
+        buckets = []
+        for kind, key in keys:
+            if key is None:
+                continue
+            bucket = self.buckets.get((action, kind, key))
+            if bucket is None:
+                bucket = self.buckets[(action, kind, key)] = TokenBucket(calls, now)
+            else:
+                bucket.tokens = min(calls, bucket.tokens + (now - bucket.updated) * rate)
+                bucket.updated = now
+            if bucket.tokens < 1:
+                RATE_LIMITED.inc(action=action, key=kind)
+                return (1 - bucket.tokens) / rate
+            buckets.append(bucket)
+        # only take the tokens if every key had one left
+        for bucket in buckets:
+            bucket.tokens -= 1
+        return 0
+
+    # forgets the buckets that are full again, they behave the same as new ones
+    def prune(self, now=None):
+        now = time.monotonic() if now is None else now
+        self.lastPrune = now
+        for bucketKey, bucket in list(self.buckets.items()):
+            calls, seconds = self.limits[bucketKey[0]]
+            if bucket.tokens + (now - bucket.updated) * calls / seconds >= calls:
+                del self.buckets[bucketKey]
+
+class Admission:
+    # maxDelay: seconds a request may have waited (0 disables it)
+    def __init__(self, maxDelay, interval=0.1):
+        self.maxDelay = maxDelay
+        self.interval = interval
+        self.lastBeat = None
+
+    # websocket messages have no time of arrival, their queue delay is how late the IOLoop runs a periodic callback
+    def start(self):
+        self.lastBeat = time.monotonic()
+        PeriodicCallback(self.beat, self.interval * 1000).start()
+        return self
+
+    def beat(self):
+        self.lastBeat = time.monotonic()
+
+    def loopLag(self):
+        if self.lastBeat is None:
+            return 0
+        return max(0.0, time.monotonic() - self.lastBeat - self.interval)
+
+    # returns why the action is rejected ("queueDelay"), None if it may run.
+    # without a queueDelay (websocket messages) the lag of the IOLoop is used
+    def check(self, action, queueDelay=None):
+        if self.maxDelay and (self.loopLag() if queueDelay is None else queueDelay) > self.maxDelay:
+            SHED.inc(action=action, reason="queueDelay")
+            return "queueDelay"
+        return None
+
+# passes the time a request waited since tornado read it to flask (environ[QUEUE_DELAY])
+class TimedWSGIContainer(WSGIContainer):
+    def environ(self, request):
+        environ = super().environ(request)
+        environ[QUEUE_DELAY] = request.request_time()
+        return environ
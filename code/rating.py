@@ -0,0 +1,157 @@
+# elo ratings of the players, updated in the same transaction that marks a game finished (Game.determineState).
+# the ratings are stored in the table ratings and kept in memory in a RankIndex, ordered by rating, so the rank of
+# a player and the top n are found by bisecting instead of counting over the whole table.
+# games against the bot are handled by RATING_BOT_POLICY:
+# - "fixed": the bot has the fixed rating RATING_BOT_RATING, only its opponent is rated (the bot isn't ranked)
+# - "player": the bot is rated (and ranked) like any other player
+# - "exclude": games against the bot don't change any rating
+# `python main.py ratings rebuild` recomputes all ratings from the finished (and archived) games.
+import time, threading
+from bisect import bisect_left, insort
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session as OrmSession
+
+from metrics import registry
+
+RATED_GAMES = registry.counter("rated_games_total", "Finished games that changed ratings", ["policy"])
+BOT_POLICIES = ["fixed", "player", "exclude"]
+
+# the score the first player expects against the second (0 to 1)
+def expectedScore(rating, opponentRating):
+    return 1 / (1 + 10 ** ((opponentRating - rating) / 400))
+
+# the new ratings of two players, score is 1 if the first one won, 0.5 for a draw and 0 if it lost
+def updateElo(rating, opponentRating, score, k=32):
+    expected = expectedScore(rating, opponentRating)
+    return rating + k * (score - expected), opponentRating + k * ((1 - score) - (1 - expected))
+
+# the players ordered by rating (the highest first, equal ratings by username)
+class RankIndex:
+    def __init__(self):
+        # sorted (-rating, username)
+        self.keys = []
+        # username => (rating, games)
+        self.players = {}
+        self.lock = threading.Lock()
+        registry.gauge("ranked_players", "Players in the rank index", function=lambda: len(self.players))
+
+    def __len__(self):
+        return len(self.players)
+
+    # replaces all players with the given (username, rating, games)
+    def load(self, rows):
+        players = {username: (rating, games) for username, rating, games in rows}
+        with self.lock:
+            self.players = players
+            self.keys = sorted((-rating, username) for username, (rating, games) in players.items())
+
+    def set(self, username, rating, games):
+        with self.lock:
+            previous = self.players.get(username)
+            if previous is not None:
+                del self.keys[bisect_left(self.keys, (-previous[0], username))]
+            self.players[username] = (rating, games)
+            insort(self.keys, (-rating, username))
+
+    # the rank of the player (starting at 1), None if it has no rating
+    def rank(self, username):
+        player = self.players.get(username)
+        if player is None:
+            return None
+        return bisect_left(self.keys, (-player[0], username)) + 1
+
+    # the players from rank offset + 1 on: [{"rank", "username", "rating", "games"}]
+    def top(self, limit, offset=0):
+        return [self.entry(username, offset + index + 1) for index, (_, username) in enumerate(self.keys[offset:offset + limit])]
+
+    def entry(self, username, rank):
+        rating, games = self.players[username]
+        return {"rank": rank, "username": username, "rating": round(rating, 1), "games": games}
+
+class RatingEngine:
+    def __init__(self, Rating, botUsername, policy="fixed", k=32, initial=1500, botRating=1500, log=None):
+        if policy not in BOT_POLICIES:
+            raise ValueError(f"unknown bot policy {policy}, use one of {BOT_POLICIES}")
+        self.Rating = Rating
+        self.botUsername = botUsername
+        self.policy = policy
+        self.k = k
+        self.initial = initial
+        self.botRating = botRating
+        self.log = log
+        self.index = RankIndex()
+        # the new ratings of a session are put into the index once it commits
+        self.sessionKey = f"ratings{id(self)}"
+        event.listen(OrmSession, "after_commit", self.afterCommit)
+        event.listen(OrmSession, "after_soft_rollback", self.afterRollback)
+
+    # whether the rating of the player is fixed (not stored)
+    def isFixed(self, username):
+        return username == self.botUsername and self.policy == "fixed"
+
+    # the new ratings of the players of a finished game: {username: rating} (fixed players are left out), None if
+    # the game isn't rated. ratings maps the players to their current rating
+    def rate(self, attacker, defender, winner, ratings):
+        if attacker is None or defender is None or attacker == defender:
+            return None
+        if self.botUsername in (attacker, defender) and self.policy == "exclude":
+            return None
+        score = 1 if winner == attacker else 0 if winner == defender else 0.5
+        current = [self.botRating if self.isFixed(player) else ratings.get(player, self.initial) for player in (attacker, defender)]
+        updated = updateElo(current[0], current[1], score, self.k)
+        return {player: rating for player, rating in zip((attacker, defender), updated) if not self.isFixed(player)}
+
+    # updates the ratings of the players of a game that was just marked finished, in the transaction of the session
+    def apply(self, session, game):
+        players = [player for player in (game.attacker, game.defender) if player is not None and not self.isFixed(player)]
+        rows = {row.username: row for row in session.query(self.Rating).filter(self.Rating.username.in_(players)).with_for_update()} if players else {}
+        ratings = self.rate(game.attacker, game.defender, game.winner, {username: row.rating for username, row in rows.items()})
+        if ratings is None:
+            return
+        pending = session.info.setdefault(self.sessionKey, {})
+        for username, rating in ratings.items():
+            row = rows.get(username)
+            if row is None:
+                row = self.Rating(username=username, rating=rating, games=0)
+                session.add(row)
+            row.rating = rating
+            row.games = (row.games or 0) + 1
+            pending[username] = (rating, row.games)
+        RATED_GAMES.inc(policy=self.policy)
+
+    def afterCommit(self, session):
+        for username, (rating, games) in session.info.pop(self.sessionKey, {}).items():
+            self.index.set(username, rating, games)
+
+    def afterRollback(self, session, previousTransaction):
+        session.info.pop(self.sessionKey, None)
+
+    # fills the index from the table
+    def load(self, session):
+        self.index.load(session.query(self.Rating.username, self.Rating.rating, self.Rating.games).all())
+
+    # recomputes all ratings from the finished games (rows of (attacker, defender, winner), oldest first) and
+    # replaces the table in one transaction, returns a report
+    def rebuild(self, session, games):
+        start = time.monotonic()
+        ratings = {}
+        counts = {}
+        rated = 0
+        for attacker, defender, winner in games:
+            updated = self.rate(attacker, defender, winner, ratings)
+            if updated is None:
+                continue
+            rated += 1
+            for username, rating in updated.items():
+                ratings[username] = rating
+                counts[username] = counts.get(username, 0) + 1
+        session.query(self.Rating).delete()
+        if ratings:
+            session.execute(self.Rating.__table__.insert(), [{"username": username, "rating": rating, "games": counts[username]} for username, rating in ratings.items()])
+        session.commit()
+        self.index.load((username, rating, counts[username]) for username, rating in ratings.items())
+        report = {"policy": self.policy, "games": rated, "players": len(ratings), "seconds": round(time.monotonic() - start, 3)}
+        if self.log:
+            self.log.info("ratings rebuilt", **report)
+        return report
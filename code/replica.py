@@ -0,0 +1,195 @@
+# optional read replica (REPLICA_DATABASE_URI). the read-only routes (/games, /users, /users/<username>, /viewGame
+# and viewGame over the websocket) read from it, everything else uses the primary:
+# - writes (flushes, insert/update/delete) always go to the primary, and so do reads of a session with changes
+#   that are not committed yet
+# - read your writes: a client (its session token or websocket, else its ip) reads from the primary for
+#   REPLICA_STICKY_SECONDS after it committed a change
+# - the lag is measured with a heartbeat: every REPLICA_CHECK_INTERVAL seconds the time is written to
+#   replica_heartbeat on the primary and read back from the replica. while the oldest heartbeat that did not
+#   reach the replica is older than REPLICA_MAX_LAG seconds, or the replica fails, all reads go to the primary
+# - a read that fails or finds nothing on the replica (e.g. a game that was just created) is repeated on the primary
+import time, threading
+from contextlib import contextmanager
+
+from flask_sqlalchemy.session import Session
+from sqlalchemy import create_engine, event, MetaData, Table, Column, Integer, Float, select, update, insert
+from sqlalchemy.orm import Session as OrmSession
+
+from metrics import registry
+
+READS = registry.counter("database_reads_total", "Reads of the read-only routes per database", ["target", "reason"])
+REPLICA_LAG = registry.gauge("replica_lag_seconds", "Lag of the read replica, measured with the heartbeat (-1 if unknown)")
+
+# written on the primary, read on the replica. not a model, so it isn't created on the replica by create_all
+metadata = MetaData()
+heartbeat = Table("replica_heartbeat", metadata, Column("id", Integer, primary_key=True, autoincrement=False), Column("beat", Float, nullable=False))
+
+# the session of flask-sqlalchemy, uses the replica while the router allows it (session.info["replica"])
+class RoutingSession(Session):
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        router = self.info.get("router")
+        if bind is None and router is not None and self.info.get("replica") and not self._flushing and not getattr(clause, "is_dml", False):
+            return router.engine
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+class ReplicaRouter:
+    def __init__(self, uri, maxLag=5, sticky=5, log=None):
+        # the replica is disabled without an uri, all reads use the primary then
+        self.engine = create_engine(uri, pool_pre_ping=True) if uri else None
+        self.maxLag = maxLag
+        self.sticky = sticky
+        self.log = log
+        # the replica is only used once the heartbeat reached it
+        self.lag = None
+        self.error = None
+        # heartbeats written to the primary, the ones the replica may not have yet
+        self.beats = []
+        # client => monotonic time of its last commit with changes
+        self.lastWrites = {}
+        self.lock = threading.Lock()
+        if self.engine is not None:
+            event.listen(OrmSession, "after_flush", self.afterFlush)
+            event.listen(OrmSession, "do_orm_execute", self.onExecute)
+            event.listen(OrmSession, "after_commit", self.afterCommit)
+            event.listen(OrmSession, "after_soft_rollback", self.afterRollback)
+            # the routes catch the errors of their queries, the replica is avoided until the next heartbeat reaches it
+            event.listen(self.engine, "handle_error", lambda context: self.failed(context.original_exception))
+
+    # options for the session of flask-sqlalchemy: SQLAlchemy(app, session_options=router.sessionOptions())
+    def sessionOptions(self):
+        return {"class_": RoutingSession, "info": {"router": self}}
+
+    def enabled(self):
+        return self.engine is not None
+
+    def healthy(self):
+        return self.lag is not None and self.lag <= self.maxLag
+
+    # the session is used by the client until the next request or message (commits are recorded for it)
+    def setClient(self, session, client):
+        if self.engine is not None:
+            session.info["client"] = client
+
+    def afterFlush(self, session, flushContext):
+        session.info["wrote"] = True
+
+    # bulk updates and deletes (query.update) don't flush
+    def onExecute(self, state):
+        if state.is_insert or state.is_update or state.is_delete:
+            state.session.info["wrote"] = True
+
+    def afterCommit(self, session):
+        if session.info.pop("wrote", False) and session.info.get("client") is not None:
+            with self.lock:
+                self.lastWrites[session.info["client"]] = time.monotonic()
+
+    def afterRollback(self, session, previousTransaction):
+        session.info.pop("wrote", None)
+
+    # whether the client committed a change in the last REPLICA_STICKY_SECONDS
+    def recentlyWrote(self, client):
+        lastWrite = self.lastWrites.get(client)
+        return lastWrite is not None and time.monotonic() - lastWrite < self.sticky
+
+    # returns the database to read from for the client and why ("replica" or "primary")
+    def choose(self, session, client):
+        if session.new or session.dirty or session.deleted or session.info.get("wrote"):
+            return "primary", "pending"
+        if self.recentlyWrote(client):
+            return "primary", "sticky"
+        if self.error is not None:
+            return "primary", "failed"
+        if not self.healthy():
+            return "primary", "lag"
+        return "replica", "ok"
+
+    # the session reads from the replica inside if the client may use it (yields true then). the objects loaded
+    # from the replica are forgotten afterwards, the session may be shared with others (e.g. the websockets)
+    @contextmanager
+    def reading(self, session, client):
+        if self.engine is None:
+            yield False
+            return
+        target, reason = self.choose(session, client)
+        READS.inc(target=target, reason=reason)
+        if target == "primary":
+            yield False
+            return
+        session.info["replica"] = True
+        try:
+            yield True
+        finally:
+            session.info["replica"] = False
+            # ends the transaction on the replica
+            session.rollback()
+
+    # runs read() on the replica if the client may use it, and again on the primary if it raised or ok(result) is
+    # false. read() must not return objects of the session (they are expired after the replica was used)
+    def read(self, session, client, read, ok=lambda result: True):
+        return self.readFrom(session, client, read, ok)[0]
+
+    # like read(), returns the result and the database that answered ("replica" or "primary")
+    def readFrom(self, session, client, read, ok=lambda result: True):
+        with self.reading(session, client) as onReplica:
+            if onReplica:
+                try:
+                    result = read()
+                    if ok(result):
+                        return result, "replica"
+                except Exception as e:
+                    # errors of the replica itself were recorded by handle_error
+                    pass
+                READS.inc(target="primary", reason="retry")
+        return read(), "primary"
+
+    # the replica is not used until the next heartbeat reaches it
+    def failed(self, error):
+        if self.error is None and self.log:
+            self.log.warning("read replica failed, reading from the primary", error=error)
+        self.error = error
+
+    # creates the heartbeat table on the primary (the replica gets it by replication)
+    def createTables(self, primary):
+        if self.engine is not None:
+            metadata.create_all(primary)
+
+    # measures the lag and writes the next heartbeat, blocks (run it in a thread)
+    def check(self, primary):
+        now = time.time()
+        self.measure(now)
+        # the heartbeat is written even if the replica is down, so it isn't used before it caught up again
+        try:
+            with primary.begin() as connection:
+                if connection.execute(update(heartbeat).where(heartbeat.c.id == 1).values(beat=now)).rowcount == 0:
+                    connection.execute(insert(heartbeat).values(id=1, beat=now))
+            with self.lock:
+                self.beats.append(now)
+        except Exception as e:
+            if self.log:
+                self.log.warning("failed to write the heartbeat of the read replica", error=e)
+
+    def measure(self, now):
+        try:
+            with self.engine.connect() as connection:
+                replicated = connection.execute(select(heartbeat.c.beat).where(heartbeat.c.id == 1)).scalar()
+        except Exception as e:
+            self.failed(e)
+            self.lag = None
+            REPLICA_LAG.set(-1)
+            return
+        with self.lock:
+            # the replica has every heartbeat up to the one it returned, the lag is the age of the oldest one it misses
+            self.beats = [beat for beat in self.beats if replicated is None or beat > replicated]
+            lag = now - self.beats[0] if self.beats else (0 if replicated is not None else None)
+            # forget the clients that may read from the replica again
+            self.lastWrites = {client: lastWrite for client, lastWrite in self.lastWrites.items() if time.monotonic() - lastWrite < self.sticky}
+        if self.error is not None and self.log:
+            self.log.info("read replica reachable again", lag=lag)
+        self.error = None
+        if self.log and (lag is None or lag > self.maxLag) != (self.lag is None or self.lag > self.maxLag):
+            if lag is None or lag > self.maxLag:
+                self.log.warning("read replica lags behind, reading from the primary", lag=lag)
+            else:
+                self.log.info("read replica caught up", lag=lag)
+        self.lag = lag
+        REPLICA_LAG.set(-1 if lag is None else lag)
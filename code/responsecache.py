@@ -0,0 +1,69 @@
+# short-lived cache for responses of endpoints that are polled (e.g. the game list), with strong etags.
+# entries are grouped in namespaces, which are invalidated after a commit that changed their data.
+import time, hashlib
+from collections import OrderedDict
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session as OrmSession
+
+from metrics import registry
+
+CACHE_REQUESTS = registry.counter("response_cache_requests_total", "Lookups in the response cache", ["namespace", "result"])
+
+class CachedResponse:
+    def __init__(self, body, ttl):
+        self.body = body
+        self.etag = '"' + hashlib.sha1(body.encode() if isinstance(body, str) else body).hexdigest() + '"'
+        self.expires = time.monotonic() + ttl
+
+    # checks an If-None-Match header against the etag
+    def matches(self, ifNoneMatch):
+        if not ifNoneMatch:
+            return False
+        tags = {tag.strip() for tag in ifNoneMatch.split(",")}
+        return "*" in tags or self.etag in tags
+
+class ResponseCache:
+    def __init__(self, ttl=10, maxEntries=1024):
+        self.ttl = ttl
+        self.maxEntries = maxEntries
+        # namespace => OrderedDict(key => CachedResponse), least recently used first
+        self.namespaces = {}
+        # namespaces to invalidate are collected per session and invalidated after its commit
+        self.sessionKey = f"responseCache{id(self)}"
+        event.listen(OrmSession, "after_commit", self.afterCommit)
+        event.listen(OrmSession, "after_soft_rollback", self.afterRollback)
+
+    # returns the cached response or None if there is none or it expired
+    def get(self, namespace, key):
+        entries = self.namespaces.get(namespace)
+        entry = entries.get(key) if entries is not None else None
+        if entry is None or entry.expires < time.monotonic():
+            CACHE_REQUESTS.inc(namespace=namespace, result="miss")
+            return None
+        entries.move_to_end(key)
+        CACHE_REQUESTS.inc(namespace=namespace, result="hit")
+        return entry
+
+    def set(self, namespace, key, body):
+        entries = self.namespaces.setdefault(namespace, OrderedDict())
+        entry = entries[key] = CachedResponse(body, self.ttl)
+        entries.move_to_end(key)
+        # drop the least recently used entries
+        while len(entries) > self.maxEntries:
+            entries.popitem(last=False)
+        return entry
+
+    def invalidate(self, *namespaces):
+        for namespace in namespaces:
+            self.namespaces.pop(namespace, None)
+
+    # marks namespaces to be invalidated once the session commits (use in mapper events)
+    def invalidateOnCommit(self, session, *namespaces):
+        session.info.setdefault(self.sessionKey, set()).update(namespaces)
+
+    def afterCommit(self, session):
+        self.invalidate(*session.info.pop(self.sessionKey, ()))
+
+    def afterRollback(self, session, previousTransaction):
+        session.info.pop(self.sessionKey, None)
@@ -0,0 +1,68 @@
+# encodes the responses of the flask routes and the messages of the websocket.
+# orjson is used if it is installed (pip install orjson), otherwise the json module. the payloads that are sent
+# most often (game info, game list, leaderboard) always have the same keys, without orjson they are encoded
+# with precomputed format strings instead of walking the dicts. messages to many sockets (broadcasts) are
+# encoded once, only the msgId of every subscriber is spliced in.
+import json
+from json.encoder import encode_basestring_ascii
+
+from flask import Response
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+CONTENT_TYPE = "application/json"
+BACKEND = "orjson" if orjson else "json"
+
+if orjson:
+    OPTIONS = orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY
+
+    def dumps(value):
+        return orjson.dumps(value, option=OPTIONS).decode()
+else:
+    ENCODER = json.JSONEncoder(separators=(",", ":"))
+
+    def dumps(value):
+        return ENCODER.encode(value)
+
+LITERALS = {True: "true", False: "false", None: "null"}
+
+def string(value):
+    return "null" if value is None else encode_basestring_ascii(value)
+
+GAME_INFO = '{"attacker":%s,"defender":%s,"gameId":%d,"winner":%s,"gameField":[%d,%d,%d,%d,%d,%d,%d,%d,%d],"isFinished":%s,"isDraw":%s}'
+USER_ROW = '{"username":%s,"winCount":%d,"defeatCount":%d,"drawCount":%d}'
+
+# the result of Game.getGameInfo
+def encodeGameInfo(info):
+    if orjson or len(info) != 7:
+        return dumps(info)
+    return GAME_INFO % (string(info["attacker"]), string(info["defender"]), info["gameId"], string(info["winner"]), *info["gameField"], LITERALS[info["isFinished"]], LITERALS[info["isDraw"]])
+
+# the response of /games
+def encodeGameList(response):
+    if orjson or not response["success"]:
+        return dumps(response)
+    return '{"success":true,"data":[' + ",".join([encodeGameInfo(info) for info in response["data"]]) + "]}"
+
+# the response of /users
+def encodeUserList(response):
+    if orjson or not response["success"]:
+        return dumps(response)
+    return '{"success":true,"data":[' + ",".join([USER_ROW % (string(user["username"]), user["winCount"], user["defeatCount"], user["drawCount"]) for user in response["data"]]) + "]}"
+
+# the start of the messages per action, up to the data
+PREFIXES = {}
+
+# a message of the websocket with data that is encoded already
+def encodeMessage(action, encodedData, msgId, error=False):
+    prefix = PREFIXES.get((action, error))
+    if prefix is None:
+        prefix = PREFIXES[(action, error)] = '{"action":' + dumps(action) + (',"success":false,"error":' if error else ',"success":true,"data":')
+    return prefix + encodedData + ',"msgId":' + (str(msgId) if type(msgId) is int else dumps(msgId)) + "}"
+
+# a flask response with the content type of json, the body can be encoded already
+def jsonResponse(body, status=200, headers=None):
+    return Response(body if isinstance(body, str) else dumps(body), status=status, headers=headers, content_type=CONTENT_TYPE)
@@ -6,5 +6,5 @@ apt-get install unzip
 unzip release.zip
 # remove release.zip
 rm release.zip
-# run the server
-python /code/main.py
\ No newline at end of file
+# run the server, exec so it gets the SIGTERM of docker (and stops gracefully)
+exec python /code/main.py
\ No newline at end of file
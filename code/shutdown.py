@@ -0,0 +1,92 @@
+# graceful shutdown on SIGTERM (docker compose stop/restart) and SIGINT, within SHUTDOWN_DEADLINE seconds:
+# - the steps added with add run in order once the signal arrived, e.g. stop listening, close the websockets with
+#   a reconnect hint, finish the open http connections and flush the mail digests. each step gets what is left of
+#   the deadline
+# - the work started with background (in the executor) is tracked, so a step can wait for it. no new work is
+#   started once the server is stopping
+# - the IOLoop stops once all steps are done or the deadline is reached, a second signal stops it right away.
+#   steps added with always=True (e.g. the mails) still run after the deadline, with at least grace seconds
+import time, signal, asyncio, inspect
+
+from tornado.ioloop import IOLoop
+
+class GracefulShutdown:
+    def __init__(self, deadline=20, log=None, grace=5):
+        self.deadline = deadline
+        self.log = log
+        self.grace = grace
+        # (name, step, always), a step is a function that may return an awaitable
+        self.steps = []
+        # futures of the background work that is still running
+        self.running = set()
+        self.stopping = False
+        # whether a step did not finish within the deadline (its work is abandoned)
+        self.timedOut = False
+
+    def add(self, name, step, always=False):
+        self.steps.append((name, step, always))
+
+    # runs function in the default executor (it may block) unless the server is stopping, returns the future or None
+    def background(self, function, *args):
+        if self.stopping:
+            return None
+        future = IOLoop.current().run_in_executor(None, function, *args)
+        self.running.add(future)
+        future.add_done_callback(self.running.discard)
+        return future
+
+    # waits until the background work that is still running finished
+    async def waitForBackground(self):
+        if self.running:
+            await asyncio.wait(list(self.running))
+
+    # handles the signals on the IOLoop (call before it is started)
+    def install(self, signals=(signal.SIGTERM, signal.SIGINT)):
+        loop = IOLoop.current()
+        for signum in signals:
+            loop.asyncio_loop.add_signal_handler(signum, self.onSignal, signum)
+
+    def onSignal(self, signum):
+        name = signal.Signals(signum).name
+        if self.stopping:
+            if self.log:
+                self.log.warning("stopping right away", signal=name)
+            self.timedOut = True
+            IOLoop.current().stop()
+            return
+        IOLoop.current().add_callback(self.run, name)
+
+    async def run(self, reason):
+        self.stopping = True
+        start = time.monotonic()
+        if self.log:
+            self.log.info("shutting down", reason=reason, deadline=self.deadline)
+        for name, step, always in self.steps:
+            remaining = self.deadline - (time.monotonic() - start)
+            if always:
+                remaining = max(remaining, self.grace)
+            elif self.timedOut:
+                if self.log:
+                    self.log.warning("shutdown step skipped", step=name)
+                continue
+            stepStart = time.monotonic()
+            try:
+                if remaining <= 0:
+                    raise asyncio.TimeoutError()
+                result = step()
+                if inspect.isawaitable(result):
+                    await asyncio.wait_for(result, remaining)
+            except asyncio.TimeoutError:
+                self.timedOut = True
+                if self.log:
+                    self.log.warning("shutdown deadline reached", step=name)
+                continue
+            except Exception as e:
+                if self.log:
+                    self.log.error("shutdown step failed", step=name, error=e)
+                continue
+            if self.log:
+                self.log.info("shutdown step done", step=name, seconds=round(time.monotonic() - stepStart, 3))
+        if self.log:
+            self.log.info("stopped", seconds=round(time.monotonic() - start, 3), timedOut=self.timedOut)
+        IOLoop.current().stop()
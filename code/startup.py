@@ -0,0 +1,100 @@
+# gets the server to accept connections quickly after a (re)start:
+# - the server listens right away, the database is waited for with exponential backoff in the background.
+#   /healthz answers as soon as the process runs, /readyz only once everything it needs is ready.
+# - heavy things (the RL-A, the email templates, the compressed build) are loaded on first use or warmed up in
+#   the background once the server listens.
+import time, random, threading
+
+from tornado import gen
+from tornado.ioloop import IOLoop
+from tornado.web import RequestHandler
+
+from responses import dumps, CONTENT_TYPE
+
+# delays between two attempts: starts at initial and doubles up to maximum, with some jitter so restarted
+# replicas don't hit the database at the same time
+def backoffDelays(initial=0.1, maximum=5, jitter=0.2):
+    delay = initial
+    while True:
+        yield delay * random.uniform(1 - jitter, 1 + jitter)
+        delay = min(maximum, delay * 2)
+
+# calls attempt (in the default executor, it may block) until it returns true, waits on the IOLoop in between.
+# returns the number of attempts
+async def waitFor(attempt, delays, log=None, name="dependency"):
+    attempts = 0
+    for delay in delays:
+        attempts += 1
+        if await IOLoop.current().run_in_executor(None, attempt):
+            return attempts
+        if log:
+            log.warning("waiting for " + name, attempts=attempts, retryIn=round(delay, 2))
+        await gen.sleep(delay)
+
+# a value that is created on first use. the warmup may create it in another thread at the same time
+class Lazy:
+    def __init__(self, factory):
+        self.factory = factory
+        self.value = None
+        self.loaded = False
+        self.lock = threading.Lock()
+
+    def get(self):
+        if not self.loaded:
+            with self.lock:
+                if not self.loaded:
+                    self.value = self.factory()
+                    self.loaded = True
+        return self.value
+
+# the parts the server needs before it can handle requests (e.g. the database) and the ones it warms up
+class Readiness:
+    def __init__(self, required=()):
+        self.started = time.monotonic()
+        # name => seconds after the start when it was ready, None while it isn't
+        self.required = {name: None for name in required}
+        self.warm = {}
+        # set on shutdown, the server isn't ready anymore
+        self.stopping = False
+
+    # the server isn't ready until the part is set
+    def require(self, name):
+        self.required[name] = None
+
+    def set(self, name):
+        seconds = time.monotonic() - self.started
+        if name in self.required:
+            self.required[name] = seconds
+        else:
+            self.warm[name] = seconds
+
+    def stop(self):
+        self.stopping = True
+
+    def ready(self):
+        return not self.stopping and all(seconds is not None for seconds in self.required.values())
+
+    # why the server isn't ready
+    def reason(self):
+        return "stopping" if self.stopping else "starting"
+
+    def status(self):
+        return {"ready": self.ready(), "stopping": self.stopping, "uptime": time.monotonic() - self.started, "required": self.required, "warm": self.warm}
+
+# liveness: the process runs and the IOLoop answers
+class HealthHandler(RequestHandler):
+    def get(self):
+        self.set_header("Content-Type", CONTENT_TYPE)
+        self.set_header("Cache-Control", "no-store")
+        self.finish(dumps({"alive": True}))
+
+# readiness: 200 once the required parts are ready, 503 before
+class ReadyHandler(RequestHandler):
+    def initialize(self, readiness):
+        self.readiness = readiness
+
+    def get(self):
+        self.set_status(200 if self.readiness.ready() else 503)
+        self.set_header("Content-Type", CONTENT_TYPE)
+        self.set_header("Cache-Control", "no-store")
+        self.finish(dumps(self.readiness.status()))
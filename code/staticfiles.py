@@ -0,0 +1,140 @@
+# serves the react build from memory, without passing through flask:
+# all files of the build folder are read (and compressed with gzip and brotli) once at startup (or in the background),
+# hashed assets are cached forever by the browser, all other files are revalidated with their ETag.
+import os, re, gzip, hashlib, mimetypes
+from email.utils import formatdate, parsedate_to_datetime
+
+from tornado.escape import url_unescape
+from tornado.web import FallbackHandler
+
+from metrics import registry
+
+# brotli is optional, only gzip is used if it is not installed
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+STATIC_RESPONSES = registry.counter("static_responses_total", "Responses served from the in-memory build index", ["status", "encoding"])
+
+# files like main.1a2b3c4d.js or 787.0f1e2d3c.chunk.css contain a hash of their content
+HASHED_FILE = re.compile(r"\.[0-9a-f]{8,}(\.chunk)?\.[a-z0-9]+$")
+COMPRESSIBLE_TYPES = ("text/", "application/javascript", "application/json", "application/manifest+json", "application/xml", "image/svg+xml", "image/x-icon", "image/vnd.microsoft.icon")
+# compressing smaller files doesn't pay off
+MIN_COMPRESS_SIZE = 256
+
+# a file of the build with its precompressed variants
+class BuildFile:
+    def __init__(self, path, content, modified):
+        self.content = content
+        self.contentType = mimetypes.guess_type(path)[0] or "application/octet-stream"
+        if self.contentType.startswith("text/") or self.contentType in ("application/javascript", "application/json"):
+            self.contentType += "; charset=utf-8"
+        self.immutable = bool(HASHED_FILE.search(path))
+        self.lastModified = formatdate(int(modified), usegmt=True)
+        self.modified = int(modified)
+        digest = hashlib.sha1(content).hexdigest()[:20]
+        # encoding => (etag, body), each encoding needs its own strong etag
+        self.variants = {"identity": (f'"{digest}"', content)}
+        if len(content) >= MIN_COMPRESS_SIZE and self.contentType.startswith(COMPRESSIBLE_TYPES):
+            compressed = gzip.compress(content, 9, mtime=0)
+            if len(compressed) < len(content):
+                self.variants["gzip"] = (f'"{digest}-gz"', compressed)
+            if brotli:
+                compressed = brotli.compress(content, quality=11)
+                if len(compressed) < len(content):
+                    self.variants["br"] = (f'"{digest}-br"', compressed)
+        self.etags = {etag for etag, _ in self.variants.values()}
+
+    # returns the best variant for an Accept-Encoding header
+    def negotiate(self, acceptEncoding):
+        accepted = {part.split(";")[0].strip() for part in acceptEncoding.lower().split(",") if not part.strip().endswith(";q=0")}
+        for encoding in ("br", "gzip"):
+            if encoding in self.variants and encoding in accepted:
+                return encoding
+        return "identity"
+
+# index of all files in the build folder: relative path => BuildFile.
+# with load=False the index stays empty (all requests go to the fallback) until load() is called, e.g. in the
+# background after the server started to listen
+class BuildIndex:
+    def __init__(self, root, log=None, load=True):
+        self.root = root
+        self.files = {}
+        if load:
+            self.load(log)
+
+    def load(self, log=None):
+        files = {}
+        for directory, _, names in os.walk(self.root):
+            for name in names:
+                path = os.path.join(directory, name)
+                with open(path, "rb") as f:
+                    content = f.read()
+                files[os.path.relpath(path, self.root).replace(os.sep, "/")] = BuildFile(name, content, os.path.getmtime(path))
+        self.files = files
+        if log:
+            log.info("indexed build", root=self.root, files=len(files), bytes=sum(len(file.content) for file in files.values()), brotli=brotli is not None)
+
+    def get(self, path):
+        return self.files.get(path)
+
+# serves GET and HEAD requests for files of the build (and the index.html for routes of the react app),
+# all other requests are passed on to the fallback (flask)
+class BuildFileHandler(FallbackHandler):
+    def initialize(self, fallback, index, isAppRoute, redirectToHttps=False):
+        self.fallback = fallback
+        self.index = index
+        self.isAppRoute = isAppRoute
+        self.redirectToHttps = redirectToHttps
+
+    def prepare(self):
+        if self.request.method in ("GET", "HEAD"):
+            path = url_unescape(self.request.path).lstrip("/") or "index.html"
+            buildFile = self.index.get(path)
+            # routes of the react app are answered with the index.html (as appLoader does)
+            if buildFile is None and self.isAppRoute("/" + path):
+                buildFile = self.index.get("index.html")
+            if buildFile is not None:
+                return self.serve(buildFile)
+        super().prepare()
+
+    def serve(self, buildFile):
+        # redirect to https if requested via http
+        if self.redirectToHttps and self.request.protocol == "http":
+            return self.redirect(self.request.full_url().replace("http://", "https://", 1))
+        encoding = buildFile.negotiate(self.request.headers.get("Accept-Encoding", ""))
+        etag, body = buildFile.variants[encoding]
+        self.set_header("Content-Type", buildFile.contentType)
+        self.set_header("ETag", etag)
+        self.set_header("Last-Modified", buildFile.lastModified)
+        self.set_header("Vary", "Accept-Encoding")
+        self.set_header("Access-Control-Allow-Origin", "*")
+        # hashed files never change, all others have to be revalidated
+        self.set_header("Cache-Control", "public, max-age=31536000, immutable" if buildFile.immutable else "no-cache")
+        if encoding != "identity":
+            self.set_header("Content-Encoding", encoding)
+        if self.notModified(buildFile):
+            self.set_status(304)
+            self.clear_header("Content-Type")
+            STATIC_RESPONSES.inc(status=304, encoding=encoding)
+            return self.finish()
+        STATIC_RESPONSES.inc(status=200, encoding=encoding)
+        self.set_header("Content-Length", len(body))
+        if self.request.method == "HEAD":
+            return self.finish()
+        self.finish(body)
+
+    # checks If-None-Match (or If-Modified-Since if no If-None-Match is given)
+    def notModified(self, buildFile):
+        ifNoneMatch = self.request.headers.get("If-None-Match")
+        if ifNoneMatch is not None:
+            tags = {tag.strip().removeprefix("W/") for tag in ifNoneMatch.split(",")}
+            return "*" in tags or not tags.isdisjoint(buildFile.etags)
+        ifModifiedSince = self.request.headers.get("If-Modified-Since")
+        if ifModifiedSince:
+            try:
+                return parsedate_to_datetime(ifModifiedSince).timestamp() >= buildFile.modified
+            except (TypeError, ValueError):
+                return False
+        return False
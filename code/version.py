@@ -0,0 +1,65 @@
+# version of the running code and whether a newer one is available on the remote.
+# the local hash is read once at startup and the remote hash is refreshed in the background,
+# so answering /version never waits for git or the network.
+import subprocess
+from datetime import datetime
+
+from tornado.ioloop import IOLoop, PeriodicCallback
+
+class VersionChecker:
+    def __init__(self, repository=None, remote="origin", interval=3600, log=None):
+        # folder of the repository, None for the current working directory
+        self.repository = repository
+        self.remote = remote
+        self.interval = interval
+        self.log = log
+        self.localHash = "NONE"
+        # last known hash of the remote, None if it was never reached
+        self.remoteHash = None
+        self.checkedAt = None
+        self.reachable = False
+
+    # runs a git command and returns its output
+    def git(self, *args, timeout=30):
+        # the repository is mounted and may belong to another user, which newer versions of git refuse
+        return subprocess.run(["git", "-c", "safe.directory=*", *args], cwd=self.repository, capture_output=True, text=True, timeout=timeout, check=True).stdout.strip()
+
+    def readLocalHash(self):
+        try:
+            return self.git("rev-parse", "HEAD")
+        except Exception as e:
+            if self.log:
+                self.log.warning("failed to read local version", error=e)
+            return "NONE"
+
+    def readRemoteHash(self):
+        # output: "<hash>\tHEAD"
+        return self.git("ls-remote", self.remote, "HEAD").split()[0]
+
+    # asks the remote for its hash (in a thread), keeps the last known one if it is unreachable
+    async def refresh(self):
+        try:
+            self.remoteHash = await IOLoop.current().run_in_executor(None, self.readRemoteHash)
+            self.reachable = True
+        except Exception as e:
+            self.reachable = False
+            if self.log:
+                self.log.warning("failed to reach remote", remote=self.remote, error=e)
+        self.checkedAt = datetime.now()
+
+    # reads the local hash and starts refreshing the remote one, must be called with a running IOLoop
+    def start(self):
+        self.localHash = self.readLocalHash()
+        IOLoop.current().add_callback(self.refresh)
+        if self.interval > 0:
+            PeriodicCallback(self.refresh, self.interval * 1000).start()
+        return self
+
+    def toDict(self):
+        return {
+            "versionHash": self.localHash,
+            "upToDate": self.remoteHash.startswith(self.localHash) if self.remoteHash else None,
+            "remoteHash": self.remoteHash,
+            "remoteReachable": self.reachable,
+            "checkedAt": self.checkedAt.isoformat() if self.checkedAt else None,
+        }
@@ -0,0 +1,58 @@
+# the tests import the modules of code/ like main.py does. main.py reads its configuration from the environment
+# at import time, the tests that import it run against a sqlite database in a temporary folder (a file, so threads
+# get connections of their own)
+import os, sys, tempfile
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CODE = os.path.join(ROOT, "code")
+
+ENV = {
+    "DATABASE_URI": "sqlite:///" + os.path.join(tempfile.mkdtemp(), "tests.db"),
+    "POSTGRES_USER": "postgres",
+    "POSTGRES_PASSWORD": "password",
+    "SMTP_PORT": "25",
+    "DOMAIN": "localhost",
+    "BOT_USERNAME": "bot",
+    "BOT_EMAIL": "bot",
+    "GAMELIST_LIMIT": "20",
+    "SESSION_TIMEOUT": "1209600",
+    "ENABLE_SSL": "FALSE",
+    "PRODUCTION": "TRUE",
+}
+for key, value in ENV.items():
+    os.environ.setdefault(key, value)
+sys.path.insert(0, CODE)
+sys.path.insert(0, os.path.join(CODE, "RL-A"))
+
+# main.py with empty tables (and the bot user) in an app context, the server counts as ready
+@pytest.fixture
+def main():
+    import main
+    with main.app.app_context():
+        main.db.drop_all()
+        main.db.create_all()
+        main.db.session.add(main.User(main.os.environ["BOT_USERNAME"], main.os.environ["BOT_EMAIL"], "key", "salt"))
+        main.db.session.commit()
+        main.readiness.set("database")
+        yield main
+        main.db.session.remove()
+        main.gameSubscriptions.subscriptions.clear()
+
+# a websocket that keeps the messages it was sent
+class FakeSocket:
+    protocolVersion = 2
+
+    def __init__(self):
+        self.messages = []
+
+    def sendEncoded(self, action, encodedData, msgId, error=False):
+        self.messages.append((action, encodedData, msgId))
+
+    def send(self, action, data, msgId, error=False):
+        self.messages.append((action, data, msgId))
+
+@pytest.fixture
+def fakeSocket():
+    return FakeSocket()
@@ -0,0 +1,48 @@
+# the export only answers admins, a bad or expired token is refused like a missing one
+import json
+from datetime import datetime
+
+import pytest
+from tornado.testing import AsyncHTTPTestCase
+from tornado.web import Application
+
+@pytest.mark.usefixtures("main")
+class TestExport(AsyncHTTPTestCase):
+    def get_app(self):
+        import main, export
+        self.mainModule = main
+        return Application([(r"/export/games", export.ExportHandler, dict(engine=main.db.engine, games=main.Game.__table__, moves=main.Move.__table__, archived=main.ArchivedGame.__table__, isAllowed=main.isAdminTornadoRequest))])
+
+    def export(self, authorisation=None):
+        headers = {"Authorisation": authorisation} if authorisation is not None else {}
+        return self.fetch("/export/games", headers=headers)
+
+    def test_badTokensAreForbidden(self):
+        for authorisation in (None, "Bearer 0123abcd", "Bearer", "garbage"):
+            response = self.export(authorisation)
+            assert response.code == 403
+            assert json.loads(response.body) == {"success": False}
+
+    def test_adminExportsAgain(self):
+        main = self.mainModule
+        main.ADMIN_USERS.append("bot")
+        try:
+            token = main.Session.generateToken("bot").sessionKey
+            # the executor is shared, a second export works after the first one closed its connection
+            for _ in range(2):
+                response = self.export(f"Bearer {token}")
+                assert response.code == 200
+                assert response.body == b""
+        finally:
+            main.ADMIN_USERS.remove("bot")
+
+    def test_expiredAdminTokenIsForbidden(self):
+        main = self.mainModule
+        main.ADMIN_USERS.append("bot")
+        try:
+            session = main.Session.generateToken("bot")
+            session.sessionStart = datetime(2000, 1, 1)
+            main.db.session.commit()
+            assert self.export(f"Bearer {session.sessionKey}").code == 403
+        finally:
+            main.ADMIN_USERS.remove("bot")
@@ -0,0 +1,69 @@
+# finishing games: the state, the broadcast of the last move, the mails of the result and the session shared by
+# the websockets
+import json
+
+# a guest game against the bot with the given moves (the guest attacks, the bot defends)
+def guestGame(main, positions):
+    game = main.Game(None)
+    main.db.session.add(game)
+    main.db.session.commit()
+    moves = []
+    for index, position in enumerate(positions):
+        move = main.Move(game.gameId, position, None if index % 2 == 0 else main.os.environ["BOT_USERNAME"])
+        main.db.session.add(move)
+        main.db.session.commit()
+        moves.append(move)
+    return game, moves[-1]
+
+def test_guestWinIsBroadcast(main, fakeSocket):
+    game, move = guestGame(main, [0, 3, 1, 4, 2])
+    main.gameSubscriptions.add(game.gameId, 7, fakeSocket)
+    main.determineAndBroadcast(game, move)
+    assert main.Game.find(game.gameId).gameFinished
+    assert [(action, msgId) for action, _, msgId in fakeSocket.messages] == [("move", 7)]
+    assert json.loads(fakeSocket.messages[0][1])["position"] == 2
+
+def test_failedStateIsRolledBackAndStillBroadcast(main, fakeSocket, monkeypatch):
+    game, move = guestGame(main, [0, 3, 1, 4, 2])
+    main.gameSubscriptions.add(game.gameId, 7, fakeSocket)
+    def fail(*args):
+        raise RuntimeError("position stats unavailable")
+    monkeypatch.setattr(main.positionStats, "record", fail)
+    main.determineAndBroadcast(game, move)
+    # nothing of the result is left in the session for the next commit of another socket
+    assert not main.db.session.new and not main.db.session.dirty
+    main.db.session.commit()
+    assert not main.Game.find(game.gameId).gameFinished
+    assert main.db.session.query(main.PositionStat).count() == 0
+    assert [action for action, _, _ in fakeSocket.messages] == ["move"]
+
+# the game of a player against the bot, the player attacks
+def playerGame(main, username, positions):
+    main.db.session.add(main.User(username, f"{username}@localhost", "key", "salt"))
+    main.db.session.commit()
+    game = main.Game(username)
+    main.db.session.add(game)
+    main.db.session.commit()
+    for index, position in enumerate(positions):
+        move = main.Move(game.gameId, position, username if index % 2 == 0 else main.os.environ["BOT_USERNAME"])
+        main.db.session.add(move)
+        main.db.session.commit()
+    return game, move
+
+def test_digestIsQueuedAfterTheCommit(main, monkeypatch):
+    monkeypatch.setattr(main, "mailDigests", main.DigestQueue(60))
+    game, move = playerGame(main, "alice", [0, 3, 1, 4, 2])
+    main.determineAndBroadcast(game, move)
+    assert list(main.mailDigests.pending) == ["alice@localhost"]
+
+def test_failedCommitQueuesNoDigest(main, monkeypatch):
+    digests = main.DigestQueue(60)
+    monkeypatch.setattr(main, "mailDigests", digests)
+    game, move = playerGame(main, "alice", [0, 3, 1, 4, 2])
+    def fail():
+        raise RuntimeError("database gone")
+    monkeypatch.setattr(main.db.session, "commit", fail)
+    main.determineAndBroadcast(game, move)
+    monkeypatch.undo()
+    assert not main.Game.find(game.gameId).gameFinished
+    assert len(digests) == 0
@@ -0,0 +1,21 @@
+# importing main must not load numpy or the solver, they are loaded on first use or by the warmup
+import os, sys, subprocess
+
+from conftest import CODE
+
+def importedModules(statement):
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", statement], cwd=CODE, env=os.environ.copy(), capture_output=True, text=True, timeout=120)
+    assert result.returncode == 0, result.stderr
+    # "import time: self [us] | cumulative | imported package", nested imports are indented
+    return {line.rsplit("|", 1)[-1].strip() for line in result.stderr.splitlines() if line.startswith("import time:")}
+
+def test_mainDoesNotImportTheSolver():
+    modules = importedModules("import main")
+    assert "main" in modules
+    assert not {module for module in modules if module == "numpy" or module.startswith("numpy.")}
+    assert "TTTsolver" not in modules
+
+def test_solverImportsNumpy():
+    # the check above would pass if importtime stopped reporting the modules
+    modules = importedModules("import main; main.solver.get()")
+    assert {"numpy", "TTTsolver"} <= modules
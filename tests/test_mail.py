@@ -0,0 +1,68 @@
+# a refused reciever only requeues its own digest, the ones behind it are still sent
+import smtplib
+
+import mail
+
+class Server:
+    def __init__(self, refused):
+        self.refused = refused
+        self.sent = []
+
+    def sendmail(self, sender, reciever, message):
+        if reciever in self.refused:
+            raise smtplib.SMTPRecipientsRefused({reciever: (550, b"no such user")})
+        self.sent.append(reciever)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+class Log:
+    def __init__(self):
+        self.events = []
+
+    def warning(self, event, **fields):
+        self.events.append((event, fields))
+
+    error = warning
+
+def game(username):
+    return {"username": username, "domain": "localhost", "attacker": username, "defender": "bot", "winner": username, "isDraw": False, "gameId": 1}
+
+def test_refusedRecieverDoesNotBlockTheOthers(monkeypatch):
+    server = Server({"bad@localhost"})
+    monkeypatch.setattr(mail, "connect", lambda: server)
+    monkeypatch.setattr(mail, "digestMessage", lambda reciever, games: mail.MIMEText(reciever))
+    log = Log()
+    queue = mail.DigestQueue(0, log, maxAttempts=2)
+    for reciever in ("a@localhost", "bad@localhost", "b@localhost"):
+        queue.add(reciever, game(reciever))
+
+    assert queue.flush(everything=True) == 2
+    assert server.sent == ["a@localhost", "b@localhost"]
+    assert list(queue.pending) == ["bad@localhost"]
+
+    queue.add("c@localhost", game("c@localhost"))
+    assert queue.flush(everything=True) == 1
+    assert server.sent[-1] == "c@localhost"
+    # dropped after maxAttempts, with the reciever in the log
+    assert len(queue) == 0
+    assert ("dropped a game digest that could not be sent", {"reciever": "bad@localhost", "games": 1, "attempts": 2}) in log.events
+
+# the digests of a flush that is still running count as unsent until it is done
+def test_unsentCountsTheDigestsBeingSent(monkeypatch):
+    queue = mail.DigestQueue(0)
+    queue.add("a@localhost", game("a@localhost"))
+    queue.add("b@localhost", game("b@localhost"))
+    counts = []
+    class Counting(Server):
+        def sendmail(self, sender, reciever, message):
+            counts.append(queue.unsent())
+            super().sendmail(sender, reciever, message)
+    monkeypatch.setattr(mail, "connect", lambda: Counting(set()))
+    monkeypatch.setattr(mail, "digestMessage", lambda reciever, games: mail.MIMEText(reciever))
+    queue.flush(everything=True)
+    assert counts == [2, 2]
+    assert queue.unsent() == 0
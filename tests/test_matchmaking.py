@@ -0,0 +1,59 @@
+# joining a game and the matchmaking when several players race for the same opponent
+import threading
+
+import matchmaking
+
+def signUp(main, username):
+    main.db.session.add(main.User(username, f"{username}@localhost", "key", "salt"))
+    main.db.session.commit()
+    return main.Session.generateToken(username).sessionKey
+
+def test_concurrentJoinHasOneWinner(main):
+    host = signUp(main, "host")
+    tokens = [signUp(main, f"joiner{i}") for i in range(8)]
+    game = main.Game("host", False)
+    main.db.session.add(game)
+    main.db.session.commit()
+    gameId = game.idToHexString()
+    barrier = threading.Barrier(len(tokens))
+    results = {}
+    # every thread has a request (and so a session and a connection) of its own
+    def join(token):
+        with main.app.test_request_context("/joinGame", method="POST", data={"gameId": gameId}, headers={"Authorisation": f"Bearer {token}"}):
+            barrier.wait()
+            try:
+                results[token] = main.Game.join(main.request).defender
+            except ValueError:
+                results[token] = None
+            finally:
+                main.db.session.remove()
+    threads = [threading.Thread(target=join, args=(token,)) for token in tokens]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    winners = [defender for defender in results.values() if defender is not None]
+    assert len(results) == len(tokens)
+    assert len(winners) == 1
+    main.db.session.expire_all()
+    stored = main.Game.find(game.gameId)
+    assert stored.started and stored.defender == winners[0]
+
+def test_queuePairsEveryPlayerOnce():
+    queue = matchmaking.MatchmakingQueue()
+    pairs = []
+    for i in range(9):
+        opponent = queue.enqueue(f"player{i}", object(), i)
+        if opponent is not None:
+            pairs.append((opponent.username, f"player{i}"))
+    players = [player for pair in pairs for player in pair]
+    assert len(pairs) == 4 and len(set(players)) == 8
+    # the odd one keeps waiting
+    assert len(queue) == 1 and "player8" in queue
+
+def test_waitingPlayerIsNotPairedWithItself():
+    queue = matchmaking.MatchmakingQueue()
+    assert queue.enqueue("player", object(), 1) is None
+    assert queue.enqueue("player", object(), 2) is None
+    assert len(queue) == 1
+    assert queue.enqueue("other", object(), 3).username == "player"
@@ -0,0 +1,35 @@
+# the dropped messages only count the ones a slow connection did not get, not the ones after it closed
+import outbox
+
+class Socket:
+    def __init__(self):
+        self.frames = []
+
+    def write_message(self, data):
+        self.frames.append(data)
+        # never written, so the bytes stay pending
+        class Pending:
+            def add_done_callback(self, callback):
+                pass
+        return Pending()
+
+    def close(self, code=None, reason=None):
+        pass
+
+def test_closedOutboxIsNoDrop():
+    box = outbox.Outbox(Socket())
+    box.closed = True
+    before = outbox.DROPPED_MESSAGES.get()
+    box.put('{"action":"ping"}')
+    assert outbox.DROPPED_MESSAGES.get() == before
+    assert not box.needsResync
+
+def test_overLimitIsDrop():
+    socket = Socket()
+    box = outbox.Outbox(socket, maxBuffer=10, grace=60)
+    box.put("x" * 20)
+    before = outbox.DROPPED_MESSAGES.get()
+    box.put("y")
+    assert outbox.DROPPED_MESSAGES.get() == before + 1
+    assert box.needsResync
+    assert socket.frames == ["x" * 20]
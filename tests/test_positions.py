@@ -0,0 +1,32 @@
+# the generic upsert (databases without "on conflict") counts like the one of sqlite/postgres
+from sqlalchemy import create_engine, MetaData, Table, Column, Integer, select
+from sqlalchemy.orm import Session
+
+import positions
+
+GAMES = [
+    ([(4, 1), (0, -1), (8, 1), (2, -1), (6, 1), (1, -1)], -1),
+    ([(4, 1), (0, -1), (8, 1), (2, -1), (1, 1), (6, -1), (3, 1), (5, -1), (7, 1)], 0),
+    ([(0, 1), (4, -1), (1, 1), (8, -1), (2, 1)], 1),
+    ([(2, 1), (4, -1), (1, 1), (6, -1), (0, 1)], 1),
+]
+
+def recordAll(generic):
+    metadata = MetaData()
+    table = Table("positionstats", metadata, Column("code", Integer, primary_key=True), Column("moves", Integer, nullable=False), *(Column(column, Integer, nullable=False) for column in positions.COUNTERS.values()))
+    engine = create_engine("sqlite://")
+    metadata.create_all(engine)
+    stats = positions.PositionStats(table)
+    if generic:
+        stats.upsert = lambda session, rows: stats.upsertGeneric(session, sorted(rows, key=lambda row: row["code"]))
+    with Session(engine) as session:
+        for moves, result in GAMES:
+            stats.record(session, moves, result)
+            session.commit()
+        return [tuple(row) for row in session.execute(select(table).order_by(table.c.code))]
+
+def test_genericUpsertMatchesOnConflict():
+    rows = recordAll(generic=True)
+    assert rows == recordAll(generic=False)
+    # the empty board is in every game, once per result
+    assert rows[0] == (0, 0, 2, 1, 1)
@@ -0,0 +1,39 @@
+# failed logins with someone else's username use up the budget of the caller's ip, not the login of that user
+def test_loginIsLimitedPerIp(main, monkeypatch):
+    monkeypatch.setattr(main, "rateLimiter", main.ratelimit.RateLimiter({"login": (3, 60)}))
+    client = main.app.test_client()
+
+    def login(ip):
+        return client.post("/login", data={"username": "bot", "password": "wrong"}, environ_base={"REMOTE_ADDR": ip}).status_code
+
+    assert [login("10.0.0.1") for _ in range(4)] == [200, 200, 200, 429]
+    assert login("10.0.0.2") == 200
+
+# page loads and CORS preflights of /login don't use up the budget of the ip
+def test_onlyPostIsLimited(main, monkeypatch):
+    monkeypatch.setattr(main, "rateLimiter", main.ratelimit.RateLimiter({"login": (3, 60)}))
+    client = main.app.test_client()
+
+    for method in (client.get, client.options):
+        assert 429 not in [method("/login", environ_base={"REMOTE_ADDR": "10.0.0.1"}).status_code for _ in range(4)]
+    assert [client.post("/login", data={"username": "bot", "password": "wrong"}, environ_base={"REMOTE_ADDR": "10.0.0.1"}).status_code for _ in range(4)] == [200, 200, 200, 429]
+
+# a request that waited longer than ADMISSION_MAX_DELAY for the IOLoop is shed before it uses the budget
+def test_delayedRequestIsShed(main, monkeypatch):
+    monkeypatch.setattr(main, "rateLimiter", main.ratelimit.RateLimiter({"login": (1, 60)}))
+    monkeypatch.setattr(main, "admission", main.ratelimit.Admission(0.5))
+    client = main.app.test_client()
+
+    def login(queueDelay):
+        response = client.post("/login", data={"username": "bot", "password": "wrong"}, environ_base={"REMOTE_ADDR": "10.0.0.1", main.ratelimit.QUEUE_DELAY: queueDelay})
+        return response.status_code, response.get_json().get("error")
+
+    assert login(2.0) == (429, "server busy")
+    assert login(0.01)[0] == 200
+
+# websocket messages are shed while the IOLoop lags behind
+def test_loopLagIsShed(main):
+    admission = main.ratelimit.Admission(0.5)
+    assert admission.check("makeMove") is None
+    admission.lastBeat = main.time.monotonic() - 2
+    assert admission.check("makeMove") == "queueDelay"
@@ -0,0 +1,28 @@
+# dead websockets are closed by the reaper and their subscriptions are removed
+import time
+
+class Socket:
+    def __init__(self, idleFor):
+        self.lastActivity = time.monotonic() - idleFor
+        self.closedWith = None
+
+    def close(self, code=None, reason=None):
+        self.closedWith = (code, reason)
+
+def test_reapIdleAndClosedSockets(main, monkeypatch):
+    monkeypatch.setenv("WS_IDLE_TIMEOUT", "120")
+    alive, idle, closed = Socket(1), Socket(600), Socket(1)
+    main.WebSocket.connections.update([alive, idle])
+    try:
+        for socket in (alive, idle, closed):
+            main.gameSubscriptions.add(1, 1, socket)
+        main.lobbyFeed.subscribe(idle, 2)
+        main.lobbyFeed.subscribe(closed, 2)
+        main.reapConnections()
+        assert idle.closedWith == (1001, "idle")
+        assert alive.closedWith is None
+        assert main.WebSocket.connections >= {alive} and idle not in main.WebSocket.connections
+        assert [socket for socket, _ in main.gameSubscriptions.subscriptions[1]] == [alive]
+        assert idle not in main.lobbyFeed and closed not in main.lobbyFeed
+    finally:
+        main.WebSocket.connections.difference_update([alive, idle])
@@ -0,0 +1,125 @@
+# the graceful shutdown: its steps run in order within the deadline, and the steps of the server stop listening,
+# send the websockets the reconnect hint, finish the connections, wait for the background work and flush the mails
+import time, asyncio
+
+from tornado.ioloop import IOLoop
+
+import shutdown
+
+# runs the steps on an IOLoop of their own until the shutdown stops it
+def runShutdown(gracefulShutdown, before=None):
+    loop = IOLoop()
+    try:
+        if before:
+            loop.add_callback(before)
+        loop.add_callback(gracefulShutdown.run, "SIGTERM")
+        loop.start()
+    finally:
+        loop.close(all_fds=True)
+
+def test_stepsRunInOrder():
+    events = []
+    gracefulShutdown = shutdown.GracefulShutdown(5)
+    gracefulShutdown.add("first", lambda: events.append("first"))
+    async def second():
+        await asyncio.sleep(0.01)
+        events.append("second")
+    gracefulShutdown.add("second", second)
+    gracefulShutdown.add("failing", lambda: 1 / 0)
+    gracefulShutdown.add("third", lambda: events.append("third"))
+    runShutdown(gracefulShutdown)
+    assert events == ["first", "second", "third"]
+    assert not gracefulShutdown.timedOut
+
+def test_deadlineAbandonsTheRest():
+    events = []
+    gracefulShutdown = shutdown.GracefulShutdown(0.2, grace=0.5)
+    gracefulShutdown.add("hanging", lambda: asyncio.sleep(60))
+    gracefulShutdown.add("skipped", lambda: events.append("skipped"))
+    # e.g. the mails, they still get the grace after the deadline
+    async def always():
+        await asyncio.sleep(0.1)
+        events.append("always")
+    gracefulShutdown.add("always", always, always=True)
+    start = time.monotonic()
+    runShutdown(gracefulShutdown)
+    assert time.monotonic() - start < 5
+    assert gracefulShutdown.timedOut
+    assert events == ["always"]
+
+def test_noBackgroundWorkWhileStopping():
+    gracefulShutdown = shutdown.GracefulShutdown(5)
+    futures = []
+    gracefulShutdown.add("start work", lambda: futures.append(gracefulShutdown.background(time.sleep, 0)))
+    runShutdown(gracefulShutdown)
+    assert futures == [None]
+
+class Server:
+    def __init__(self, events):
+        self.events = events
+
+    def stop(self):
+        self.events.append("server stop")
+
+    async def close_all_connections(self):
+        self.events.append("server close connections")
+
+class Outbox:
+    def __init__(self, socket):
+        self.socket = socket
+
+    def flush(self):
+        self.socket.events.append(("flush", self.socket.name))
+
+# a websocket whose client answers the close a moment later
+class Socket:
+    def __init__(self, main, events, name):
+        self.main = main
+        self.events = events
+        self.name = name
+        self.outbox = Outbox(self)
+
+    def send(self, action, data, msgId, error=False):
+        self.events.append(("send", self.name, action, data["reason"], 0 <= data["reconnectAfter"] <= 1))
+
+    def close(self, code=None, reason=None):
+        self.events.append(("close", self.name, code))
+        IOLoop.current().call_later(0.1, self.main.WebSocket.connections.discard, self)
+
+class Digests:
+    def __init__(self, events):
+        self.events = events
+
+    def flush(self, everything=False):
+        self.events.append(("mails", everything))
+
+def test_serverShutdownSteps(main, monkeypatch):
+    events = []
+    monkeypatch.setenv("SHUTDOWN_RECONNECT_JITTER", "1")
+    monkeypatch.setattr(main.readiness, "stopping", False)
+    monkeypatch.setattr(main, "mailDigests", Digests(events))
+    sockets = [Socket(main, events, "a"), Socket(main, events, "b")]
+    main.WebSocket.connections.update(sockets)
+    try:
+        gracefulShutdown = shutdown.GracefulShutdown(5)
+        main.addShutdownSteps(gracefulShutdown, [Server(events)])
+        # work that is still running when the signal arrives, it is waited for before the mails are sent
+        def archive():
+            time.sleep(0.2)
+            events.append("archived")
+        runShutdown(gracefulShutdown, lambda: gracefulShutdown.background(archive))
+        assert main.readiness.stopping and not main.readiness.ready()
+        assert not gracefulShutdown.timedOut
+        assert not main.WebSocket.connections.intersection(sockets)
+        socketEvents = sorted(event for event in events if isinstance(event, tuple) and event[0] != "mails")
+        assert socketEvents == sorted([("send", name, "shutdown", "restart", True) for name in "ab"] + [("flush", name) for name in "ab"] + [("close", name, 1012) for name in "ab"])
+        # per socket: the hint, then the flush of its outbox, then the close
+        for name in "ab":
+            assert [event[0] for event in events if isinstance(event, tuple) and event[1:2] == (name,)] == ["send", "flush", "close"]
+        order = [event if isinstance(event, str) else event[0] for event in events]
+        assert order.index("server stop") < order.index("send")
+        assert max(index for index, event in enumerate(order) if event == "close") < order.index("server close connections")
+        assert order.index("server close connections") < order.index("mails") and order.index("archived") < order.index("mails")
+        assert events[-1] == ("mails", True)
+    finally:
+        main.WebSocket.connections.difference_update(sockets)
@@ -0,0 +1,65 @@
+# the version check against a local bare repository as the remote
+import asyncio, subprocess
+
+import version
+
+def git(cwd, *args):
+    return subprocess.run(["git", "-c", "user.name=test", "-c", "user.email=test@localhost", *args], cwd=cwd, capture_output=True, text=True, check=True).stdout.strip()
+
+def commit(repository, message):
+    git(repository, "commit", "--allow-empty", "-q", "-m", message)
+    return git(repository, "rev-parse", "HEAD")
+
+# a working copy whose origin is a bare repository, both at the first commit
+def repositories(tmp_path):
+    remote, work = tmp_path / "remote.git", tmp_path / "work"
+    git(tmp_path, "init", "-q", "--bare", "-b", "main", str(remote))
+    git(tmp_path, "init", "-q", "-b", "main", str(work))
+    git(work, "remote", "add", "origin", str(remote))
+    first = commit(work, "first")
+    git(work, "push", "-q", "origin", "main")
+    return work, first
+
+def check(repository):
+    checker = version.VersionChecker(str(repository), interval=0)
+    checker.localHash = checker.readLocalHash()
+    asyncio.run(checker.refresh())
+    return checker
+
+def test_upToDate(tmp_path):
+    work, first = repositories(tmp_path)
+    info = check(work).toDict()
+    assert info["versionHash"] == first
+    assert info["remoteHash"] == first
+    assert info["upToDate"] is True
+    assert info["remoteReachable"] is True
+    assert info["checkedAt"] is not None
+
+def test_behindRemote(tmp_path):
+    work, first = repositories(tmp_path)
+    second = commit(work, "second")
+    git(work, "push", "-q", "origin", "main")
+    git(work, "reset", "-q", "--hard", first)
+    info = check(work).toDict()
+    assert info["versionHash"] == first
+    assert info["remoteHash"] == second
+    assert info["upToDate"] is False
+
+def test_unreachableRemoteKeepsLastHash(tmp_path):
+    work, first = repositories(tmp_path)
+    checker = check(work)
+    git(work, "remote", "set-url", "origin", str(tmp_path / "missing.git"))
+    asyncio.run(checker.refresh())
+    info = checker.toDict()
+    assert info["remoteReachable"] is False
+    # the last known value is served
+    assert info["remoteHash"] == first
+    assert info["upToDate"] is True
+
+def test_neverReachedRemote(tmp_path):
+    work, first = repositories(tmp_path)
+    git(work, "remote", "set-url", "origin", str(tmp_path / "missing.git"))
+    info = check(work).toDict()
+    assert info["remoteReachable"] is False
+    assert info["remoteHash"] is None
+    assert info["upToDate"] is None